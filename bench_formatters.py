@@ -0,0 +1,145 @@
+"""
+Проверка и замер векторных форматтеров.
+
+Сначала на случайных значениях (реалистичных и «грязных») сверяет каждую *_series
+функцию с поэлементным .map() скалярной версии, затем замеряет обе на больших колонках.
+
+    python bench_formatters.py [--rows 100000] [--seed 0]
+"""
+import argparse
+import itertools
+import random
+import string
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from formatters import (
+    format_currency, format_currency_series,
+    format_date_display, format_date_display_series,
+    format_phone, format_phone_series,
+    format_vk_link, format_vk_link_series,
+)
+
+_PHONE_CHARS = string.digits + " +()-"
+# цифры других письменностей, полноширинные, надстрочные и «похожие на цифры» (½, Ⅻ): str.isdigit() различает их
+_UNICODE_DIGITS = "٠١٢٣٤٥٦٧٨٩०१२३४५६७८९０１２３４５６７８９²³①½Ⅻ𝟙"
+_UNICODE_SPACES = "\u00a0\u2003\u3000\x1c"
+
+def _random_phone(rng, dirty=True):
+    kind = rng.random() if dirty else 1.0
+    if kind < 0.05:
+        return rng.choice([None, float("nan"), "", 0, "нет"])
+    if kind < 0.15:
+        return "".join(rng.choice(_PHONE_CHARS) for _ in range(rng.randint(0, 16)))
+    if kind < 0.2:
+        return rng.randint(70000000000, 89999999999)
+    if kind < 0.25:
+        # номер, в котором часть цифр — Unicode-цифры, и Unicode-пробелы вокруг
+        digits = [rng.choice(_UNICODE_DIGITS) if rng.random() < 0.3 else d
+                  for d in rng.choice(["7", "8", ""]) + "".join(rng.choice(string.digits) for _ in range(10))]
+        return rng.choice(["", _UNICODE_SPACES[rng.randrange(4)]]) + "".join(digits)
+    digits = rng.choice(["7", "8", ""]) + "".join(rng.choice(string.digits) for _ in range(10))
+    return rng.choice(["{}", "+{}", " {} "]).format(digits)
+
+def _random_vk(rng, dirty=True):
+    kind = rng.random() if dirty else rng.uniform(0.1, 1)
+    if kind < 0.1:
+        return rng.choice([None, float("nan"), "", " ", 0])
+    if kind < 0.15:
+        return rng.choice(["", " ", *_UNICODE_SPACES]) + "".join(
+            rng.choice(string.digits + _UNICODE_DIGITS) for _ in range(rng.randint(1, 9)))
+    if kind < 0.5:
+        return rng.choice(["", " "]) + str(rng.randint(1, 10 ** 9))
+    return "".join(rng.choice(string.ascii_lowercase + "_.") for _ in range(rng.randint(1, 12)))
+
+def _random_date(rng, dirty=True):
+    kind = rng.random() if dirty else rng.choice([0.0] + [1.0] * 19)  # в БД бывают NULL
+    day = date(2015, 1, 1) + timedelta(days=rng.randint(0, 4000))
+    if kind < 0.05:
+        return rng.choice([None, float("nan"), ""])
+    if kind < 0.1:
+        return rng.choice([day.strftime("%d.%m.%Y"), f"{day} 00:00:00", f"{day.year}-{day.month}-{day.day}",
+                           "2024-02-30", "0999-01-01", "дата", f" {day}"])
+    if kind < 0.13:
+        return rng.choice([pd.Timestamp(day), datetime(day.year, day.month, day.day), day])
+    return day.isoformat()
+
+def _random_amount(rng, dirty=True):
+    kind = rng.random() if dirty else rng.uniform(0.08, 1)
+    if kind < 0.05:
+        return float("nan")
+    if kind < 0.08:
+        return rng.choice([float("inf"), -float("inf"), 1e20, -0.5, 0.0])
+    return rng.uniform(-1e6, 1e7) if kind < 0.2 else float(rng.randint(0, 500) * 100)
+
+CASES = [
+    # (название, генератор значения, скалярная функция, векторная функция)
+    ("format_phone", _random_phone, format_phone, format_phone_series),
+    ("format_vk_link", _random_vk, format_vk_link, format_vk_link_series),
+    ("format_date_display", _random_date, format_date_display, format_date_display_series),
+    ("format_currency", _random_amount, format_currency, format_currency_series),
+]
+
+def _column(generator, rows, rng, numeric=False, dirty=True):
+    values = [generator(rng, dirty) for _ in range(rows)]
+    return pd.Series(values, dtype=float if numeric else object)
+
+def check_equivalence(rows, seed):
+    """Сверяет векторные и скалярные версии, возвращает число расхождений"""
+    rng = random.Random(seed)
+    failures = 0
+    for (name, generator, scalar, vectorized), dirty in itertools.product(CASES, (True, False)):
+        column = _column(generator, rows, rng, numeric=name == "format_currency", dirty=dirty)
+        column.index = np.arange(rows) * 3  # индекс не обязан быть 0..n-1
+        expected = column.map(scalar)
+        actual = vectorized(column)
+        mismatched = [
+            (value, want, got)
+            for value, want, got in zip(column, expected, actual)
+            if want != got or type(want) is not type(got)
+        ]
+        if not actual.index.equals(column.index):
+            mismatched.append(("<index>", "", ""))
+        status = "OK" if not mismatched else f"{len(mismatched)} расхождений"
+        print(f"  {name:<22} {'смешанные' if dirty else 'как в БД':<10} {status}")
+        for value, want, got in mismatched[:5]:
+            print(f"      {value!r}: ожидалось {want!r}, получено {got!r}")
+        failures += len(mismatched)
+    return failures
+
+def _best_of(func, column, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(column)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def benchmark(rows, seed, repeat=3):
+    """Замер .map(скалярная) против векторной версии на колонках из rows строк в формате БД"""
+    rng = random.Random(seed)
+    print(f"\n{'функция':<22} {'map, мс':>10} {'series, мс':>12} {'ускорение':>10}")
+    for name, generator, scalar, vectorized in CASES:
+        column = _column(generator, rows, rng, numeric=name == "format_currency", dirty=False)
+        t_scalar = _best_of(lambda c: c.map(scalar), column, repeat)
+        t_vector = _best_of(vectorized, column, repeat)
+        print(f"{name:<22} {t_scalar * 1000:>10.1f} {t_vector * 1000:>12.1f} {t_scalar / t_vector:>9.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--check-rows", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"Сверка со скалярными функциями ({args.check_rows} значений на функцию):")
+    if check_equivalence(args.check_rows, args.seed):
+        sys.exit(1)
+    benchmark(args.rows, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""
+Замер запросов и pandas-обработки, которые приложение выполняет на каждой странице.
+
+Каждый случай сначала выполняется для разогрева, затем --rounds раз; кэши чтения обходятся,
+поэтому замеряется сам запрос. Сводка печатается таблицей, с --json сохраняется в формате
+pytest-benchmark, а --compare печатает изменение медиан относительно прошлого JSON.
+Запись (добавление и удаление услуги) выполняется по-настоящему — используйте копию базы.
+
+    python gen_synthetic_db.py --db studio_bench.db
+    python bench_queries.py --db studio_bench.db [--rounds 5] [--json bench.json] [--compare old.json] [-k отчёт]
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import studio_service
+
+CASES = []
+
+def case(page, name):
+    """Регистрирует замер: функция получает (core, ctx) и выполняет один раунд"""
+    def register(func):
+        CASES.append((page, name, func))
+        return func
+    return register
+
+def _uncached(reader):
+    """Исходная функция под кэширующим декоратором cached_read"""
+    return getattr(reader, "__wrapped__", reader)
+
+def build_context(core):
+    """Параметры «типичного» вызова: самый активный клиент, крупный заказ, последний полный год"""
+    with core.get_pool().connection() as conn:
+        one = lambda sql: conn.execute(sql).fetchone()
+        ctx = {
+            "client_id": one("SELECT client_id FROM orders GROUP BY client_id ORDER BY COUNT(*) DESC LIMIT 1")[0],
+            "order_id": one("SELECT order_id FROM order_items GROUP BY order_id ORDER BY COUNT(*) DESC LIMIT 1")[0],
+            "service_id": one("SELECT MIN(id) FROM services_catalog")[0],
+            "group_id": one("SELECT group_id FROM clients WHERE group_id IS NOT NULL "
+                            "GROUP BY group_id ORDER BY COUNT(*) DESC LIMIT 1")[0],
+            "years": [y for (y,) in conn.execute("SELECT DISTINCT year FROM revenue_rollup ORDER BY year")],
+            "client_ids": [c for (c,) in conn.execute("SELECT id FROM clients ORDER BY id LIMIT ?",
+                                                       (CONCURRENT_SESSIONS * WRITES_PER_SESSION,))],
+            "counts": {t: one(f"SELECT COUNT(*) FROM {t}")[0]
+                       for t in ("clients", "groups", "services_catalog", "orders", "order_items")},
+        }
+        contact = conn.execute("SELECT phone, vk_id, tg_id FROM clients WHERE phone_norm IS NOT NULL LIMIT 1").fetchone()
+    ctx["contact"] = contact
+    ctx["year"] = ctx["years"][-2] if len(ctx["years"]) > 1 else ctx["years"][-1]
+    ctx["month"] = 11
+    # ключ из середины списка — для замера «глубокой» страницы
+    for listing in ("clients", "orders"):
+        middle = core.count_listing.__wrapped__(listing) // 2
+        keys = ", ".join(core.LISTINGS[listing]["keys"])
+        with core.get_pool().connection() as conn:
+            ctx[f"{listing}_middle"] = conn.execute(
+                f"SELECT {keys} FROM {core.LISTINGS[listing]['from']} ORDER BY {keys.replace(',', ' DESC,')} DESC "
+                f"LIMIT 1 OFFSET ?", (middle,)).fetchone()
+    return ctx
+
+# --- КЛИЕНТЫ И ГРУППЫ ---
+@case("Клиенты и Группы", "группы")
+def _(core, ctx):
+    _uncached(core.load_groups)()
+
+@case("Клиенты и Группы", "поле выбора клиента: последние добавленные")
+def _(core, ctx):
+    core.pick_clients()
+
+@case("Клиенты и Группы", "поле выбора клиента: «Ив»")
+def _(core, ctx):
+    core.pick_clients("Ив")
+
+@case("Клиенты и Группы", "карточка клиента")
+def _(core, ctx):
+    core.load_client(ctx["client_id"])
+
+@case("Клиенты и Группы", "возможные дубликаты")
+def _(core, ctx):
+    _uncached(core.duplicate_contact_groups)()
+
+@case("Клиенты и Группы", "проверка дублей контакта")
+def _(core, ctx):
+    core.find_duplicate_clients(*ctx["contact"])
+
+@case("Клиенты и Группы", "число клиентов")
+def _(core, ctx):
+    _uncached(core.count_listing)("clients")
+
+@case("Клиенты и Группы", "число клиентов группы")
+def _(core, ctx):
+    _uncached(core.count_listing)("clients", group=ctx["group_id"])
+
+@case("Клиенты и Группы", "страница клиентов: первая")
+def _(core, ctx):
+    core.fetch_page("clients", page_size=50)
+
+@case("Клиенты и Группы", "страница клиентов: из середины")
+def _(core, ctx):
+    core.fetch_page("clients", after=ctx["clients_middle"], page_size=50)
+
+@case("Клиенты и Группы", "страница клиентов: по выручке")
+def _(core, ctx):
+    core.fetch_page("clients", page_size=50, sort="revenue")
+
+@case("Клиенты и Группы", "страница клиентов: давно не платили, по последней оплате")
+def _(core, ctx):
+    core.fetch_page("clients", page_size=50, sort="last_payment",
+                    idle_since=(date.today() - timedelta(days=365)).isoformat())
+
+@case("Клиенты и Группы", "карточка клиента: итоги и первая страница заказов")
+def _(core, ctx):
+    core.load_client_stats(ctx["client_id"])
+    core.fetch_page("client_orders", page_size=25, client=ctx["client_id"])
+
+@case("Клиенты и Группы", "итоги клиента по журналу (как было: report 2 за каждый год)")
+def _(core, ctx):
+    for year in ctx["years"]:
+        core.run_query(*core.compile_report("clients_by_year", year=year), fetch=True)
+
+@case("Клиенты и Группы", "поиск: «Иван» (триграммы)")
+def _(core, ctx):
+    core.search_clients("Иван")
+
+@case("Клиенты и Группы", "поиск: «Ив» (префикс)")
+def _(core, ctx):
+    core.search_clients("Ив")
+
+@case("Клиенты и Группы", "поиск: «7916» в группе")
+def _(core, ctx):
+    core.search_clients("7916", group_id=ctx["group_id"])
+
+@case("Клиенты и Группы", "форматирование страницы клиентов (250 строк)")
+def _(core, ctx):
+    df = ctx.setdefault("clients_page", core.fetch_page("clients", page_size=250))
+    core.format_phone_series(df["phone"])
+    core.format_vk_link_series(df["vk_id"])
+    core.format_date_display_series(df["first_order_date"])
+
+# --- ПРАЙС-ЛИСТ ---
+@case("Прайс-лист Услуг", "страница прайс-листа")
+def _(core, ctx):
+    core.fetch_page("services", page_size=50)
+
+@case("Прайс-лист Услуг", "поле выбора услуги: «зап»")
+def _(core, ctx):
+    core.pick_services("зап")
+
+@case("Прайс-лист Услуг", "услуги не из прайс-листа")
+def _(core, ctx):
+    _uncached(core.load_unmatched_services)()
+
+# --- ЗАКАЗЫ И УСЛУГИ ---
+@case("Заказы и услуги", "поле выбора заказа клиента")
+def _(core, ctx):
+    # как в «Управление заказом»
+    core.pick_orders(ctx["client_id"])
+
+@case("Заказы и услуги", "состав заказа с итогом")
+def _(core, ctx):
+    # как в «Состав заказа»
+    items = core.load_order_items(ctx["order_id"])
+    core.order_total(ctx["order_id"])
+    core.format_date_display_series(items["payment_date"])
+    core.format_currency_series(items["amount"])
+
+@case("Заказы и услуги", "число заказов")
+def _(core, ctx):
+    _uncached(core.count_listing)("orders")
+
+@case("Заказы и услуги", "число заказов «Оплачен»")
+def _(core, ctx):
+    _uncached(core.count_listing)("orders", status="Оплачен")
+
+@case("Заказы и услуги", "страница заказов: первая")
+def _(core, ctx):
+    core.fetch_page("orders", page_size=50)
+
+@case("Заказы и услуги", "страница заказов: из середины")
+def _(core, ctx):
+    core.fetch_page("orders", after=ctx["orders_middle"], page_size=50)
+
+@case("Заказы и услуги", "запись: добавить и удалить заказ с услугой")
+def _(core, ctx):
+    order_id = core.add_order_item(ctx["client_id"], None, date.today(), "В работе", ctx["service_id"], date.today(), 1000, 1)
+    core.delete_order(order_id)
+
+CONCURRENT_SESSIONS = 8
+WRITES_PER_SESSION = 25
+
+def _concurrent_sessions(core, ctx, write):
+    """Запускает сессии в потоках; каждая делает WRITES_PER_SESSION записей write(client_id)"""
+    clients = ctx["client_ids"]
+    def session(n):
+        for client_id in clients[n::CONCURRENT_SESSIONS]:
+            write(client_id)
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(CONCURRENT_SESSIONS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+@case("Заказы и услуги", f"запись: {CONCURRENT_SESSIONS} сессий параллельно (как было)")
+def _(core, ctx):
+    def write(client_id):
+        with core.get_pool().connection() as conn:
+            conn.execute("UPDATE clients SET name = name WHERE id = ?", (client_id,))
+            conn.commit()
+    _concurrent_sessions(core, ctx, write)
+
+@case("Заказы и услуги", f"запись: {CONCURRENT_SESSIONS} сессий параллельно, очередь записи")
+def _(core, ctx):
+    _concurrent_sessions(core, ctx, lambda client_id: core.run_query("UPDATE clients SET name = name WHERE id = ?", (client_id,)))
+
+# --- ОТЧЁТЫ ---
+@case("ОТЧЁТЫ", "main_query: журнал оплат целиком в pandas (как было)")
+def _(core, ctx):
+    sql, bindings = core.compile_report("ledger")
+    df = core.run_query(sql, bindings, fetch=True)
+    df["payment_date"] = pd.to_datetime(df["payment_date"])
+    df["year"] = df["payment_date"].dt.year
+    df["month"] = df["payment_date"].dt.month
+
+@case("ОТЧЁТЫ", "снимок оплат: полная сборка")
+def _(core, ctx):
+    core._LEDGERS.pop(core.DB_PATH, None)
+    core.ledger_snapshot()
+
+@case("ОТЧЁТЫ", "снимок оплат: дозагрузка одной изменённой строки")
+def _(core, ctx):
+    # запись в журнал напрямую, чтобы не замерять триггеры агрегатов самой правки
+    core.get_writer().submit(lambda conn: conn.execute("INSERT INTO ledger_changes (item_id) SELECT MIN(id) FROM order_items"))
+    core.ledger_snapshot()
+
+@case("ОТЧЁТЫ", "годы с оплатами")
+def _(core, ctx):
+    _uncached(core.load_report_years)()
+
+REPORT_CALLS = [
+    ("1. по группам за год", "groups_by_year", lambda ctx: {"year": ctx["year"]}),
+    ("2. по клиентам за год", "clients_by_year", lambda ctx: {"year": ctx["year"]}),
+    ("2. по клиентам за год, группа", "clients_by_year", lambda ctx: {"year": ctx["year"], "group": ctx["group_id"]}),
+    ("3. новые клиенты за год", "new_clients", lambda ctx: {"year": ctx["year"]}),
+    ("4. сводка по годам", "years_summary", lambda ctx: {}),
+    ("5. за месяц", "clients_by_month", lambda ctx: {"year": ctx["year"], "month": ctx["month"]}),
+    ("6. по месяцам", "months_of_year", lambda ctx: {"year": ctx["year"]}),
+    ("7. последняя неделя", "last_week", lambda ctx: {"since": (date.today() - timedelta(days=7)).isoformat()}),
+    ("9. по услугам за год", "services", lambda ctx: {"year": ctx["year"]}),
+]
+
+for title, report, params in REPORT_CALLS:
+    def _report(core, ctx, report=report, params=params):
+        df = _uncached(core.run_report)(report, **params(ctx))
+        for column in df.columns:
+            if column.endswith("sum") or column.startswith("Сумма"):
+                core.format_currency_series(df[column])
+    case("ОТЧЁТЫ", f"отчёт {title}")(_report)
+
+@case("ОТЧЁТЫ", "отчёт 8. когорты: матрица удержания")
+def _(core, ctx):
+    core.cohort_matrix(_uncached(core.run_report)("cohorts"), "clients")
+
+@case("ОТЧЁТЫ", "отчёт 9. по услугам за год: SQL по агрегатам (service_id)")
+def _(core, ctx):
+    core.run_query(*core.compile_report("services", year=ctx["year"]), fetch=True)
+
+@case("ОТЧЁТЫ", "отчёт 9. по услугам за год: группировка order_items по названию (как было бы)")
+def _(core, ctx):
+    core.run_query('''
+        SELECT COALESCE(sc.name, oi.service_name) AS service_name,
+               COUNT(*) AS payments_count, SUM(oi.amount) AS total_sum, SUM(oi.hours) AS total_hours
+        FROM order_items oi
+        LEFT JOIN services_catalog sc ON sc.id = oi.service_id
+        WHERE oi.payment_date >= :start AND oi.payment_date < :end
+        GROUP BY 1
+    ''', {"start": f"{ctx['year']}-01-01", "end": f"{ctx['year'] + 1}-01-01"}, fetch=True)
+
+@case("ОТЧЁТЫ", "предрасчёт: чтение результата с диска (отчёт 2)")
+def _(core, ctx):
+    _uncached(core.precomputed_report)("clients_by_year", year=ctx["year"])
+
+@case("ОТЧЁТЫ", "предрасчёт: проверка всех результатов без изменений")
+def _(core, ctx):
+    core.precompute_reports()
+
+@case("ОТЧЁТЫ", "выгрузка журнала за год в CSV")
+def _(core, ctx):
+    core.export_report("ledger", io.BytesIO(), "csv", year=ctx["year"])
+
+@case("ОТЧЁТЫ", "выгрузка журнала за год в Parquet")
+def _(core, ctx):
+    core.export_report("ledger", io.BytesIO(), "parquet", year=ctx["year"])
+
+@case("ОТЧЁТЫ", "выгрузка в Parquet: NULL в первых строках")
+def _(core, ctx):
+    # регрессия: схема не должна браться из первой порции, где числовые колонки пустые
+    chunks = core.iter_report_chunks("ledger", 1000, year=ctx["year"], month=ctx["month"])
+    first = next(chunks)
+    blank = first.head(2).assign(service_id=None, amount=None, hours=None)
+    core._write_parquet(itertools.chain([blank, first], chunks), io.BytesIO(), core.REPORTS["ledger"]["types"])
+
+# --- ЗАПУСК ---
+def run_case(core, ctx, func, rounds):
+    func(core, ctx)  # разогрев: кэш страниц SQLite, подготовленные выражения
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func(core, ctx)
+        timings.append(time.perf_counter() - started)
+    return {
+        "min": min(timings),
+        "max": max(timings),
+        "mean": statistics.fmean(timings),
+        "stddev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "median": statistics.median(timings),
+        "rounds": rounds,
+        "ops": 1 / statistics.fmean(timings),
+        "data": timings,
+    }
+
+def _commit_info():
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                                    capture_output=True, text=True).stdout.strip())
+    except OSError:
+        commit, dirty = "", False
+    return {"id": commit, "dirty": dirty}
+
+def compare(results, previous_path):
+    """Печатает изменение медиан относительно сохранённого прогона"""
+    with open(previous_path, encoding="utf-8") as f:
+        previous = {(b["group"], b["name"]): b["stats"]["median"] for b in json.load(f)["benchmarks"]}
+    print(f"\nСравнение с {previous_path} (медианы):")
+    for bench in results:
+        old = previous.get((bench["group"], bench["name"]))
+        new = bench["stats"]["median"]
+        change = f"{(new / old - 1) * 100:+7.1f}%" if old else "   новый"
+        print(f"  {bench['group'][:18]:<18} {bench['name'][:52]:<52} {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default="studio_bench.db")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--json", help="куда сохранить результаты")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("-k", dest="keyword", help="только случаи, в странице или названии которых есть подстрока")
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        sys.exit(f"{args.db} не найден; создайте базу: python gen_synthetic_db.py --db {args.db}")
+
+    core = studio_service
+    # замеры не пишут в журнал метрик и кэш результатов приложения
+    results_dir = tempfile.TemporaryDirectory()
+    core.configure(db_path=args.db, metrics_db_path=":memory:",
+                   results_db_path=os.path.join(results_dir.name, "report_cache.db"))
+    core.SLOW_QUERY_MS = float("inf")  # и не тратят время на EXPLAIN медленных запросов
+    core.init_db()
+    ctx = build_context(core)
+    print(f"{args.db}: " + ", ".join(f"{t} {n}" for t, n in ctx["counts"].items()))
+
+    results = []
+    for page, name, func in CASES:
+        if args.keyword and args.keyword.lower() not in f"{page} {name}".lower():
+            continue
+        stats = run_case(core, ctx, func, args.rounds)
+        results.append({"group": page, "name": name, "fullname": f"{page}::{name}", "stats": stats})
+        print(f"  {page[:18]:<18} {name[:52]:<52} {stats['median'] * 1000:10.2f} мс")
+
+    if args.json:
+        report = {
+            "machine_info": {"python_version": platform.python_version(), "platform": platform.platform(),
+                             "processor": platform.processor(), "sqlite_version": sqlite3.sqlite_version},
+            "commit_info": _commit_info(),
+            "datetime": datetime.now().isoformat(timespec="seconds"),
+            "version": "studio-bench-1",
+            "database": {"path": args.db, "counts": ctx["counts"]},
+            "benchmarks": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.json}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Форматирование и разбор значений для отображения: телефоны, VK, Telegram, даты, суммы.
+Для каждой колонки DataFrame есть векторная версия (*_series), которая даёт
+тот же результат, что и поэлементный .apply() скалярной функции.
+"""
+from datetime import datetime, date
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+_INT64_LIMIT = 2 ** 63
+
+# --- СКАЛЯРНЫЕ ФУНКЦИИ ---
+def format_phone(phone_str):
+    """
+    Форматирование номера: 7XXXXXXXXXX → +7 (XXX) XXX-XX-XX
+    """
+    if not phone_str or pd.isna(phone_str):
+        return ""
+    digits = ''.join(filter(str.isdigit, str(phone_str)))
+    if digits.startswith("8"):
+        digits = "7" + digits[1:]
+    if len(digits) == 10:
+        digits = "7" + digits  # если не хватает кода
+    if len(digits) != 11 or not digits.startswith("7"):
+        return phone_str  # вернём как есть
+
+    return f"+7 ({digits[1:4]}) {digits[4:7]}-{digits[7:9]}-{digits[9:11]}"
+
+def normalize_phone(phone_str):
+    """
+    Телефон для хранения: 7XXXXXXXXXX (правила формы добавления клиента).
+    "" для пустого значения, None — если номер некорректный.
+    """
+    if not phone_str or pd.isna(phone_str):
+        return ""
+    digits = ''.join(filter(str.isdigit, str(phone_str)))
+    if digits.startswith("8") and len(digits) == 11:
+        digits = "7" + digits[1:]
+    if len(digits) == 10:
+        digits = "7" + digits
+    if len(digits) != 11 or not digits.startswith("7"):
+        return None
+    return digits
+
+def normalize_telegram(tg_str):
+    """Ник Telegram для хранения: без @ и t.me/"""
+    if not tg_str or pd.isna(tg_str):
+        return ""
+    return str(tg_str).strip().replace("@", "").replace("t.me/", "")
+
+def format_vk_link(vk_id) -> str:
+    """Формирует правильную ссылку на VK"""
+    if not vk_id or pd.isna(vk_id):
+        return ""
+    vk_id = str(vk_id).strip()
+    # Если только цифры — значит, это id
+    if vk_id.isdigit():
+        return f"https://vk.com/id{vk_id}"
+    return f"https://vk.com/{vk_id}"
+
+def format_vk(vk_str):
+    """Форматирование VK ID для отображения"""
+    if not vk_str or pd.isna(vk_str):
+        return ""
+    vk = str(vk_str).strip()
+    vk = vk.replace("https://", "").replace("http://", "")
+    if vk.startswith("vk.com/"):
+        return vk
+    if vk.startswith("id") and vk[2:].isdigit():
+        return f"vk.com/{vk}"
+    if vk.isdigit():
+        return f"vk.com/id{vk}"
+    return f"vk.com/{vk}"
+
+def format_telegram(tg_str):
+    """Форматирование Telegram для отображения"""
+    if not tg_str or pd.isna(tg_str):
+        return ""
+    tg = str(tg_str).strip()
+    tg = tg.replace("https://", "").replace("http://", "").replace("@", "")
+    if tg.startswith("t.me/"):
+        return tg
+    return f"t.me/{tg}"
+
+def format_date_display(date_str):
+    """Форматирование даты в dd.mm.yyyy"""
+    if pd.isna(date_str) or date_str is None or date_str == '':
+        return ""
+    try:
+        if isinstance(date_str, str):
+            if '.' in date_str:
+                return date_str
+            date_obj = datetime.strptime(date_str, "%Y-%m-%d")
+        else:
+            date_obj = pd.to_datetime(date_str)
+        return date_obj.strftime("%d.%m.%Y")
+    except:
+        return str(date_str)
+
+def parse_date_to_db(date_str):
+    """Преобразует строку даты в формат БД"""
+    if pd.isna(date_str) or not date_str or date_str == '':
+        return None
+    try:
+        if isinstance(date_str, date):
+            return date_str.strftime("%Y-%m-%d")
+        if isinstance(date_str, str):
+            if '.' in date_str:
+                return datetime.strptime(date_str, "%d.%m.%Y").strftime("%Y-%m-%d")
+            return date_str
+        return pd.to_datetime(date_str).strftime("%Y-%m-%d")
+    except:
+        return None
+
+def format_currency(amount):
+    """Форматирование валюты"""
+    if pd.isna(amount) or amount is None:
+        return "0"
+    try:
+        return f"{int(float(amount)):,}".replace(",", " ")
+    except:
+        return str(amount)
+
+def parse_currency(amount_str):
+    """Преобразует строку в число"""
+    if not amount_str or pd.isna(amount_str):
+        return 0.0
+    try:
+        clean = str(amount_str).replace(" ", "").replace(",", "").replace("₽", "").strip()
+        return float(clean) if clean else 0.0
+    except:
+        return 0.0
+
+# --- ВЕКТОРНЫЕ ВЕРСИИ ---
+# Строковые колонки обрабатываются ядрами pyarrow.compute, колонки с небольшим числом
+# различных значений (даты, суммы) форматируются по уникальным значениям с раскладкой обратно.
+# Строки с символами вне печатного ASCII (Unicode-цифры и пробелы, управляющие символы) досчитываются
+# скалярной функцией: ядра pyarrow понимают цифры и пробелы иначе, чем str.isdigit() и str.strip().
+# pyarrow импортируется при первом вызове: скалярным функциям и слою данных он не нужен.
+@lru_cache(maxsize=None)
+def _pc():
+    import pyarrow.compute
+    return pyarrow.compute
+
+def _is_blank(series):
+    """Маска значений, для которых скалярные функции возвращают пустой результат (not x или NaN)"""
+    return (series.isna() | ~series.astype(bool)).to_numpy()
+
+def _to_arrow_text(series):
+    """str() каждого значения в виде строкового массива pyarrow (NaN/None — null)"""
+    import pyarrow as pa
+    if pd.api.types.infer_dtype(series, skipna=True) != "string":
+        series = series.astype(str).mask(series.isna())
+    return pa.array(series.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+
+def _from_arrow(array):
+    return array.to_numpy(zero_copy_only=False)
+
+def _join(*parts):
+    return _pc().binary_join_element_wise(*parts, "")
+
+def _apply_non_ascii(result, series, text, scalar):
+    """Пересчитывает scalar() строки с символами вне печатного ASCII (result меняется на месте)"""
+    pc = _pc()
+    mask = _from_arrow(pc.fill_null(pc.match_substring_regex(text, r"[^\x20-\x7e\t\n\v\f\r]"), False))
+    if mask.any():
+        result[mask] = [scalar(value) for value in series.to_numpy()[mask]]
+    return result
+
+def format_phone_series(phones):
+    """Векторный format_phone"""
+    s = pd.Series(phones, dtype=object)
+    blank = _is_blank(s)
+    pc = _pc()
+    text = _to_arrow_text(s)
+    digits = pc.replace_substring_regex(text, pattern=r"\D", replacement="")
+    digits = pc.if_else(pc.starts_with(digits, "8"), _join("7", pc.utf8_slice_codeunits(digits, 1)), digits)
+    digits = pc.if_else(pc.equal(pc.utf8_length(digits), 10), _join("7", digits), digits)
+    valid = pc.and_(pc.equal(pc.utf8_length(digits), 11), pc.starts_with(digits, "7"))
+    valid = _from_arrow(pc.fill_null(valid, False))
+    formatted = _join(
+        "+7 (", pc.utf8_slice_codeunits(digits, 1, 4), ") ", pc.utf8_slice_codeunits(digits, 4, 7),
+        "-", pc.utf8_slice_codeunits(digits, 7, 9), "-", pc.utf8_slice_codeunits(digits, 9, 11),
+    )
+    result = np.where(valid, _from_arrow(formatted), s.to_numpy())
+    _apply_non_ascii(result, s, text, format_phone)
+    result[blank] = ""
+    return pd.Series(result, index=s.index, dtype=object)
+
+def format_vk_link_series(vk_ids):
+    """Векторный format_vk_link"""
+    s = pd.Series(vk_ids, dtype=object)
+    blank = _is_blank(s)
+    pc = _pc()
+    text = _to_arrow_text(s)
+    vk = pc.ascii_trim_whitespace(text)
+    prefix = pc.if_else(pc.ascii_is_decimal(vk), "https://vk.com/id", "https://vk.com/")
+    result = _from_arrow(_join(prefix, vk))
+    _apply_non_ascii(result, s, text, format_vk_link)
+    result[blank] = ""
+    return pd.Series(result, index=s.index, dtype=object)
+
+def _by_unique(series, func, na_value):
+    """Применяет func к уникальным значениям строковой колонки и раскладывает результат по строкам"""
+    codes, uniques = pd.factorize(series)
+    formatted = np.append(func(pd.Series(uniques, dtype=object)).to_numpy(dtype=object), na_value)
+    return pd.Series(formatted[codes], index=series.index, dtype=object)  # код -1 (NaN) -> na_value
+
+def _format_dates(s):
+    result = pd.Series("", index=s.index, dtype=object)
+    blank = s.isna() | (s == "")
+
+    is_str = s.map(type).eq(str) & ~blank
+    text = s[is_str]
+    has_dot = text.str.contains(".", regex=False)
+    result[has_dot[has_dot].index] = text[has_dot]
+
+    iso = text[~has_dot]
+    parsed = pd.to_datetime(iso, format="%Y-%m-%d", errors="coerce")
+    ok = parsed.notna()
+    good = parsed[ok]
+    result[good.index] = (
+        good.dt.day.astype(str).str.zfill(2) + "."
+        + good.dt.month.astype(str).str.zfill(2) + "."
+        + good.dt.year.astype(str).str.zfill(4)
+    )
+    bad = iso[~ok]
+    if not bad.empty:
+        # за пределами диапазона pandas или не ISO — поведение скалярной функции
+        result[bad.index] = bad.map(format_date_display)
+
+    other = ~is_str & ~blank
+    if other.any():
+        result[other] = s[other].map(format_date_display)
+    return result
+
+def format_date_display_series(dates):
+    """
+    Векторный format_date_display.
+    Строки вида YYYY-MM-DD разбираются одним проходом pandas (для строковых колонок — по уникальным
+    датам), остальные значения обрабатываются как в скалярной функции.
+    """
+    s = pd.Series(dates, dtype=object)
+    if pd.api.types.infer_dtype(s, skipna=True) == "string":
+        return _by_unique(s, _format_dates, "")
+    return _format_dates(s)
+
+def format_currency_series(amounts):
+    """Векторный format_currency"""
+    s = pd.Series(amounts)
+    if not pd.api.types.is_numeric_dtype(s) or pd.api.types.is_bool_dtype(s):
+        return s.map(format_currency).astype(object)
+
+    values = s.to_numpy(dtype=float)
+    result = np.full(len(values), "0", dtype=object)
+    with np.errstate(invalid="ignore"):
+        finite = np.isfinite(values) & (np.abs(values) < _INT64_LIMIT)
+    whole, positions = np.unique(np.trunc(values[finite]).astype(np.int64), return_inverse=True)
+    labels = np.array([f"{v:,}".replace(",", " ") for v in whole.tolist()], dtype=object)
+    result[finite] = labels[positions.ravel()]
+
+    rest = ~finite & ~np.isnan(values)
+    if rest.any():
+        # inf и числа за пределами int64 — как в скалярной функции
+        result[rest] = s[rest].map(format_currency).to_numpy()
+    return pd.Series(result, index=s.index, dtype=object)
@@ -0,0 +1,225 @@
+"""
+Генератор синтетической базы студии для замеров на объёмах «как в проде».
+
+Клиенты с русскими именами, группы, прайс-лист, заказы и услуги с перекосом: часть клиентов
+заказывает намного чаще остальных, оплат с каждым годом больше, осенью и зимой больше, чем летом.
+Данные пишутся в базовые таблицы до миграций 2+, поэтому индексы, агрегаты выручки, FTS
+и итоги заказов строят сами миграции одним проходом, а не триггеры на каждую строку.
+
+    python gen_synthetic_db.py --db studio_bench.db [--clients 50000] [--groups 300]
+                               [--orders 500000] [--items 2000000] [--years 2017-2025] [--seed 0]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import date
+
+import numpy as np
+
+import studio_service
+
+CHUNK_ROWS = 200_000
+
+MALE_NAMES = ["Александр", "Алексей", "Андрей", "Артём", "Борис", "Вадим", "Василий", "Виктор", "Владимир",
+              "Дмитрий", "Евгений", "Егор", "Иван", "Игорь", "Илья", "Кирилл", "Константин", "Максим",
+              "Михаил", "Никита", "Николай", "Олег", "Павел", "Роман", "Сергей", "Степан", "Тимур", "Юрий"]
+FEMALE_NAMES = ["Алина", "Алиса", "Анастасия", "Анна", "Валерия", "Вера", "Виктория", "Дарья", "Екатерина",
+                "Елена", "Ксения", "Лариса", "Мария", "Марина", "Надежда", "Наталья", "Ольга", "Полина",
+                "Светлана", "София", "Татьяна", "Ульяна", "Юлия", "Яна"]
+SURNAMES = ["Иванов", "Смирнов", "Кузнецов", "Попов", "Васильев", "Петров", "Соколов", "Михайлов",
+            "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов", "Егоров",
+            "Павлов", "Козлов", "Степанов", "Николаев", "Орлов", "Андреев", "Макаров", "Никитин",
+            "Захаров", "Зайцев", "Соловьёв", "Борисов", "Яковлев", "Григорьев", "Романов", "Воробьёв"]
+GROUP_KINDS = ["Группа", "Хор", "Ансамбль", "Дуэт", "Проект", "Оркестр", "Трио", "Студия"]
+GROUP_WORDS = ["Рассвет", "Северный ветер", "Белые ночи", "Звездопад", "Полнолуние", "Гроза", "Оттепель",
+               "Перекрёсток", "Маяк", "Горизонт", "Метель", "Янтарь", "Листопад", "Причал", "Зарница",
+               "Радуга", "Кристалл", "Эхо", "Орбита", "Камертон", "Вираж", "Параллели", "Созвездие",
+               "Полёт", "Огни города", "Тайга", "Ливень", "Мираж", "Волна", "Сирень", "Пилигрим",
+               "Ритм", "Шторм", "Мосты", "Гавань", "Родник", "Сияние", "Багульник", "Ветер перемен",
+               "Пульс", "Сфера", "Фрегат", "Прибой", "Туман"]
+SERVICES = [
+    # (название, базовая цена, типичная длительность в часах)
+    ("Запись вокала", 2500, 2), ("Запись инструментов", 2000, 2), ("Запись подкаста", 1500, 1),
+    ("Сведение трека", 6000, 4), ("Мастеринг трека", 3000, 1), ("Аранжировка", 12000, 8),
+    ("Репетиция", 800, 3), ("Аренда студии", 1200, 4), ("Озвучка ролика", 3500, 1),
+    ("Тюнинг вокала", 2000, 1), ("Запись хора", 8000, 4), ("Саунд-дизайн", 9000, 6),
+    ("Минусовка", 1500, 1), ("Запись аудиокниги", 4000, 3), ("Консультация продюсера", 2500, 1),
+]
+# названия из старых таблиц, которых нет в прайс-листе (их находит отчёт несопоставленных услуг)
+LEGACY_SERVICES = ["Студийный день", "запись вокала", "Сведение + мастеринг", "Репетиция (старый прайс)"]
+LEGACY_SHARE = 0.01
+STATUSES = ["В работе", "Ожидает оплаты", "Выполнен", "Оплачен"]
+MONTH_WEIGHTS = np.array([1.0, 1.1, 1.15, 1.1, 0.95, 0.75, 0.6, 0.65, 1.05, 1.25, 1.3, 1.4])
+
+def _zipf_choice(rng, n, size, a=1.1):
+    """Индексы 0..n-1 с убывающей частотой (первые выбираются намного чаще), порядок перемешан"""
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    picks = rng.choice(n, size=size, p=weights / weights.sum())
+    return rng.permutation(n)[picks]
+
+def _random_days(rng, size, first_year, last_year):
+    """Даты не позже сегодняшней, с ростом от года к году и сезонностью по месяцам"""
+    today = date.today()
+    years = np.arange(first_year, last_year + 1)
+    months = np.arange(1, 13)
+    weights = (1.35 ** (years - first_year))[:, None] * MONTH_WEIGHTS[None, :]
+    weights[(years[:, None] * 12 + months[None, :]) > today.year * 12 + today.month] = 0
+    cells = rng.choice(weights.size, size=size, p=(weights / weights.sum()).ravel())
+    month_start = (years[cells // 12] - 1970) * 12 + (months[cells % 12] - 1)
+    start = np.array(month_start, dtype="datetime64[M]").astype("datetime64[D]")
+    length = ((start.astype("datetime64[M]") + 1).astype("datetime64[D]") - start).astype(int)
+    length[start.astype("datetime64[M]") == np.datetime64(today, "M")] = today.day
+    return start + (rng.random(size) * length).astype(int)
+
+def _dates_to_text(days, null_mask=None):
+    text = np.datetime_as_string(days, unit="D").astype(object)
+    if null_mask is not None:
+        text[null_mask] = None
+    return text
+
+def _insert(conn, sql, columns):
+    rows = len(columns[0])
+    for start in range(0, rows, CHUNK_ROWS):
+        chunk = [c[start:start + CHUNK_ROWS] for c in columns]
+        conn.executemany(sql, zip(*(c.tolist() if isinstance(c, np.ndarray) else c for c in chunk)))
+
+def generate_groups(conn, rng, count):
+    names = [f"{kind} «{word}»" for word in GROUP_WORDS for kind in GROUP_KINDS]
+    if count > len(names):
+        names += [f"Коллектив №{i}" for i in range(1, count - len(names) + 1)]
+    picked = rng.permutation(len(names))[:count]
+    conn.executemany("INSERT INTO groups (name) VALUES (?)", [(names[i],) for i in picked])
+
+def generate_services(conn):
+    conn.executemany(
+        "INSERT INTO services_catalog (name, min_price, description) VALUES (?, ?, ?)",
+        [(name, price, f"Около {hours} ч") for name, price, hours in SERVICES],
+    )
+
+def generate_clients(conn, rng, count, groups):
+    female = rng.random(count) < 0.45
+    first = np.where(female,
+                     np.array(FEMALE_NAMES, dtype=object)[rng.integers(0, len(FEMALE_NAMES), count)],
+                     np.array(MALE_NAMES, dtype=object)[rng.integers(0, len(MALE_NAMES), count)])
+    last = np.array(SURNAMES, dtype=object)[rng.integers(0, len(SURNAMES), count)]
+    last = np.where(female, last + "а", last)
+    names = first + " " + last
+
+    phones = np.char.add("79", np.char.zfill(rng.integers(0, 10 ** 9, count).astype(str), 9)).astype(object)
+    reused = rng.random(count) < 0.01  # один номер у двух клиентов — для поиска дублей
+    phones[reused] = phones[rng.integers(0, count, reused.sum())]
+    phones[rng.random(count) < 0.05] = ""
+
+    vk_kind = rng.random(count)
+    vk = np.where(vk_kind < 0.35, (rng.integers(10 ** 5, 10 ** 9, count)).astype(str).astype(object),
+                  np.char.add("user_", rng.integers(0, 10 ** 7, count).astype(str)).astype(object))
+    vk[vk_kind > 0.7] = ""
+    tg = np.char.add("tg_", rng.integers(0, 10 ** 7, count).astype(str)).astype(object)
+    tg[rng.random(count) < 0.6] = ""
+
+    group_ids = (_zipf_choice(rng, groups, count, a=0.8) + 1).astype(object)
+    group_ids[rng.random(count) < 0.3] = None
+    sex = np.where(female, "Ж", "М").astype(object)
+    _insert(conn, "INSERT INTO clients (name, sex, phone, vk_id, tg_id, group_id) VALUES (?,?,?,?,?,?)",
+            [names, sex, phones, vk, tg, group_ids])
+
+def generate_orders(conn, rng, count, clients, first_year, last_year):
+    client_ids = _zipf_choice(rng, clients, count) + 1
+    days = _random_days(rng, count, first_year, last_year)
+    age = (np.datetime64(date.today()) - days).astype(int)
+    # старые заказы почти все оплачены, среди последних двух месяцев много незакрытых
+    status = np.where(age > 60, 3, rng.choice(4, size=count, p=[0.3, 0.2, 0.15, 0.35]))
+    status[(age > 60) & (rng.random(count) < 0.02)] = 2
+    _insert(conn, "INSERT INTO orders (client_id, execution_date, status) VALUES (?,?,?)",
+            [client_ids, _dates_to_text(days), np.array(STATUSES, dtype=object)[status]])
+    return days, status
+
+def generate_items(conn, rng, count, order_days, order_status):
+    orders = len(order_days)
+    # каждый заказ получает хотя бы одну услугу, остальные распределяются с перекосом
+    order_idx = np.concatenate([np.arange(min(count, orders)),
+                                _zipf_choice(rng, orders, max(count - orders, 0), a=0.6)])
+    service = rng.integers(0, len(SERVICES), count)
+    base_price = np.array([s[1] for s in SERVICES], dtype=float)[service]
+    base_hours = np.array([s[2] for s in SERVICES], dtype=float)[service]
+    amount = np.round(base_price * rng.lognormal(0, 0.35, count) / 100) * 100
+    hours = np.round(base_hours * rng.uniform(0.5, 2.0, count) * 2) / 2
+    pay_days = order_days[order_idx] + rng.integers(-3, 21, count)
+    unpaid = ((order_status[order_idx] < 3) & (rng.random(count) < 0.6)) | (pay_days > np.datetime64(date.today()))
+    names = np.array([s[0] for s in SERVICES], dtype=object)[service]
+    legacy = rng.random(count) < LEGACY_SHARE
+    names[legacy] = np.array(LEGACY_SERVICES, dtype=object)[rng.integers(0, len(LEGACY_SERVICES), legacy.sum())]
+    _insert(conn, "INSERT INTO order_items (order_id, service_name, payment_date, amount, hours) VALUES (?,?,?,?,?)",
+            [order_idx + 1, names, _dates_to_text(pay_days, unpaid), amount, hours])
+
+FIRST_PAYMENT_BACKFILL = '''
+    UPDATE clients SET first_order_date = f.first_payment
+    FROM (
+        SELECT o.client_id, MIN(oi.payment_date) AS first_payment
+        FROM order_items oi
+        JOIN orders o ON oi.order_id = o.id
+        WHERE oi.payment_date IS NOT NULL
+        GROUP BY o.client_id
+    ) f
+    WHERE f.client_id = clients.id
+'''
+
+def generate(db_path, clients, groups, orders, items, first_year, last_year, seed):
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")  # одноразовая загрузка: при сбое файл просто создаётся заново
+
+    state = {}
+    steps = [
+        # (название, шаг, обернуть в транзакцию) — миграции управляют транзакциями сами
+        ("схема", lambda: conn.executescript(studio_service.MIGRATIONS[0] + "\nPRAGMA user_version = 1;"), False),
+        ("группы и прайс-лист", lambda: (generate_groups(conn, rng, groups), generate_services(conn)), True),
+        ("клиенты", lambda: generate_clients(conn, rng, clients, groups), True),
+        ("заказы", lambda: state.update(orders=generate_orders(conn, rng, orders, clients, first_year, last_year)), True),
+        ("услуги", lambda: generate_items(conn, rng, items, *state["orders"]), True),
+        ("даты первой оплаты", lambda: conn.execute(FIRST_PAYMENT_BACKFILL), True),
+        ("миграции: индексы, агрегаты, FTS, итоги", lambda: studio_service.apply_migrations(conn), False),
+        ("ANALYZE", lambda: conn.execute("ANALYZE"), False),
+    ]
+    for title, step, in_transaction in steps:
+        started = time.perf_counter()
+        if in_transaction:
+            conn.execute("BEGIN")
+        step()
+        if in_transaction:
+            conn.execute("COMMIT")
+        print(f"  {title:<42} {time.perf_counter() - started:6.1f} с")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default="studio_bench.db")
+    parser.add_argument("--replace", action="store_true", help="перезаписать существующий файл базы")
+    parser.add_argument("--clients", type=int, default=50_000)
+    parser.add_argument("--groups", type=int, default=300)
+    parser.add_argument("--orders", type=int, default=500_000)
+    parser.add_argument("--items", type=int, default=2_000_000)
+    parser.add_argument("--years", default=f"2017-{date.today().year}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    first_year, last_year = (int(y) for y in args.years.split("-"))
+    if os.path.exists(args.db):
+        if not args.replace:
+            sys.exit(f"{args.db} уже существует; добавьте --replace, чтобы перезаписать его")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    print(f"{args.db}: {args.clients} клиентов, {args.groups} групп, {args.orders} заказов, "
+          f"{args.items} услуг за {first_year}–{last_year}")
+    started = time.perf_counter()
+    generate(args.db, args.clients, args.groups, args.orders, args.items, first_year, last_year, args.seed)
+    print(f"Готово за {time.perf_counter() - started:.1f} с")
+
+if __name__ == "__main__":
+    main()
@@ -1,234 +1,180 @@
 import streamlit as st
 import pandas as pd
+import os
 import sqlite3
-from datetime import datetime, date, timedelta
-import re
-
-# --- КОНСТАНТЫ ---
-STATUS_LIST = ["В работе", "Ожидает оплаты", "Выполнен", "Оплачен"]
-
-# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
-@st.cache_data(ttl=30)
-def load_groups():
-    return run_query("SELECT id, name FROM groups ORDER BY id DESC", fetch=True)
-
-def format_phone(phone_str):
+from datetime import date, timedelta
+from functools import wraps
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from formatters import format_date_display, format_currency, parse_currency, normalize_phone, normalize_telegram
+from studio_service import (
+    STATUS_LIST, CLIENT_SEARCH_LIMIT, PAGE_SIZES, PICKERS, LISTINGS, SLOW_QUERY_MS,
+    IMPORT_KINDS, REPORTS, COHORT_METRICS, EXPORT_CHUNK_SIZE, EXPORT_DOWNLOAD_LIMIT, EXPORT_FORMATS, EXPORT_FILTERS,
+    UNLISTED_SERVICE,
+    init_db, start_precompute, set_error_handler, run_write, table_versions,
+    start_rerun, mark_section, finish_rerun, recent_slow_queries, page_percentiles, write_queue_stats,
+    format_phone_series, format_vk_link_series, format_date_display_series, format_currency_series,
+    load_groups, load_client, load_client_stats, load_service,
+    add_client, update_client, delete_client, find_duplicate_clients, describe_duplicates,
+    duplicate_contact_groups, search_clients,
+    group_name_taken, count_group_clients, add_group, rename_group, delete_group,
+    add_service, update_service, delete_service, count_service_items, load_unmatched_services, link_service_name,
+    load_order_items, order_total, create_order, update_order,
+    add_order_item, update_order_item, delete_order_item, delete_order,
+    count_listing, listing_page,
+    import_file, run_report, precomputed_report, load_report_years, cohort_matrix, export_dir, export_report_file,
+    rebuild_rollups, check_derived_fields, repair_derived_fields,
+)
+
+# Данные, запросы и отчёты — в studio_service; здесь только страницы Streamlit
+RERUN = start_rerun()
+
+CLIENT_SORTS = LISTINGS["clients"]["sorts"]
+# фильтр списка клиентов по давности оплат: фильтр LISTINGS["clients"] -> дней назад
+CLIENT_ACTIVITY = {
+    "Все": {},
+    "Были за 30 дней": {"paid_since": 30},
+    "Были за 90 дней": {"paid_since": 90},
+    "Были за год": {"paid_since": 365},
+    "Нет оплат 90 дней": {"idle_since": 90},
+    "Нет оплат год": {"idle_since": 365},
+}
+
+# --- ПОСТРАНИЧНЫЕ СПИСКИ ---
+def paginated_listing(name, key, sort=None, **filters):
     """
-    Форматирование номера: 7XXXXXXXXXX → +7 (XXX) XXX-XX-XX
+    Элементы управления страницами и данные текущей страницы списка LISTINGS[name] в сортировке sort.
+    Границы уже просмотренных страниц хранятся в session_state.
     """
-    if not phone_str or pd.isna(phone_str):
-        return ""
-    digits = ''.join(filter(str.isdigit, str(phone_str)))
-    if digits.startswith("8"):
-        digits = "7" + digits[1:]
-    if len(digits) == 10:
-        digits = "7" + digits  # если не хватает кода
-    if len(digits) != 11 or not digits.startswith("7"):
-        return phone_str  # вернём как есть
-
-    return f"+7 ({digits[1:4]}) {digits[4:7]}-{digits[7:9]}-{digits[9:11]}"
-def format_vk_link(vk_id) -> str:
-    """Формирует правильную ссылку на VK"""
-    if not vk_id or pd.isna(vk_id):
-        return ""
-    vk_id = str(vk_id).strip()
-    # Если только цифры — значит, это id
-    if vk_id.isdigit():
-        return f"https://vk.com/id{vk_id}"
-    return f"https://vk.com/{vk_id}"
-
-def format_vk(vk_str):
-    """Форматирование VK ID для отображения"""
-    if not vk_str or pd.isna(vk_str):
-        return ""
-    vk = str(vk_str).strip()
-    vk = vk.replace("https://", "").replace("http://", "")
-    if vk.startswith("vk.com/"):
-        return vk
-    if vk.startswith("id") and vk[2:].isdigit():
-        return f"vk.com/{vk}"
-    if vk.isdigit():
-        return f"vk.com/id{vk}"
-    return f"vk.com/{vk}"
-
-def format_telegram(tg_str):
-    """Форматирование Telegram для отображения"""
-    if not tg_str or pd.isna(tg_str):
-        return ""
-    tg = str(tg_str).strip()
-    tg = tg.replace("https://", "").replace("http://", "").replace("@", "")
-    if tg.startswith("t.me/"):
-        return tg
-    return f"t.me/{tg}"
-
-def format_date_display(date_str):
-    """Форматирование даты в dd.mm.yyyy"""
-    if pd.isna(date_str) or date_str is None or date_str == '':
-        return ""
-    try:
-        if isinstance(date_str, str):
-            if '.' in date_str:
-                return date_str
-            date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        else:
-            date_obj = pd.to_datetime(date_str)
-        return date_obj.strftime("%d.%m.%Y")
-    except:
-        return str(date_str)
-
-def parse_date_to_db(date_str):
-    """Преобразует строку даты в формат БД"""
-    if pd.isna(date_str) or not date_str or date_str == '':
-        return None
-    try:
-        if isinstance(date_str, date):
-            return date_str.strftime("%Y-%m-%d")
-        if isinstance(date_str, str):
-            if '.' in date_str:
-                return datetime.strptime(date_str, "%d.%m.%Y").strftime("%Y-%m-%d")
-            return date_str
-        return pd.to_datetime(date_str).strftime("%Y-%m-%d")
-    except:
-        return None
-
-def format_currency(amount):
-    """Форматирование валюты"""
-    if pd.isna(amount) or amount is None:
-        return "0"
-    try:
-        return f"{int(float(amount)):,}".replace(",", " ")
-    except:
-        return str(amount)
-
-def parse_currency(amount_str):
-    """Преобразует строку в число"""
-    if not amount_str or pd.isna(amount_str):
-        return 0.0
-    try:
-        clean = str(amount_str).replace(" ", "").replace(",", "").replace("₽", "").strip()
-        return float(clean) if clean else 0.0
-    except:
-        return 0.0
-
-def update_client_first_order_date(client_id):
-    """Обновляет дату первого заказа клиента по первой оплате"""
-    result = run_query('''
-        SELECT MIN(oi.payment_date) as first_payment
-        FROM order_items oi
-        JOIN orders o ON oi.order_id = o.id
-        WHERE o.client_id = ? AND oi.payment_date IS NOT NULL
-    ''', (client_id,), fetch=True)
-
-    if not result.empty and result['first_payment'].iloc[0]:
-        run_query(
-            "UPDATE clients SET first_order_date = ? WHERE id = ?",
-            (result['first_payment'].iloc[0], client_id)
+    total = count_listing(name, **filters)
+
+    col_size, col_page, col_info = st.columns([1, 1, 2])
+    with col_size:
+        page_size = st.selectbox("Строк на странице", PAGE_SIZES, key=f"{key}_page_size")
+    pages = max(1, -(-total // page_size))
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages  # список мог сократиться после удаления
+    with col_page:
+        page = st.number_input("Страница", min_value=1, max_value=pages, value=1, step=1, key=f"{key}_page")
+    with col_info:
+        st.caption(f"Всего: {total} · страница {page} из {pages}")
+
+    # границы страниц сбрасываются при смене размера страницы, сортировки или фильтров
+    signature = (page_size, sort, tuple(sorted(filters.items())))
+    state = st.session_state.get(f"{key}_cursors")
+    if not state or state["signature"] != signature:
+        state = {"signature": signature, "cursors": {1: None}}
+        st.session_state[f"{key}_cursors"] = state
+    return listing_page(name, page, page_size, state["cursors"], sort=sort, **filters)
+
+# --- ПОЛЯ ВЫБОРА ---
+PICKER_CACHE_SIZE = 50   # сколько последних поисков полей выбора помнит сессия
+
+def picker_options(kind, term="", **scope):
+    """
+    Варианты PICKERS[kind] {id: подпись} по строке поиска. Последние поиски кэшируются в session_state
+    и действуют, пока не изменились таблицы, из которых они получены.
+    """
+    cache = st.session_state.setdefault("picker_cache", {})
+    key = (kind, term.strip().casefold(), tuple(sorted(scope.items())))
+    versions = table_versions(PICKERS[kind]["tables"])
+    hit = cache.pop(key, None)
+    if hit is None or hit[0] != versions:
+        hit = (versions, PICKERS[kind]["find"](term=term, **scope))
+    cache[key] = hit  # в конец: вытесняются самые давние поиски
+    while len(cache) > PICKER_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    return hit[1]
+
+def id_picker(label, kind, key, placeholder="Выберите...", hint="", index=None, **scope):
+    """
+    Поле выбора по id: строка поиска и найденные в базе варианты PICKERS[kind].
+    Выбранный вариант остаётся в списке, пока меняется строка поиска. Возвращает id или None.
+    """
+    col_term, col_pick = st.columns([1, 2])
+    with col_term:
+        term = st.text_input("Поиск", key=f"{key}_term", placeholder=hint)
+    options = picker_options(kind, term, **scope)
+
+    # с новым списком вариантов Streamlit создаёт виджет заново, поэтому выбор переносим сами
+    shown_scope, shown, selected = st.session_state.get(f"{key}_shown", (None, {}, None))
+    selected = st.session_state.get(key, selected)
+    if shown_scope != scope:
+        selected = None
+    elif selected is not None and selected not in options and selected in shown:
+        options = {selected: shown[selected], **options}
+    if selected in options:
+        index = list(options).index(selected)
+    with col_pick:
+        picked = st.selectbox(
+            label, list(options), format_func=options.get,
+            index=index if options else None, placeholder=placeholder, key=key,
         )
-        
-# Вспомогательная функция пересчёта суммы заказа
-def _update_order_total(order_id):
-    total_df = run_query("SELECT COALESCE(SUM(amount),0) as t FROM order_items WHERE order_id=?", (order_id,), fetch=True)
-    total = total_df.iloc[0]['t']
-    run_query("UPDATE orders SET total_amount=? WHERE id=?", (total, order_id))
-
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('studio.db')
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-
-    c.execute('''CREATE TABLE IF NOT EXISTS groups (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS clients (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    sex TEXT,
-                    phone TEXT,
-                    vk_id TEXT,
-                    tg_id TEXT,
-                    group_id INTEGER,
-                    first_order_date DATE,
-                    FOREIGN KEY (group_id) REFERENCES groups(id))''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS services_catalog (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    min_price REAL,
-                    description TEXT)''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    client_id INTEGER,
-                    execution_date DATE,
-                    status TEXT,
-                    total_amount REAL DEFAULT 0,
-                    FOREIGN KEY (client_id) REFERENCES clients(id))''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS order_items (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    order_id INTEGER,
-                    service_name TEXT,
-                    payment_date DATE,
-                    amount REAL,
-                    hours REAL,
-                    FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE)''')
-
-    conn.commit()
-    conn.close()
-
-def run_query(query, params=(), fetch=False):
-    """Выполняет SQL запрос"""
-    conn = sqlite3.connect('studio.db')
-    c = conn.cursor()
-    try:
-        c.execute(query, params)
-        if fetch:
-            data = c.fetchall()
-            cols = [description[0] for description in c.description]
-            conn.close()
-            return pd.DataFrame(data, columns=cols)
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        conn.close()
-        st.error(f"Ошибка БД: {e}")
-        return pd.DataFrame() if fetch else False
+    st.session_state[f"{key}_shown"] = (scope, options, picked)
+    return picked
+
+# --- ФРАГМЕНТЫ ---
+# Виджет внутри st.fragment перезапускает только свой фрагмент, а не весь скрипт.
+# Такой перезапуск не доходит до конца скрипта, поэтому фрагмент сам пишет свои метрики
+# как страницу «страница / раздел».
+def fragment_only_rerun():
+    """Перезапускается только фрагмент, а не весь скрипт"""
+    ctx = get_script_run_ctx()
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+def page_fragment(page, section):
+    """Декоратор блока страницы: st.fragment с разделом метрик section"""
+    def decorate(func):
+        @st.fragment
+        @wraps(func)
+        def block(*args, **kwargs):
+            alone = fragment_only_rerun()
+            if alone:
+                start_rerun(f"{page} / {section}")
+            mark_section(section)
+            func(*args, **kwargs)
+            if alone:
+                finish_rerun()
+        return block
+    return decorate
+
+# --- ПРЕДРАСЧИТАННЫЕ ОТЧЁТЫ ---
+def report_frame(name, **params):
+    """Отчёт из кэша предрасчёта; устаревший результат показывается с пометкой, пока идёт пересчёт"""
+    df = precomputed_report(name, **params)
+    if df.attrs.get("stale"):
+        st.caption(f"⏳ Данные на {df.attrs['computed_at']} — пересчёт идёт в фоне")
+    return df
+
 
 # --- ИНТЕРФЕЙС ---
 st.set_page_config(page_title="Studio Admin", layout="wide")
+set_error_handler(st.error)
 init_db()
+start_precompute()
 
 st.title("🎛️ CRM Студии Звукозаписи")
 
-menu = ["Клиенты и Группы", "Прайс-лист Услуг", "Заказы и услуги", "ОТЧЁТЫ"]
+menu = ["Клиенты и Группы", "Прайс-лист Услуг", "Заказы и услуги", "ОТЧЁТЫ", "Импорт"]
 choice = st.sidebar.selectbox("Навигация", menu)
+RERUN["page"] = choice
+show_debug = st.sidebar.toggle("🛠 Отладка: запросы и время", key="debug_panel")
+debug_slot = st.sidebar.container()  # заполняется в конце перезапуска, когда итоги известны
 
 # --- 1. КЛИЕНТЫ И ГРУППЫ ---
 if choice == "Клиенты и Группы":
     st.subheader("Клиенты")
 
     # Получаем группы
-    groups_df = run_query("SELECT id, name FROM groups", fetch=True)
+    groups_df = load_groups()
     groups_list = groups_df['name'].tolist() if not groups_df.empty else []
     group_map = dict(zip(groups_df['name'], groups_df['id'])) if not groups_df.empty else {}
 
 # --- УПРАВЛЕНИЕ КЛИЕНТАМИ ---
+    mark_section("Управление клиентами")
     with st.expander("➕ Управление клиентами"):
         action = st.radio("Выберите действие", ["Добавить", "Редактировать", "Удалить"], horizontal=True, key="client_action_radio")
 
-        # Загрузка клиентов
-        clients_df = run_query('''
-            SELECT c.id, c.name, c.sex, c.phone, c.vk_id, c.tg_id,
-                   COALESCE(g.name, 'Без группы') as group_name,
-                   c.first_order_date
-            FROM clients c
-            LEFT JOIN groups g ON c.group_id = g.id
-            ORDER BY c.id DESC
-        ''', fetch=True)
-
         if action == "Добавить":
             with st.form("add_client"):
                 # 👇 Часть 1 — Имя, Пол, Группа — в одной строке
@@ -256,6 +202,8 @@ if choice == "Клиенты и Группы":
                     c_vk_raw = st.text_input("VK ID", placeholder="id123456 или username")
                 with col6:
                     c_tg_raw = st.text_input("Telegram", placeholder="username (без @)")
+
+                c_force = st.checkbox("Сохранить, даже если контакт уже есть у другого клиента")
                 
                 # 👇 Кнопка
                 if st.form_submit_button("Сохранить клиента"):
@@ -263,26 +211,21 @@ if choice == "Клиенты и Группы":
                         if not c_phone_raw:
                             st.error("Введите номер телефона")
                         else:
-                            import re
-                            digits_only = re.sub(r'\D', '', c_phone_raw)
-        
-                            if digits_only.startswith("8") and len(digits_only) == 11:
-                                digits_only = "7" + digits_only[1:]
-                            if len(digits_only) == 10:
-                                digits_only = "7" + digits_only
-                            if len(digits_only) != 11 or not digits_only.startswith("7"):
+                            phone = normalize_phone(c_phone_raw)
+                            if not phone:
                                 st.error("❌ Введите корректный номер: 11 цифр, начиная с 7 (например: 79991234567)")
                                 st.stop()
-                            phone = digits_only
         
                             vk = c_vk_raw.strip() if c_vk_raw else ""
-                            tg = c_tg_raw.strip().replace("@", "").replace("t.me/", "") if c_tg_raw else ""
+                            tg = normalize_telegram(c_tg_raw)
                             g_id = group_map.get(c_group) if c_group != "Без группы" else None
+
+                            dups = find_duplicate_clients(phone, vk, tg)
+                            if not dups.empty and not c_force:
+                                st.warning(describe_duplicates(dups))
+                                st.stop()
         
-                            run_query('''INSERT INTO clients 
-                                (name, sex, phone, vk_id, tg_id, group_id) 
-                                VALUES (?,?,?,?,?,?)''', 
-                                (c_name, c_sex, phone, vk, tg, g_id))
+                            add_client(c_name, c_sex, phone, vk, tg, g_id)
         
                             st.success("✅ Клиент добавлен!")
                             st.rerun()
@@ -291,69 +234,93 @@ if choice == "Клиенты и Группы":
 
 
         elif action in ["Редактировать", "Удалить"]:
-            if clients_df.empty:
-                st.info("Нет клиентов для действия.")
+            selected_id = id_picker(
+                "Выберите клиента для редактирования", "clients", key="client_select",
+                hint="Имя, телефон, VK или Telegram",
+            )
+            selected_row = load_client(selected_id) if selected_id is not None else None
+            if selected_row is None:
+                st.info("Найдите и выберите клиента")
             else:
-                client_options = [f"#{row['id']} {row['name']}" for _, row in clients_df.iterrows()]
-                selected_client = st.selectbox("Выберите клиента для редактирования", client_options, key="client_select")
+                dups = find_duplicate_clients(
+                    selected_row['phone'], selected_row['vk_id'], selected_row['tg_id'], exclude_id=selected_id
+                )
+                if not dups.empty:
+                    st.warning(describe_duplicates(dups))
+
+                # Создаём таблицу с одной строкой
+                edit_df = pd.DataFrame([selected_row])
+                edit_df['first_order_date'] = format_date_display_series(edit_df['first_order_date'])
         
-                if selected_client:
-                    # Получаем ID выбранного клиента
-                    selected_id = int(selected_client.split()[0][1:])
-                    selected_row = clients_df[clients_df['id'] == selected_id].iloc[0]
-            
-                    # Создаём таблицу с одной строкой
-                    edit_df = pd.DataFrame([selected_row])
-                    edit_df['first_order_date'] = edit_df['first_order_date'].apply(format_date_display)
-            
-                    edited_client = st.data_editor(
-                        edit_df[['id', 'name', 'sex', 'phone', 'vk_id', 'tg_id', 'group_name', 'first_order_date']],
-                        column_config={
-                            "id": st.column_config.NumberColumn("ID", disabled=True),
-                            "name": st.column_config.TextColumn("Имя"),
-                            "sex": st.column_config.SelectboxColumn("Пол", options=["М", "Ж"]),
-                            "phone": st.column_config.TextColumn("Телефон"),
-                            "vk_id": st.column_config.TextColumn("VK ID"),
-                            "tg_id": st.column_config.TextColumn("Telegram"),
-                            "group_name": st.column_config.SelectboxColumn("Группа", options=["Без группы"] + groups_list),
-                            "first_order_date": st.column_config.TextColumn("Первая оплата"),
-                        },
-                        hide_index=True,
-                        use_container_width=True,
-                        key="single_client_editor"
-                    )
+                edited_client = st.data_editor(
+                    edit_df[['id', 'name', 'sex', 'phone', 'vk_id', 'tg_id', 'group_name', 'first_order_date']],
+                    column_config={
+                        "id": st.column_config.NumberColumn("ID", disabled=True),
+                        "name": st.column_config.TextColumn("Имя"),
+                        "sex": st.column_config.SelectboxColumn("Пол", options=["М", "Ж"]),
+                        "phone": st.column_config.TextColumn("Телефон"),
+                        "vk_id": st.column_config.TextColumn("VK ID"),
+                        "tg_id": st.column_config.TextColumn("Telegram"),
+                        "group_name": st.column_config.SelectboxColumn("Группа", options=["Без группы"] + groups_list),
+                        "first_order_date": st.column_config.TextColumn("Первая оплата", disabled=True),
+                    },
+                    hide_index=True,
+                    use_container_width=True,
+                    key="single_client_editor"
+                )
 
                 if action == "Редактировать":
+                    e_force = st.checkbox("Сохранить, даже если контакт уже есть у другого клиента", key="client_edit_force")
                     if not edited_client.equals(edit_df):
                        new_row = edited_client.iloc[0]
                        group_name = new_row['group_name']
                        g_id = group_map.get(group_name) if group_name != "Без группы" else None
-                       first_order = parse_date_to_db(new_row['first_order_date'])
-                
-                       run_query('''
-                           UPDATE clients 
-                           SET name=?, sex=?, phone=?, vk_id=?, tg_id=?, group_id=?, first_order_date=?
-                           WHERE id=?
-                       ''', (
-                           new_row['name'],
-                           new_row['sex'],
-                           new_row['phone'],
-                           new_row['vk_id'],
-                           new_row['tg_id'],
-                           g_id,
-                           first_order,
-                           selected_id
-                       ))
-                       st.success("✅ Изменения сохранены!")
-                       st.rerun()
+
+                       # те же правила, что в форме добавления; старый номер без изменений не проверяем
+                       phone = normalize_phone(new_row['phone'])
+                       if phone is None and new_row['phone'] == selected_row['phone']:
+                           phone = selected_row['phone']
+                       vk = str(new_row['vk_id']).strip() if pd.notna(new_row['vk_id']) else ""
+                       tg = normalize_telegram(new_row['tg_id'])
+                       contacts_changed = (new_row['phone'], new_row['vk_id'], new_row['tg_id']) != (
+                           selected_row['phone'], selected_row['vk_id'], selected_row['tg_id'])
+                       dups = find_duplicate_clients(phone, vk, tg, exclude_id=selected_id) if contacts_changed else None
+
+                       if phone is None:
+                           st.error("❌ Введите корректный номер: 11 цифр, начиная с 7 (например: 79991234567)")
+                       elif dups is not None and not dups.empty and not e_force:
+                           st.warning(describe_duplicates(dups))
+                       else:
+                           update_client(
+                               selected_id,
+                               new_row['name'],
+                               new_row['sex'],
+                               phone,
+                               vk,
+                               tg,
+                               g_id,
+                           )
+                           st.success("✅ Изменения сохранены!")
+                           st.rerun()
 
                 elif action == "Удалить":
                     if st.button("🗑️ Подтвердить удаление клиента"):
-                        run_query("DELETE FROM clients WHERE id=?", (selected_id,))
+                        delete_client(selected_id)
                         st.success("✅ Клиент удалён")
                         st.rerun()
 
+    # --- Возможные дубликаты ---
+    mark_section("Дубликаты")
+    with st.expander("🔁 Возможные дубликаты"):
+        dup_groups = duplicate_contact_groups()
+        if dup_groups.empty:
+            st.info("Клиентов с одинаковыми контактами нет")
+        else:
+            dup_groups.columns = ['Контакт', 'Значение', 'Клиентов', 'ID клиентов']
+            st.dataframe(dup_groups, use_container_width=True, hide_index=True)
+
     # --- Управление группами ---
+    mark_section("Группы")
     with st.expander("🏷️ Управление группами", expanded=False):
         # Выбор действия
         col_action_l, col_action_r = st.columns([2, 3])
@@ -362,7 +329,7 @@ if choice == "Клиенты и Группы":
         with col_action_r:
             st.markdown("#### 📋 Список всех групп")
     
-        groups_df = load_groups()  # (можно повторить — кеш используется)
+        groups_df = load_groups()
     
         # Две колонки общей работы
         col_l, col_r = st.columns([2, 3])
@@ -375,13 +342,11 @@ if choice == "Клиенты и Группы":
     
                     if st.form_submit_button("Сохранить группу"):
                         if new_group_name.strip():
-                            check = run_query("SELECT id FROM groups WHERE name=?", (new_group_name.strip(),), fetch=True)
-                            if not check.empty:
+                            if group_name_taken(new_group_name.strip()):
                                 st.error("❌ Группа с таким названием уже существует")
                             else:
-                                run_query("INSERT INTO groups (name) VALUES (?)", (new_group_name.strip(),))
+                                add_group(new_group_name.strip())
                                 st.toast("✅ Группа добавлена!", icon="✅")
-                                st.cache_data.clear()  # обнуляем кэш
                                 st.session_state["group_rerun"] = True
                         else:
                             st.warning("Введите название группы")
@@ -423,27 +388,21 @@ if choice == "Клиенты и Группы":
                                 if not new_name:
                                     st.error("❌ Название не может быть пустым")
                                 else:
-                                    exists = run_query("SELECT id FROM groups WHERE name=? AND id!=?", (new_name, selected_id), fetch=True)
-                                    if not exists.empty:
+                                    if group_name_taken(new_name, exclude_id=selected_id):
                                         st.error("❌ Такое название уже есть")
                                     else:
-                                        run_query("UPDATE groups SET name=? WHERE id=?", (new_name, selected_id))
+                                        rename_group(selected_id, new_name)
                                         st.toast("✅ Группа обновлена!", icon="✅")
-                                        st.cache_data.clear()
                                         st.session_state["group_rerun"] = True
     
                         elif action == "Удалить":
                             st.warning(f"Вы собираетесь удалить группу: **{selected_row['name']}**")
-                            clients_check = run_query("SELECT COUNT(*) as count FROM clients WHERE group_id=?", (selected_id,), fetch=True)
-                            has_clients = clients_check.iloc[0]["count"] > 0 if not clients_check.empty else False
-    
-                            if has_clients:
+                            if count_group_clients(selected_id) > 0:
                                 st.error("❌ В группе есть клиенты. Удаление невозможно.")
                             else:
                                 if st.button("🗑️ Подтвердить удаление группы"):
-                                    run_query("DELETE FROM groups WHERE id=?", (selected_id,))
+                                    delete_group(selected_id)
                                     st.toast("✅ Группа удалена!", icon="🧹")
-                                    st.cache_data.clear()
                                     st.session_state["group_rerun"] = True
     
     # 👈 После всех блоков — если сработал флаг, перезагрузить
@@ -453,6 +412,7 @@ if choice == "Клиенты и Группы":
 
 
     # Поиск и фильтрация
+    mark_section("Список клиентов")
 
     search_col1, search_col2 = st.columns([2, 1])
     with search_col1:
@@ -460,43 +420,43 @@ if choice == "Клиенты и Группы":
     with search_col2:
         filter_group = st.selectbox("Фильтр по группе", ["Все"] + groups_list)
 
-    # Получаем всех клиентов
-    clients_query = '''
-    SELECT 
-        c.id, 
-        c.name, 
-        c.sex, 
-        c.phone, 
-        c.vk_id, 
-        c.tg_id, 
-        COALESCE(g.name, 'Без группы') as group_name,
-        c.first_order_date
-    FROM clients c 
-    LEFT JOIN groups g ON c.group_id = g.id
-    ORDER BY c.id DESC
-    '''
-    clients_df_data = run_query(clients_query, fetch=True)
-
-    # --- Фильтрация на стороне Python (регистронезависимая, поддержка кириллицы) ---
-    if not clients_df_data.empty:
-
-        if search_query.strip():
-            search_query_lower = search_query.strip().lower()
-
-            # Приводим к строке и применяем str.contains(..., case=False)
-            clients_df_data = clients_df_data[
-                clients_df_data['name'].astype(str).str.lower().str.contains(search_query_lower, na=False) |
-                clients_df_data['phone'].astype(str).str.contains(search_query, na=False) |
-                clients_df_data['vk_id'].astype(str).str.lower().str.contains(search_query_lower, na=False) |
-                clients_df_data['tg_id'].astype(str).str.lower().str.contains(search_query_lower, na=False)
-            ]
-
-        if filter_group != "Все":
-            clients_df_data = clients_df_data[
-                clients_df_data["group_name"] == filter_group
-            ]
-
-
+    # сортировка и фильтры по итогам клиента (client_stats); поиск сортирует по релевантности
+    searching = bool(search_query.strip())
+    sort_col, revenue_col, activity_col, open_col = st.columns([1, 1, 1, 1])
+    with sort_col:
+        client_sort = st.selectbox(
+            "Сортировка", [None] + list(CLIENT_SORTS),
+            format_func=lambda k: CLIENT_SORTS[k]["title"] if k else "Новые",
+            key="clients_sort", disabled=searching,
+        )
+    with revenue_col:
+        min_revenue = parse_currency(st.text_input("Выручка от ₽", placeholder="100 000", key="clients_min_revenue",
+                                                   disabled=searching))
+    with activity_col:
+        activity = st.selectbox("Оплаты", list(CLIENT_ACTIVITY), key="clients_activity", disabled=searching)
+    with open_col:
+        only_open = st.checkbox("Есть заказы «Ожидает оплаты»", key="clients_open", disabled=searching)
+
+    if search_query.strip():
+        # Поиск по FTS-индексу, фильтр по группе — там же, в SQL
+        clients_df_data = search_clients(
+            search_query,
+            group_id=group_map.get(filter_group) if filter_group != "Все" else None,
+        )
+        if len(clients_df_data) >= CLIENT_SEARCH_LIMIT:
+            st.caption(f"Показаны первые {CLIENT_SEARCH_LIMIT} совпадений — уточните запрос")
+    else:
+        # Постраничный список клиентов (новые сверху)
+        clients_df_data = paginated_listing(
+            "clients",
+            key="clients_list",
+            sort=client_sort,
+            group=group_map.get(filter_group) if filter_group != "Все" else None,
+            min_revenue=min_revenue or None,
+            open_orders=1 if only_open else None,
+            **{name: (date.today() - timedelta(days=days)).isoformat()
+               for name, days in CLIENT_ACTIVITY[activity].items()},
+        )
 
     if not clients_df_data.empty:
         
@@ -504,22 +464,25 @@ if choice == "Клиенты и Группы":
         display_df = clients_df_data.copy()
 
         # Телефон
-        display_df['Телефон'] = display_df['phone'].apply(format_phone)  # +7 999 999-99-99
+        display_df['Телефон'] = format_phone_series(display_df['phone'])  # +7 999 999-99-99
 
         # VK
         display_df['VK (текст)'] = display_df['vk_id'].fillna("")
-        display_df['VK (ссылка)'] = display_df['vk_id'].apply(format_vk_link)
+        display_df['VK (ссылка)'] = format_vk_link_series(display_df['vk_id'])
 
         # Telegram
         display_df['tg_id'] = display_df['tg_id'].fillna("")
         display_df['Telegram (текст)'] = display_df['tg_id']
-        display_df['Telegram (ссылка)'] = display_df['tg_id'].apply(lambda x: f"https://t.me/{x}" if x else "")
+        display_df['Telegram (ссылка)'] = ("https://t.me/" + display_df['tg_id']).where(display_df['tg_id'] != "", "")
 
         # Другое
         display_df['Имя'] = display_df['name']
         display_df['Пол'] = display_df['sex']
         display_df['Группа'] = display_df['group_name']
-        display_df['Первая оплата'] = display_df['first_order_date'].apply(format_date_display)
+        display_df['Первая оплата'] = format_date_display_series(display_df['first_order_date'])
+        display_df['Последняя оплата'] = format_date_display_series(display_df['last_payment'])
+        display_df['Выручка'] = format_currency_series(display_df['revenue']) + " ₽"
+        display_df['Средний чек'] = format_currency_series(display_df['avg_check']) + " ₽"
 
         # Удалим NaN из ссылок
         display_df['VK (ссылка)'] = display_df['VK (ссылка)'].fillna("")
@@ -529,22 +492,28 @@ if choice == "Клиенты и Группы":
             display_df[[
                 'id', 'Имя', 'Пол',
                 'Телефон', 'VK (ссылка)', 'Telegram (ссылка)',
-                'Группа', 'Первая оплата'
+                'Группа', 'Первая оплата',
+                'Выручка', 'payments', 'hours', 'Средний чек', 'Последняя оплата', 'open_orders',
             ]].rename(columns={
                 'id': 'ID',
+                'payments': 'Оплат',
+                'hours': 'Часы',
+                'open_orders': 'Ждут оплаты',
                 'VK (ссылка)': 'VK',
                 'Telegram (ссылка)': 'Telegram',
             }),
             column_config={
                 "VK": st.column_config.LinkColumn("VK"),
                 "Telegram": st.column_config.LinkColumn("Telegram"),
+                "Часы": st.column_config.NumberColumn("Часы", format="%.1f"),
             },
             column_order=[
                 "ID", "Имя", "Пол",
                 "Телефон", 
                 "VK", 
                 "Telegram", 
-                "Группа", "Первая оплата"
+                "Группа", "Первая оплата",
+                "Выручка", "Оплат", "Часы", "Средний чек", "Последняя оплата", "Ждут оплаты",
             ],
             hide_index=True,
             use_container_width=True,
@@ -554,12 +523,37 @@ if choice == "Клиенты и Группы":
     else:
         st.info("Клиенты не найдены")
 
+    # --- Карточка клиента ---
+    mark_section("Карточка клиента")
+    with st.expander("📇 Карточка клиента"):
+        card_id = id_picker("Клиент", "clients", key="client_card", hint="Имя, телефон, VK или Telegram")
+        stats = load_client_stats(card_id) if card_id is not None else None
+        if stats is None:
+            st.info("Найдите и выберите клиента")
+        else:
+            m1, m2, m3, m4, m5, m6 = st.columns(6)
+            m1.metric("Выручка", f"{format_currency(stats['revenue'])} ₽")
+            m2.metric("Оплат", int(stats["payments"]))
+            m3.metric("Часы", f"{stats['hours']:.1f}")
+            m4.metric("Средний чек", f"{format_currency(stats['avg_check'])} ₽")
+            m5.metric("Последняя оплата", format_date_display(stats["last_payment"]) if stats["last_payment"] else "—")
+            m6.metric("Ждут оплаты", int(stats["open_orders"]))
+
+            st.markdown("**История заказов**")
+            timeline = paginated_listing("client_orders", key="client_card_orders", client=card_id)
+            if not timeline.empty:
+                timeline['execution_date'] = format_date_display_series(timeline['execution_date'])
+                timeline['last_payment'] = format_date_display_series(timeline['last_payment'])
+                timeline['total_amount'] = format_currency_series(timeline['total_amount']) + " ₽"
+                timeline.columns = ['№', 'Дата исполнения', 'Статус', 'Сумма', 'Услуг', 'Услуги', 'Оплачен']
+                st.dataframe(timeline, use_container_width=True, hide_index=True)
+            else:
+                st.info("У клиента пока нет заказов")
+
 # --- 2. ПРАЙС-ЛИСТ ---
 elif choice == "Прайс-лист Услуг":
     st.subheader("📦 Прайс-лист Услуг")
 
-    services_df = run_query("SELECT * FROM services_catalog ORDER BY id DESC", fetch=True)
-
     with st.expander("➕ Управление услугами"):
         action = st.radio("Выберите действие", ["Добавить", "Редактировать", "Удалить"], horizontal=True)
 
@@ -572,25 +566,18 @@ elif choice == "Прайс-лист Услуг":
                 if st.form_submit_button("Добавить услугу"):
                     if s_name.strip():
                         price = parse_currency(s_price)
-                        run_query(
-                            "INSERT INTO services_catalog (name, min_price, description) VALUES (?,?,?)",
-                            (s_name.strip(), price, s_desc.strip())
-                        )
+                        add_service(s_name.strip(), price, s_desc.strip())
                         st.success("✅ Услуга добавлена")
                         st.rerun()
                     else:
                         st.error("Название услуги обязательно")
 
         elif action in ["Редактировать", "Удалить"]:
-            if services_df.empty:
-                st.warning("Нет доступных услуг для выбранного действия.")
+            selected_id = id_picker("Выберите услугу", "services", key="edit_service_select", hint="Название услуги")
+            selected_row = load_service(selected_id) if selected_id is not None else None
+            if selected_row is None:
+                st.info("Найдите и выберите услугу")
             else:
-                service_options = [f"#{row['id']} {row['name']}" for _, row in services_df.iterrows()]
-                selected_service = st.selectbox("Выберите услугу", service_options, key="edit_service_select")
-
-                selected_id = int(selected_service.split()[0][1:])
-                selected_row = services_df[services_df['id'] == selected_id].iloc[0]
-
                 edit_df = pd.DataFrame([selected_row])
 
                 st.markdown(f"**{action} услугу со следующими параметрами:**")
@@ -611,30 +598,41 @@ elif choice == "Прайс-лист Услуг":
                 if action == "Редактировать":
                     if not edited_row.equals(edit_df):
                         new_row = edited_row.iloc[0]
-                        run_query('''
-                            UPDATE services_catalog 
-                            SET name=?, min_price=?, description=?
-                            WHERE id=?
-                        ''', (
-                            new_row['name'],
-                            new_row['min_price'],
-                            new_row['description'],
-                            selected_id
-                        ))
+                        update_service(selected_id, new_row['name'], new_row['min_price'], new_row['description'])
                         st.success("✅ Изменения сохранены!")
                         st.rerun()
 
                 elif action == "Удалить":
-                    if st.button("🗑️ Подтвердить удаление"):
-                        run_query("DELETE FROM services_catalog WHERE id=?", (selected_id,))
+                    if count_service_items(selected_id) > 0:
+                        st.error("❌ Услуга есть в заказах. Удаление невозможно.")
+                    elif st.button("🗑️ Подтвердить удаление"):
+                        delete_service(selected_id)
                         st.success("✅ Услуга удалена")
                         st.rerun()
 
+    # Названия услуг в заказах (старые данные, импорт), которых нет в прайс-листе
+    unmatched_df = load_unmatched_services()
+    if not unmatched_df.empty:
+        with st.expander(f"🔗 Услуги не из прайс-листа ({len(unmatched_df)})"):
+            disp_unmatched = unmatched_df.copy()
+            disp_unmatched['total_sum'] = format_currency_series(disp_unmatched['total_sum']) + " ₽"
+            disp_unmatched['last_payment'] = format_date_display_series(disp_unmatched['last_payment'])
+            disp_unmatched.columns = ['Название в заказах', 'Строк', 'Сумма', 'Последняя оплата']
+            st.dataframe(disp_unmatched, use_container_width=True, hide_index=True)
+
+            link_name = st.selectbox("Название", unmatched_df['service_name'].tolist(), key="link_name")
+            link_id = id_picker("Услуга прайс-листа", "services", key="link_service", hint="Название услуги")
+            if st.button("Привязать", disabled=link_id is None):
+                if link_service_name(link_name, link_id):
+                    st.success(f"✅ «{link_name}» привязано к услуге прайс-листа")
+                    st.rerun()
+
+    mark_section("Список услуг")
     st.markdown("### 📋 Список всех услуг")
-    services_df = run_query("SELECT * FROM services_catalog", fetch=True)
+    services_df = paginated_listing("services", key="services_list")
     if not services_df.empty:
         disp_df = services_df.copy()
-        disp_df['min_price'] = disp_df['min_price'].apply(lambda x: f"{format_currency(x)} ₽")
+        disp_df['min_price'] = format_currency_series(disp_df['min_price']) + " ₽"
         disp_df.columns = ['ID', 'Название', 'Мин. прайс', 'Описание']
         st.dataframe(disp_df, use_container_width=True, hide_index=True)
     else:
@@ -646,17 +644,9 @@ elif choice == "Прайс-лист Услуг":
 elif choice == "Заказы и услуги":
     st.subheader("Заказы и услуги")
 
-    # Справочники
-    clients_df = run_query("SELECT id, name FROM clients ORDER BY name", fetch=True)
-    client_options = clients_df['name'].tolist() if not clients_df.empty else []
-    client_map = dict(zip(clients_df['name'], clients_df['id'])) if not clients_df.empty else {}
-
-    services_df = run_query("SELECT name FROM services_catalog ORDER BY name", fetch=True)
-    service_options = services_df['name'].tolist() if not services_df.empty else []
-
-    col_left, col_right = st.columns([1.8, 1.2])
-
-    with col_left:
+    # Левая и правая колонки — отдельные фрагменты: виджеты редактора не перезапускают состав заказа
+    @page_fragment(choice, "Управление заказом")
+    def order_editor():
         st.markdown("### Управление заказом")
 
         order_mode = st.radio(
@@ -666,10 +656,9 @@ elif choice == "Заказы и услуги":
             key="order_mode"
         )
 
-        selected_client_name = st.selectbox(
-            "Клиент",
-            options=["— Выберите клиента —"] + client_options,
-            key="order_client"
+        client_id = id_picker(
+            "Клиент", "clients", key="order_client",
+            placeholder="— Выберите клиента —", hint="Имя, телефон, VK или Telegram",
         )
 
         col_date, col_status = st.columns(2)
@@ -679,24 +668,13 @@ elif choice == "Заказы и услуги":
             status = st.selectbox("Статус", STATUS_LIST, key="order_status")
 
         order_id = None
-        if order_mode in ["Редактировать", "Удалить"] and selected_client_name != "— Выберите клиента —":
-            client_id = client_map.get(selected_client_name)
-            if client_id:
-                orders_df = run_query("""
-                    SELECT o.id, o.execution_date, o.status 
-                    FROM orders o WHERE o.client_id = ? 
-                    ORDER BY o.execution_date DESC
-                """, (client_id,), fetch=True)
-
-                if not orders_df.empty:
-                    order_labels = [
-                        f"№{row['id']} | {format_date_display(row['execution_date'])} | {row['status']}"
-                        for _, row in orders_df.iterrows()
-                    ]
-                    selected_label = st.selectbox("Выберите заказ", order_labels, key="sel_existing_order")
-                    order_id = int(selected_label.split()[0][1:-1])
-                else:
-                    st.info("У этого клиента пока нет заказов")
+        if order_mode in ["Редактировать", "Удалить"] and client_id is not None:
+            order_id = id_picker(
+                "Выберите заказ", "orders", key="sel_existing_order",
+                index=0, hint="Номер заказа", client_id=client_id,
+            )
+            if order_id is None:
+                st.info("Заказы клиента не найдены")
 
         with st.expander("Управление услугами в заказе", expanded=True):
             service_mode = st.radio(
@@ -708,47 +686,40 @@ elif choice == "Заказы и услуги":
 
             current_items_df = pd.DataFrame()
             if order_id:
-                current_items_df = run_query("""
-                    SELECT id, service_name, payment_date, amount, hours 
-                    FROM order_items WHERE order_id = ?
-                """, (order_id,), fetch=True)
+                current_items_df = load_order_items(order_id)
 
             if service_mode == "Добавить":
+                st.markdown("**Новая услуга**")
+                new_service_id = id_picker("Услуга", "services", key="add_srv", hint="Название услуги")
                 with st.form("form_add_service", clear_on_submit=True):
-                    st.markdown("**Новая услуга**")
                     c1, c2 = st.columns(2)
                     with c1:
-                        new_service = st.selectbox("Услуга", service_options, key="add_srv")
                         new_amount = st.text_input("Сумма ₽", placeholder="15 000", key="add_amount")
+                        new_hours = st.text_input("Часы", value="0.0", key="add_hours")
                     with c2:
                         new_pay_date = st.date_input("Дата оплаты", value=date.today(), key="add_paydate")
-                        new_hours = st.text_input("Часы", value="0.0", key="add_hours")
 
                     if st.form_submit_button("Добавить услугу", use_container_width=True, type="primary"):
-                        if selected_client_name == "— Выберите клиента —":
+                        if client_id is None:
                             st.error("Выберите клиента")
                             st.stop()
+                        new_service = load_service(new_service_id) if new_service_id is not None else None
+                        if new_service is None:
+                            st.error("Выберите услугу")
+                            st.stop()
 
                         amount_val = parse_currency(new_amount)
                         hours_val = float(new_hours.replace(",", ".")) if new_hours.strip() else 0.0
 
-                        # Если заказа ещё нет — создаём
-                        if not order_id:
-                            cid = client_map[selected_client_name]
-                            run_query("""
-                                INSERT INTO orders (client_id, execution_date, status) 
-                                VALUES (?, ?, ?)
-                            """, (cid, execution_date.strftime("%Y-%m-%d"), status))
-                            new_id_df = run_query("SELECT last_insert_rowid() as id", fetch=True)
-                            order_id = new_id_df.iloc[0]['id']
-
-                        run_query("""
-                            INSERT INTO order_items (order_id, service_name, payment_date, amount, hours)
-                            VALUES (?, ?, ?, ?, ?)
-                        """, (order_id, new_service, new_pay_date.strftime("%Y-%m-%d"), amount_val, hours_val))
-
-                        _update_order_total(order_id)
-                        update_client_first_order_date(client_map[selected_client_name])
+                        # Заказ (если его ещё нет), услуга и пересчёт итогов — одной транзакцией
+                        new_order_id = run_write(
+                            add_order_item,
+                            client_id, order_id, execution_date, status,
+                            new_service_id, new_pay_date, amount_val, hours_val,
+                        )
+                        if new_order_id is None:
+                            st.stop()
+                        st.session_state.last_viewed_order_id = new_order_id
                         st.success("Услуга добавлена!")
                         st.rerun()
 
@@ -762,8 +733,12 @@ elif choice == "Заказы и услуги":
                 sel_item_id = current_items_df.iloc[sel_idx]['id']
 
                 row = current_items_df[current_items_df['id'] == sel_item_id].iloc[0]
+                if service_mode == "Редактировать":
+                    replace_id = id_picker(
+                        "Услуга", "services", key=f"edit_item_service_{sel_item_id}",
+                        placeholder=f"{row['service_name']} (без изменений)", hint="Название услуги",
+                    )
                 edit_df = pd.DataFrame([{
-                    "service_name": row["service_name"],
                     "payment_date": pd.to_datetime(row["payment_date"]),
                     "amount": row["amount"],
                     "hours": row["hours"]
@@ -772,7 +747,6 @@ elif choice == "Заказы и услуги":
                 edited = st.data_editor(
                     edit_df,
                     column_config={
-                        "service_name": st.column_config.SelectboxColumn("Услуга", options=service_options),
                         "payment_date": st.column_config.DateColumn("Дата оплаты"),
                         "amount": st.column_config.NumberColumn("Сумма ₽", format="%.0f"),
                         "hours": st.column_config.NumberColumn("Часы", format="%.2f")
@@ -784,18 +758,16 @@ elif choice == "Заказы и услуги":
                 if service_mode == "Редактировать":
                     if st.button("Сохранить изменения", use_container_width=True, type="primary"):
                         r = edited.iloc[0]
-                        run_query("""
-                            UPDATE order_items SET service_name=?, payment_date=?, amount=?, hours=?
-                            WHERE id=?
-                        """, (r.service_name, r.payment_date, r.amount, r.hours, sel_item_id))
-                        _update_order_total(order_id)
+                        # без новой услуги остаётся прежняя (и у несопоставленной строки — её название)
+                        if run_write(update_order_item, sel_item_id, replace_id, r.payment_date, r.amount, r.hours) is None:
+                            st.stop()
                         st.success("Услуга обновлена")
                         st.rerun()
 
                 if service_mode == "Удалить":
                     if st.button("Удалить услугу", use_container_width=True, type="secondary"):
-                        run_query("DELETE FROM order_items WHERE id=?", (sel_item_id,))
-                        _update_order_total(order_id)
+                        if run_write(delete_order_item, sel_item_id) is None:
+                            st.stop()
                         st.success("Услуга удалена")
                         st.rerun()
 
@@ -805,49 +777,47 @@ elif choice == "Заказы и услуги":
         # Кнопки действий по заказу
         if order_mode == "Добавить":
             if st.button("Создать заказ", use_container_width=True, type="primary"):
-                if selected_client_name == "— Выберите клиента —":
+                if client_id is None:
                     st.error("Выберите клиента")
                 else:
-                    cid = client_map[selected_client_name]
-                    run_query("""
-                        INSERT INTO orders (client_id, execution_date, status) VALUES (?, ?, ?)
-                    """, (cid, execution_date.strftime("%Y-%m-%d"), status))
+                    create_order(client_id, execution_date, status)
                     st.success("Заказ создан!")
                     st.rerun()
 
         elif order_mode == "Редактировать" and order_id:
             if st.button("Сохранить изменения заказа", use_container_width=True, type="primary"):
-                run_query("""
-                    UPDATE orders SET execution_date=?, status=? WHERE id=?
-                """, (execution_date.strftime("%Y-%m-%d"), status, order_id))
+                update_order(order_id, execution_date, status)
                 st.success("Заказ обновлён")
                 st.rerun()
 
         elif order_mode == "Удалить" and order_id:
             st.warning("Удалить весь заказ со всеми услугами?")
             if st.button("Подтвердить удаление", type="secondary"):
-                run_query("DELETE FROM orders WHERE id=?", (order_id,))
+                if run_write(delete_order, order_id) is None:
+                    st.stop()
                 st.success("Заказ удалён")
                 st.rerun()
 
+        # Сохраняем последний просмотренный заказ для правой колонки
+        if order_id and order_id != st.session_state.get("last_viewed_order_id"):
+            st.session_state.last_viewed_order_id = order_id
+            if fragment_only_rerun():
+                st.rerun()  # выбран другой заказ — правая колонка тоже должна обновиться
+
     # Правая колонка — всегда состав заказа
-    with col_right:
+    @page_fragment(choice, "Состав заказа")
+    def order_items_panel():
         st.markdown("### Состав заказа")
 
-        display_id = order_id or st.session_state.get("last_viewed_order_id")
+        display_id = st.session_state.get("last_viewed_order_id")
         if display_id:
-            items = run_query("""
-                SELECT service_name, payment_date, amount, hours 
-                FROM order_items WHERE order_id = ? ORDER BY payment_date
-            """, (display_id,), fetch=True)
-
-            total_row = run_query("SELECT total_amount FROM orders WHERE id=?", (display_id,), fetch=True)
-            total = total_row.iloc[0]['total_amount'] if not total_row.empty else 0
+            items = load_order_items(display_id)
+            total = order_total(display_id)
 
             if not items.empty:
                 disp = items.copy()
-                disp['payment_date'] = disp['payment_date'].apply(format_date_display)
-                disp['amount'] = disp['amount'].apply(lambda x: f"{format_currency(x)} ₽")
+                disp['payment_date'] = format_date_display_series(disp['payment_date'])
+                disp['amount'] = format_currency_series(disp['amount']) + " ₽"
                 disp['hours'] = disp['hours'].apply(lambda x: f"{float(x):.1f}" if pd.notna(x) else "—")
 
                 st.dataframe(
@@ -866,178 +836,393 @@ elif choice == "Заказы и услуги":
         else:
             st.info("Выберите заказ — состав появится здесь")
 
-    # Сохраняем последний просмотренный заказ для правой колонки
-    if order_id:
-        st.session_state.last_viewed_order_id = order_id
+    col_left, col_right = st.columns([1.8, 1.2])
+    with col_left:
+        order_editor()
+    with col_right:
+        order_items_panel()
+
+    mark_section("Все заказы")
+    with st.expander("📋 Все заказы"):
+        status_filter = st.selectbox("Статус", ["Все"] + STATUS_LIST, key="orders_list_status")
+        orders_page = paginated_listing(
+            "orders",
+            key="orders_list",
+            status=status_filter if status_filter != "Все" else None,
+        )
+        if not orders_page.empty:
+            orders_page['execution_date'] = format_date_display_series(orders_page['execution_date'])
+            orders_page['total_amount'] = format_currency_series(orders_page['total_amount']) + " ₽"
+            orders_page.columns = ['№', 'Дата исполнения', 'Клиент', 'Статус', 'Сумма']
+            st.dataframe(orders_page, use_container_width=True, hide_index=True)
+        else:
+            st.info("Заказов нет")
 
 
 
 
 
-# --- 4. ОТЧЁТЫ (остаётся без изменений) ---
+# --- 4. ОТЧЁТЫ ---
 elif choice == "ОТЧЁТЫ":
     st.header("📊 Аналитические Отчёты")
 
-    # Основной запрос — по дате оплаты!
-    main_query = '''
-    SELECT 
-        oi.id as item_id,
-        oi.payment_date,
-        oi.amount,
-        oi.hours,
-        oi.service_name,
-        o.id as order_id,
-        o.status,
-        o.execution_date,
-        c.id as client_id,
-        c.name as client_name,
-        c.first_order_date,
-        g.name as group_name
-    FROM order_items oi
-    JOIN orders o ON oi.order_id = o.id
-    JOIN clients c ON o.client_id = c.id
-    LEFT JOIN groups g ON c.group_id = g.id
-    WHERE oi.payment_date IS NOT NULL
-    '''
-    df = run_query(main_query, fetch=True)
-
-    if not df.empty:
-        df['payment_date'] = pd.to_datetime(df['payment_date'])
-        df['year'] = df['payment_date'].dt.year
-        df['month'] = df['payment_date'].dt.month
-        df['month_name'] = df['payment_date'].dt.strftime('%B')
-
-        years = sorted(df['year'].unique())
-        
+    # Годы с оплатами — из помесячных агрегатов (см. revenue_rollup)
+    years = load_report_years()
+
+    # Фильтр по группе для отчётов по клиентам
+    report_groups_df = load_groups()
+    report_group_map = dict(zip(report_groups_df['name'], report_groups_df['id'])) if not report_groups_df.empty else {}
+    report_group_options = ["Все"] + sorted(report_group_map)
+
+    if years:
         # Отчет 1: Оплаты за год по группам
-        st.subheader("1. Оплаты за год по группам")
-        sel_year_1 = st.selectbox("Выберите год", years, index=len(years)-1, key='y1')
+        @page_fragment(choice, "Отчёт 1")
+        def report_groups_by_year():
+            st.subheader("1. Оплаты за год по группам")
+            sel_year_1 = st.selectbox("Выберите год", years, index=len(years)-1, key='y1')
         
-        df_1 = df[df['year'] == sel_year_1].groupby('group_name').agg(
-            Количество_оплат=('item_id', 'count'),
-            Сумма=('amount', 'sum'),
-            Средняя_оплата=('amount', 'mean')
-        ).reset_index()
-        df_1['Сумма'] = df_1['Сумма'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_1['Средняя_оплата'] = df_1['Средняя_оплата'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_1.columns = ['Группа', 'Кол-во оплат', 'Сумма', 'Средняя оплата']
-        st.dataframe(df_1, use_container_width=True, hide_index=True)
+            df_1 = report_frame("groups_by_year", year=sel_year_1)
+            df_1['total_sum'] = format_currency_series(df_1['total_sum']) + " ₽"
+            df_1['avg_sum'] = format_currency_series(df_1['avg_sum']) + " ₽"
+            df_1.columns = ['Группа', 'Кол-во оплат', 'Сумма', 'Средняя оплата']
+            st.dataframe(df_1, use_container_width=True, hide_index=True)
+        report_groups_by_year()
 
         # Отчет 2: Оплаты за год по клиентам
-        st.subheader("2. Оплаты за год по клиентам")
-        sel_year_2 = st.selectbox("Выберите год", years, index=len(years)-1, key='y2')
+        @page_fragment(choice, "Отчёт 2")
+        def report_clients_by_year():
+            st.subheader("2. Оплаты за год по клиентам")
+            c1, c2 = st.columns(2)
+            with c1:
+                sel_year_2 = st.selectbox("Выберите год", years, index=len(years)-1, key='y2')
+            with c2:
+                sel_group_2 = st.selectbox("Группа", report_group_options, key='g2')
         
-        df_2 = df[df['year'] == sel_year_2].groupby('client_name').agg(
-            Количество_оплат=('item_id', 'count'),
-            Сумма=('amount', 'sum')
-        ).reset_index().sort_values(by='Сумма', ascending=False)
-        df_2['Сумма'] = df_2['Сумма'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_2.columns = ['Клиент', 'Кол-во оплат', 'Сумма']
-        st.dataframe(df_2, use_container_width=True, hide_index=True)
+            df_2 = report_frame("clients_by_year", year=sel_year_2, group=report_group_map.get(sel_group_2))
+            df_2['total_sum'] = format_currency_series(df_2['total_sum']) + " ₽"
+            df_2.columns = ['Клиент', 'Кол-во оплат', 'Сумма']
+            st.dataframe(df_2, use_container_width=True, hide_index=True)
+        report_clients_by_year()
 
         # Отчет 3: Новые клиенты за год (по первой оплате)
-        st.subheader("3. Новые клиенты за год")
-        sel_year_3 = st.selectbox("Выберите год", years, index=len(years)-1, key='y3')
+        @page_fragment(choice, "Отчёт 3")
+        def report_new_clients():
+            st.subheader("3. Новые клиенты за год")
+            c1, c2 = st.columns(2)
+            with c1:
+                sel_year_3 = st.selectbox("Выберите год", years, index=len(years)-1, key='y3')
+            with c2:
+                sel_group_3 = st.selectbox("Группа", report_group_options, key='g3')
         
-        df_new_clients = run_query('''
-            SELECT 
-                c.name, 
-                c.first_order_date,
-                COUNT(oi.id) as payments_count, 
-                SUM(oi.amount) as total_sum
-            FROM clients c 
-            JOIN orders o ON c.id = o.client_id
-            JOIN order_items oi ON o.id = oi.order_id
-            WHERE strftime('%Y', c.first_order_date) = ?
-            GROUP BY c.id
-            ORDER BY total_sum DESC
-        ''', (str(sel_year_3),), fetch=True)
+            df_new_clients = report_frame("new_clients", year=sel_year_3, group=report_group_map.get(sel_group_3))
         
-        if not df_new_clients.empty:
-            df_new_clients['first_order_date'] = df_new_clients['first_order_date'].apply(format_date_display)
-            df_new_clients['total_sum'] = df_new_clients['total_sum'].apply(lambda x: f"{format_currency(x)} ₽")
-            df_new_clients.columns = ['Клиент', 'Первая оплата', 'Кол-во оплат', 'Сумма']
-            st.dataframe(df_new_clients, use_container_width=True, hide_index=True)
-        else:
-            st.info("Нет новых клиентов за этот год")
+            if not df_new_clients.empty:
+                df_new_clients['first_order_date'] = format_date_display_series(df_new_clients['first_order_date'])
+                df_new_clients['total_sum'] = format_currency_series(df_new_clients['total_sum']) + " ₽"
+                df_new_clients.columns = ['Клиент', 'Первая оплата', 'Кол-во оплат', 'Сумма']
+                st.dataframe(df_new_clients, use_container_width=True, hide_index=True)
+            else:
+                st.info("Нет новых клиентов за этот год")
+        report_new_clients()
 
         # Отчет 4: Сводка по годам
-        st.subheader("4. Сводка по годам")
-        df_4 = df.groupby('year').agg(
-            Количество_оплат=('item_id', 'count'),
-            Макс_оплата=('amount', 'max'),
-            Мин_оплата=('amount', 'min'),
-            Средняя_оплата=('amount', 'mean'),
-            Сумма_год=('amount', 'sum')
-        ).reset_index()
-        df_4['Средний_месячный'] = df_4['Сумма_год'] / 12
+        @page_fragment(choice, "Отчёт 4")
+        def report_years_summary():
+            st.subheader("4. Сводка по годам")
+            df_4 = report_frame("years_summary")
+            df_4['Средний_месячный'] = df_4['Сумма_год'] / 12
         
-        # Копия для графика
-        df_4_chart = df_4[['year', 'Сумма_год']].copy()
+            # Копия для графика
+            df_4_chart = df_4[['year', 'Сумма_год']].copy()
         
-        df_4['Макс_оплата'] = df_4['Макс_оплата'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_4['Мин_оплата'] = df_4['Мин_оплата'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_4['Средняя_оплата'] = df_4['Средняя_оплата'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_4['Сумма_год'] = df_4['Сумма_год'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_4['Средний_месячный'] = df_4['Средний_месячный'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_4.columns = ['Год', 'Кол-во оплат', 'Макс', 'Мин', 'Средняя', 'Сумма за год', 'Средний мес.']
-        st.dataframe(df_4, use_container_width=True, hide_index=True)
+            df_4['Макс_оплата'] = format_currency_series(df_4['Макс_оплата']) + " ₽"
+            df_4['Мин_оплата'] = format_currency_series(df_4['Мин_оплата']) + " ₽"
+            df_4['Средняя_оплата'] = format_currency_series(df_4['Средняя_оплата']) + " ₽"
+            df_4['Сумма_год'] = format_currency_series(df_4['Сумма_год']) + " ₽"
+            df_4['Средний_месячный'] = format_currency_series(df_4['Средний_месячный']) + " ₽"
+            df_4.columns = ['Год', 'Кол-во оплат', 'Макс', 'Мин', 'Средняя', 'Сумма за год', 'Средний мес.']
+            st.dataframe(df_4, use_container_width=True, hide_index=True)
         
-        st.bar_chart(df_4_chart.set_index('year'))
+            st.bar_chart(df_4_chart.set_index('year'))
+        report_years_summary()
 
         # Отчет 5: Оплаты за месяц
-        st.subheader("5. Оплаты за месяц (детализация)")
-        c1, c2 = st.columns(2)
-        with c1: 
-            sel_year_5 = st.selectbox("Год", years, index=len(years)-1, key='y5')
-        with c2: 
-            sel_month_5 = st.selectbox("Месяц", range(1,13), index=date.today().month-1, key='m5')
+        @page_fragment(choice, "Отчёт 5")
+        def report_clients_by_month():
+            st.subheader("5. Оплаты за месяц (детализация)")
+            c1, c2, c3 = st.columns(3)
+            with c1: 
+                sel_year_5 = st.selectbox("Год", years, index=len(years)-1, key='y5')
+            with c2: 
+                sel_month_5 = st.selectbox("Месяц", range(1,13), index=date.today().month-1, key='m5')
+            with c3:
+                sel_group_5 = st.selectbox("Группа", report_group_options, key='g5')
         
-        df_5 = df[(df['year'] == sel_year_5) & (df['month'] == sel_month_5)]
-        df_5_res = df_5.groupby('client_name').agg(
-            Количество_оплат=('item_id', 'count'),
-            Сумма=('amount', 'sum')
-        ).reset_index().sort_values(by='Сумма', ascending=False)
-        df_5_res['Сумма'] = df_5_res['Сумма'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_5_res.columns = ['Клиент', 'Кол-во оплат', 'Сумма']
-        st.dataframe(df_5_res, use_container_width=True, hide_index=True)
+            df_5_res = report_frame("clients_by_month", year=sel_year_5, month=sel_month_5, group=report_group_map.get(sel_group_5))
+            df_5_res['total_sum'] = format_currency_series(df_5_res['total_sum']) + " ₽"
+            df_5_res.columns = ['Клиент', 'Кол-во оплат', 'Сумма']
+            st.dataframe(df_5_res, use_container_width=True, hide_index=True)
+        report_clients_by_month()
 
         # Отчет 6: Динамика по месяцам
-        st.subheader("6. Динамика по месяцам")
-        sel_year_6 = st.selectbox("Выберите год", years, index=len(years)-1, key='y6')
-        df_6 = df[df['year'] == sel_year_6].groupby('month').agg(
-            Количество_оплат=('item_id', 'count'),
-            Средняя_оплата=('amount', 'mean'),
-            Сумма=('amount', 'sum')
-        ).reset_index()
+        @page_fragment(choice, "Отчёт 6")
+        def report_months_of_year():
+            st.subheader("6. Динамика по месяцам")
+            sel_year_6 = st.selectbox("Выберите год", years, index=len(years)-1, key='y6')
+            df_6 = report_frame("months_of_year", year=sel_year_6)
         
-        df_6_chart = df_6[['month', 'Сумма']].copy()
+            df_6_chart = df_6[['month', 'Сумма']].copy()
         
-        df_6['Средняя_оплата'] = df_6['Средняя_оплата'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_6['Сумма'] = df_6['Сумма'].apply(lambda x: f"{format_currency(x)} ₽")
-        df_6.columns = ['Месяц', 'Кол-во оплат', 'Средняя оплата', 'Сумма']
-        st.dataframe(df_6, use_container_width=True, hide_index=True)
+            df_6['Средняя_оплата'] = format_currency_series(df_6['Средняя_оплата']) + " ₽"
+            df_6['Сумма'] = format_currency_series(df_6['Сумма']) + " ₽"
+            df_6.columns = ['Месяц', 'Кол-во оплат', 'Средняя оплата', 'Сумма']
+            st.dataframe(df_6, use_container_width=True, hide_index=True)
         
-        st.line_chart(df_6_chart.set_index('month'))
+            st.line_chart(df_6_chart.set_index('month'))
+        report_months_of_year()
 
         # Отчет 7: Оплаты за последнюю неделю
-        st.subheader("7. Оплаты за последнюю неделю")
-        df_7 = run_query('''
-            SELECT c.name, oi.payment_date, SUM(oi.amount) as total_amount
-            FROM order_items oi
-            JOIN orders o ON oi.order_id = o.id
-            JOIN clients c ON o.client_id = c.id
-            WHERE oi.payment_date >= date('now','-7 days')
-            GROUP BY c.name, oi.payment_date
-            ORDER BY oi.payment_date DESC
-        ''', fetch=True)
+        @page_fragment(choice, "Отчёт 7")
+        def report_last_week():
+            st.subheader("7. Оплаты за последнюю неделю")
+            df_7 = run_report("last_week", since=(date.today() - timedelta(days=7)).isoformat())
         
-        if not df_7.empty:
-            df_7['payment_date'] = df_7['payment_date'].apply(format_date_display)
-            df_7['total_amount'] = df_7['total_amount'].apply(lambda x: f"{format_currency(x)} ₽")
-            df_7.columns = ['Клиент', 'Дата оплаты', 'Сумма']
-            st.dataframe(df_7, use_container_width=True, hide_index=True)
-        else:
-            st.info("Нет оплат за последнюю неделю")
+            if not df_7.empty:
+                df_7['payment_date'] = format_date_display_series(df_7['payment_date'])
+                df_7['total_amount'] = format_currency_series(df_7['total_amount']) + " ₽"
+                df_7.columns = ['Клиент', 'Дата оплаты', 'Сумма']
+                st.dataframe(df_7, use_container_width=True, hide_index=True)
+            else:
+                st.info("Нет оплат за последнюю неделю")
+        report_last_week()
+
+        # Отчет 8: Когорты по месяцу первой оплаты
+        @page_fragment(choice, "Отчёт 8")
+        def report_cohorts():
+            import plotly.graph_objects as go  # нужен только этому отчёту
+
+            st.subheader("8. Когорты: возвращаемость по месяцам")
+            c1, c2, c3 = st.columns(3)
+            with c1:
+                metric_8 = st.radio("Показатель", list(COHORT_METRICS), format_func=COHORT_METRICS.get, horizontal=True, key='metric8')
+            with c2:
+                sel_year_8 = st.selectbox("Год первой оплаты", ["Все"] + years, key='y8')
+            with c3:
+                sel_group_8 = st.selectbox("Группа", report_group_options, key='g8')
+
+            cohorts = report_frame(
+                "cohorts",
+                year=None if sel_year_8 == "Все" else sel_year_8,
+                group=report_group_map.get(sel_group_8),
+            )
+            matrix = cohort_matrix(cohorts, metric_8)
+            if matrix.empty:
+                st.info("Нет клиентов с оплатами для выбранных фильтров")
+                return
+
+            shares = matrix.drop(columns="size") * 100
+            fig = go.Figure(go.Heatmap(
+                z=shares.to_numpy(),
+                x=[str(m) for m in shares.columns],
+                y=list(shares.index),
+                colorscale="Blues",
+                zmin=0,
+                zmax=100 if metric_8 == "clients" else None,
+                hovertemplate="Когорта %{y}, месяц %{x}: %{z:.1f}%<extra></extra>",
+            ))
+            fig.update_layout(
+                xaxis_title="Месяцев с первой оплаты",
+                yaxis=dict(autorange="reversed", type="category"),
+                height=max(300, 18 * len(shares)),
+                margin=dict(l=0, r=0, t=10, b=0),
+            )
+            st.plotly_chart(fig, use_container_width=True)
+
+            table = shares.round(1)
+            table.columns = [f"+{m}" for m in shares.columns]
+            size_label = "Клиентов" if metric_8 == "clients" else "Выручка 1-го мес."
+            sizes = matrix["size"]
+            table.insert(0, size_label, sizes.astype(int) if metric_8 == "clients" else format_currency_series(sizes) + " ₽")
+            table.index.name = "Когорта"
+            st.dataframe(table, use_container_width=True)
+            st.caption("Доля от первого месяца когорты, %. Пусто — месяц для когорты ещё не наступил.")
+        report_cohorts()
+
+        # Отчет 9: Выручка и часы по услугам
+        @page_fragment(choice, "Отчёт 9")
+        def report_services():
+            st.subheader("9. Выручка и часы по услугам")
+            c1, c2, c3 = st.columns(3)
+            with c1:
+                sel_year_9 = st.selectbox("Год", years, index=len(years)-1, key='y9')
+            with c2:
+                sel_month_9 = st.selectbox("Месяц", ["Все"] + list(range(1, 13)), key='m9')
+            with c3:
+                sel_group_9 = st.selectbox("Группа", report_group_options, key='g9')
+
+            df_9 = report_frame(
+                "services",
+                year=sel_year_9,
+                month=None if sel_month_9 == "Все" else sel_month_9,
+                group=report_group_map.get(sel_group_9),
+            )
+            if df_9.empty:
+                st.info("Нет оплат за выбранный период")
+                return
+
+            df_9_chart = df_9[['service_name', 'total_sum']].copy()
+            hours = df_9['total_hours'].where(df_9['total_hours'] > 0)
+            df_9['per_hour'] = format_currency_series((df_9['total_sum'] / hours).fillna(0)) + " ₽"
+            df_9['total_sum'] = format_currency_series(df_9['total_sum']) + " ₽"
+            df_9['total_hours'] = df_9['total_hours'].map(lambda x: f"{x:.1f}")
+            df_9 = df_9.drop(columns='service_id')
+            df_9.columns = ['Услуга', 'Кол-во оплат', 'Сумма', 'Часы', 'Сумма за час']
+            st.dataframe(df_9, use_container_width=True, hide_index=True)
+            st.bar_chart(df_9_chart.set_index('service_name'))
+
+            unmatched = load_unmatched_services()
+            if not unmatched.empty:
+                st.caption(
+                    f"«{UNLISTED_SERVICE}» — услуги заказов, не найденные в прайс-листе "
+                    f"({len(unmatched)} назв.). Привязать их к услугам можно в разделе «Прайс-лист Услуг»."
+                )
+        report_services()
     else:
-        st.warning("В базе данных пока нет оплат для формирования отчётов.")
\ No newline at end of file
+        st.warning("В базе данных пока нет оплат для формирования отчётов.")
+
+    mark_section("Выгрузка")
+    with st.expander("📤 Выгрузка в CSV / Parquet"):
+        st.caption(f"Файл пишется порциями по {EXPORT_CHUNK_SIZE} строк в папку «{export_dir()}», "
+                   "старые выгрузки удаляются через сутки.")
+        exportable = [k for k in REPORTS if set(REPORTS[k]["params"]) <= set(EXPORT_FILTERS)]
+        exp_name = st.selectbox("Что выгрузить", exportable, format_func=lambda k: REPORTS[k]["title"], key="exp_report")
+        exp_params = REPORTS[exp_name]["params"]
+        c1, c2, c3, c4 = st.columns(4)
+        with c1:
+            exp_fmt = st.radio("Формат", list(EXPORT_FORMATS), format_func=EXPORT_FORMATS.get, key="exp_fmt")
+        with c2:
+            exp_year = st.selectbox("Год", ["Все"] + years, key="exp_year", disabled="year" not in exp_params)
+        with c3:
+            exp_month = st.selectbox("Месяц", ["Все"] + list(range(1, 13)), key="exp_month", disabled="month" not in exp_params)
+        with c4:
+            exp_group = st.selectbox("Группа", report_group_options, key="exp_group", disabled="group" not in exp_params)
+
+        if st.button("Сформировать файл", key="exp_run"):
+            try:
+                path, rows = export_report_file(
+                    exp_name, exp_fmt,
+                    year=None if exp_year == "Все" else exp_year,
+                    month=None if exp_month == "Все" else exp_month,
+                    group=report_group_map.get(exp_group),
+                )
+            except (sqlite3.Error, OSError, ValueError, TypeError) as e:   # ошибки pyarrow — ValueError/TypeError
+                st.error(f"Ошибка выгрузки: {e}")
+            else:
+                st.success(f"Выгружено строк: {rows} → {path}")
+                size = os.path.getsize(path)
+                if size > EXPORT_DOWNLOAD_LIMIT:
+                    # кнопка скачивания целиком читает файл в память сервера
+                    st.warning(f"Файл {size / 2**20:.0f} МБ больше {EXPORT_DOWNLOAD_LIMIT / 2**20:.0f} МБ — "
+                               f"заберите его из папки выгрузок: {path}")
+                else:
+                    with open(path, "rb") as f:
+                        st.download_button("Скачать файл", f, file_name=os.path.basename(path), key="exp_download")
+
+    mark_section("Обслуживание")
+    with st.expander("⚙️ Обслуживание базы"):
+        st.caption("Агрегаты и итоги обновляются автоматически. Пересборка нужна только после ручной правки базы.")
+        if st.button("Пересобрать агрегаты выручки"):
+            rebuild_rollups()
+            st.success("Агрегаты пересобраны")
+            st.rerun()
+
+        if st.button("Проверить суммы заказов и даты первой оплаты"):
+            mismatches = check_derived_fields()
+            if mismatches.empty:
+                st.success("Расхождений нет")
+            else:
+                st.warning(f"Найдено расхождений: {len(mismatches)}")
+                mismatches.columns = ['Поле', 'ID', 'Сохранено', 'Ожидается']
+                st.dataframe(mismatches, use_container_width=True, hide_index=True)
+        if st.button("Исправить расхождения"):
+            fixed = run_write(repair_derived_fields)
+            if fixed is not None:
+                st.success(f"Исправлено строк: {fixed}")
+
+# --- 5. ИМПОРТ ---
+elif choice == "Импорт":
+    st.subheader("Импорт из CSV / XLSX")
+
+    kind = st.radio(
+        "Что импортируем",
+        list(IMPORT_KINDS),
+        format_func=lambda k: IMPORT_KINDS[k]["title"],
+        horizontal=True,
+        key="import_kind"
+    )
+    st.caption(
+        "Колонки: " + ", ".join(IMPORT_KINDS[kind]["columns"])
+        + ". Подходят и русские заголовки старой таблицы (Имя, Телефон, Группа, Сумма, ...)."
+    )
+    if kind == "orders":
+        st.caption(
+            "Клиент ищется по client_id, телефону, VK или Telegram. Услуги с одинаковым order_ref "
+            "(или, без него, с одной датой исполнения и статусом) попадают в один заказ."
+        )
+
+    uploaded = st.file_uploader("Файл", type=["csv", "xlsx"], key="import_file")
+    skip_duplicates = True
+    if kind == "clients":
+        skip_duplicates = not st.checkbox("Импортировать, даже если контакт уже есть у другого клиента")
+
+    if uploaded and st.button("Импортировать", type="primary"):
+        bar = st.progress(0.0, text="Импорт...")
+        try:
+            imported, failed = import_file(
+                uploaded, uploaded.name, kind, skip_duplicates=skip_duplicates,
+                progress=lambda done, total: bar.progress(min(done / total, 1.0), text=f"Обработано строк: {done} из ~{total}"),
+            )
+        except (sqlite3.Error, ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+            st.error(f"Импорт прерван: {e}. Уже записанные порции сохранены.")
+        else:
+            bar.progress(1.0, text="Готово")
+            st.success(f"✅ Импортировано строк: {imported}")
+            if not failed.empty:
+                st.warning(f"Пропущено строк с ошибками: {len(failed)}")
+                st.dataframe(failed, use_container_width=True, hide_index=True)
+                st.download_button(
+                    "Скачать отчёт об ошибках (CSV)",
+                    failed.to_csv(index=False).encode("utf-8-sig"),
+                    file_name="import_errors.csv",
+                    mime="text/csv",
+                )
+
+# --- МЕТРИКИ ПЕРЕЗАПУСКА ---
+# (перезапуски, прерванные st.rerun() или st.stop(), сюда не доходят и в метрики не пишутся)
+finish_rerun()
+if show_debug:
+    with debug_slot:
+        st.caption(f"Страница: {choice}")
+        m1, m2 = st.columns(2)
+        m1.metric("Запросов", RERUN["queries"])
+        m2.metric("Время БД", f"{RERUN['db_ms']:.0f} мс")
+        if RERUN["repeats"]:
+            st.caption(f"Повторных чтений из памяти перезапуска: {RERUN['repeats']} (в журнале — repeat_of)")
+        m3, m4 = st.columns(2)
+        m3.metric("Форматирование", f"{RERUN['format_ms']:.0f} мс")
+        m4.metric("Отрисовка", f"{RERUN['render_ms']:.0f} мс")
+        if RERUN["log"]:
+            log_df = pd.DataFrame(RERUN["log"]).sort_values("duration_ms", ascending=False)
+            st.dataframe(log_df.round({"duration_ms": 1}), hide_index=True, use_container_width=True)
+        with st.expander(f"Медленные запросы (от {SLOW_QUERY_MS} мс)"):
+            st.dataframe(recent_slow_queries(), hide_index=True, use_container_width=True)
+        with st.expander("Перцентили по страницам"):
+            st.dataframe(page_percentiles().round(1), hide_index=True, use_container_width=True)
+        with st.expander("Очередь записи за сутки"):
+            writes = write_queue_stats()
+            w1, w2 = st.columns(2)
+            w1.metric("Заданий", writes["jobs"], help=f"пачек: {writes['batches']}, с ошибкой: {writes['failed']}")
+            w2.metric("Наибольшая очередь", writes["max_depth"])
+            w3, w4 = st.columns(2)
+            w3.metric("Ожидание p50 / p99", f"{writes['wait_p50_ms']:.0f} / {writes['wait_p99_ms']:.0f} мс")
+            w4.metric("Фиксация p50 / p99", f"{writes['commit_p50_ms']:.0f} / {writes['commit_p99_ms']:.0f} мс")
@@ -0,0 +1,2998 @@
+"""
+Слой данных CRM студии: подключение к SQLite, миграции, чтение, запись, импорт, отчёты и выгрузка.
+Модуль не зависит от Streamlit: его импортируют страницы studio_app.py, скрипты замеров
+и пакетные задачи. База выбирается через configure() (или DB_PATH), в том числе ':memory:'.
+"""
+import numpy as np
+import pandas as pd
+import sqlite3
+import codecs
+import copy
+import io
+import json
+import os
+import threading
+import queue
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from datetime import datetime, date
+import re
+import sys
+import tempfile
+import time
+
+from formatters import (
+    parse_date_to_db, format_date_display, parse_currency, normalize_phone, normalize_telegram,
+    format_phone_series, format_vk_link_series, format_date_display_series, format_currency_series,
+)
+
+# --- КОНСТАНТЫ ---
+STATUS_LIST = ["В работе", "Ожидает оплаты", "Выполнен", "Оплачен"]
+
+CLIENT_SEARCH_LIMIT = 100   # сколько клиентов максимум показывает поиск
+PAGE_SIZES = [25, 50, 100, 250]   # варианты размера страницы в списках
+PICKER_LIMIT = 20           # сколько вариантов максимум показывает поле выбора
+
+DB_PATH = os.environ.get('STUDIO_DB', 'studio.db')   # ':memory:' — база в памяти процесса
+DB_POOL_SIZE = 8             # максимум одновременно открытых соединений
+DB_POOL_TIMEOUT = 10         # сколько секунд ждать свободное соединение
+DB_BUSY_TIMEOUT = 10         # сколько секунд ждать блокировку записи другого процесса (busy_timeout)
+DB_STATEMENT_CACHE = 256     # размер кэша подготовленных выражений на соединение
+DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,        # ~64 МБ страничного кэша (в КиБ)
+    "mmap_size": 268435456,      # 256 МБ memory-mapped I/O
+    "temp_store": "MEMORY",
+}
+
+# --- ПОДКЛЮЧЕНИЕ К БД ---
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений SQLite.
+    Соединение выдаётся потоку на время работы и возвращается в пул,
+    повторный запрос из того же потока получает уже выданное соединение.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.uid = uuid.uuid4().hex   # различает базы ':memory:' разных пулов (в том числе в кэше результатов)
+
+    def _connect(self):
+        path, uri = self.path, False
+        if path == ":memory:":
+            # у каждого соединения ':memory:' своя база; общий кэш даёт соединениям пула одну базу,
+            # которая живёт, пока открыто хотя бы одно из них
+            path, uri = f"file:studio-memory-{self.uid}?mode=memory&cache=shared", True
+        conn = sqlite3.connect(
+            path,
+            uri=uri,
+            check_same_thread=False,  # соединение переходит между потоками, но не используется одновременно
+            timeout=DB_BUSY_TIMEOUT,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        for name, value in DB_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        # lower() SQLite меняет регистр только латиницы
+        conn.create_function("casefold", 1, lambda text: text.casefold() if isinstance(text, str) else text,
+                             deterministic=True)
+        return conn
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get(timeout=self.timeout)
+
+    @contextmanager
+    def connection(self):
+        """Выдаёт соединение текущему потоку (с повторным входом)"""
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()  # незавершённая транзакция не должна уйти в пул
+            self._local.conn = None
+            self._idle.put(conn)
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _shared_pool(path, size, setup=None):
+    """Пул соединений к path, общий на процесс; setup(conn) выполняется при создании пула"""
+    with _POOLS_LOCK:
+        pool = _POOLS.get(path)
+        if pool is None:
+            pool = ConnectionPool(path, size=size)
+            if setup is not None:
+                with pool.connection() as conn:
+                    setup(conn)
+            _POOLS[path] = pool
+        return pool
+
+def get_pool():
+    """Общий на процесс пул соединений базы DB_PATH"""
+    return _shared_pool(DB_PATH, DB_POOL_SIZE)
+
+def configure(db_path=None, metrics_db_path=None, results_db_path=None):
+    """Выбирает базу данных, базу метрик и кэш результатов отчётов (до первого обращения или между задачами)"""
+    global DB_PATH, METRICS_DB_PATH, RESULTS_DB_PATH
+    if db_path is not None:
+        DB_PATH = db_path
+    if metrics_db_path is not None:
+        METRICS_DB_PATH = metrics_db_path
+    if results_db_path is not None:
+        RESULTS_DB_PATH = results_db_path
+
+# --- ИНСТРУМЕНТИРОВАНИЕ ---
+# run_query замеряет время и число строк каждого запроса и относит их к странице и разделу
+# текущего перезапуска скрипта (mark_section). Запросы дольше SLOW_QUERY_MS попадают в журнал
+# медленных запросов вместе с EXPLAIN QUERY PLAN. Итоги каждого перезапуска пишутся в отдельную
+# базу METRICS_DB_PATH, по ним считаются перцентили времени страниц по неделям.
+METRICS_DB_PATH = 'metrics.db'
+SLOW_QUERY_MS = 100          # порог медленного запроса
+RERUN_QUERY_LOG_LIMIT = 500  # сколько запросов перезапуска хранить для панели отладки
+
+METRICS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS slow_queries (
+    id INTEGER PRIMARY KEY,
+    logged_at TEXT DEFAULT (datetime('now')),
+    page TEXT,
+    section TEXT,
+    caller TEXT,
+    duration_ms REAL,
+    rows INTEGER,
+    sql TEXT,
+    plan TEXT);
+
+CREATE TABLE IF NOT EXISTS rerun_metrics (
+    id INTEGER PRIMARY KEY,
+    logged_at TEXT DEFAULT (datetime('now')),
+    page TEXT,
+    queries INTEGER,
+    db_ms REAL,
+    format_ms REAL,
+    render_ms REAL,
+    total_ms REAL);
+CREATE INDEX IF NOT EXISTS idx_rerun_metrics_logged_at ON rerun_metrics(logged_at);
+
+CREATE TABLE IF NOT EXISTS write_batches (
+    id INTEGER PRIMARY KEY,
+    logged_at TEXT DEFAULT (datetime('now')),
+    jobs INTEGER,
+    failed INTEGER,
+    queue_depth INTEGER,    -- заданий в очереди после фиксации пачки
+    wait_ms REAL,           -- наибольшее ожидание задания пачки в очереди
+    commit_ms REAL);        -- выполнение пачки вместе с COMMIT
+CREATE INDEX IF NOT EXISTS idx_write_batches_logged_at ON write_batches(logged_at);
+'''
+
+# Модуль общий для всех сессий, а перезапуски сессий идут в разных потоках,
+# поэтому счётчики перезапуска хранятся отдельно для каждого потока
+_rerun_local = threading.local()
+
+def start_rerun(page=None, memo=True):
+    """
+    Обнуляет счётчики в начале перезапуска скрипта (или пакетной задачи), возвращает их.
+    memo — запоминать результаты чтения до конца перезапуска (см. ПАМЯТЬ ПЕРЕЗАПУСКА).
+    """
+    _rerun_local.state = {
+        "started": time.perf_counter(),
+        "page": page,
+        "section": None,
+        "queries": 0,
+        "repeats": 0,
+        "db_ms": 0.0,
+        "format_ms": 0.0,
+        "log": [],
+        "memo": {} if memo else None,
+        "memo_generation": None,
+    }
+    return _rerun_local.state
+
+def current_rerun():
+    """Счётчики текущего перезапуска этого потока (без start_rerun — скрипты и замеры — без памяти чтений)"""
+    state = getattr(_rerun_local, "state", None)
+    return state if state is not None else start_rerun(memo=False)
+
+def mark_section(name):
+    """Раздел страницы, к которому относятся следующие запросы"""
+    current_rerun()["section"] = name
+
+def get_metrics_pool():
+    """Пул соединений базы метрик (отдельный файл, чтобы не мешать записи в studio.db)"""
+    return _shared_pool(METRICS_DB_PATH, 2, setup=lambda conn: conn.executescript(METRICS_SCHEMA))
+
+def _save_metrics(sql, params):
+    # метрики не должны ломать приложение: ошибки записи в базу метрик игнорируются
+    try:
+        with get_metrics_pool().connection() as conn:
+            conn.execute(sql, params)
+            conn.commit()
+    except sqlite3.Error:
+        pass
+
+def _caller(depth=3):
+    frame = sys._getframe(depth)  # кто вызвал run_query
+    return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+def _record_query(conn, query, params, started, rows):
+    duration_ms = (time.perf_counter() - started) * 1000
+    rerun = current_rerun()
+    entry = {
+        "section": rerun["section"],
+        "caller": _caller(),
+        "duration_ms": duration_ms,
+        "rows": rows,
+        "sql": " ".join(query.split()),
+        "repeat_of": None,
+    }
+    rerun["queries"] += 1
+    rerun["db_ms"] += duration_ms
+    if len(rerun["log"]) < RERUN_QUERY_LOG_LIMIT:
+        rerun["log"].append(entry)
+    if duration_ms >= SLOW_QUERY_MS:
+        plan = "\n".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params))
+        _save_metrics('''
+            INSERT INTO slow_queries (page, section, caller, duration_ms, rows, sql, plan)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (rerun["page"], entry["section"], entry["caller"], duration_ms, rows, entry["sql"], plan))
+
+def _timed_formatting(func):
+    """Относит время векторного форматирования к format_ms перезапуска"""
+    @wraps(func)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_rerun()["format_ms"] += (time.perf_counter() - started) * 1000
+    return timed
+
+format_phone_series = _timed_formatting(format_phone_series)
+format_vk_link_series = _timed_formatting(format_vk_link_series)
+format_date_display_series = _timed_formatting(format_date_display_series)
+format_currency_series = _timed_formatting(format_currency_series)
+
+def finish_rerun():
+    """Итоги перезапуска: время отрисовки (всё, кроме БД и форматирования) и запись в rerun_metrics"""
+    rerun = current_rerun()
+    total_ms = (time.perf_counter() - rerun["started"]) * 1000
+    rerun["total_ms"] = total_ms
+    rerun["render_ms"] = max(total_ms - rerun["db_ms"] - rerun["format_ms"], 0.0)
+    _save_metrics('''
+        INSERT INTO rerun_metrics (page, queries, db_ms, format_ms, render_ms, total_ms)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (rerun["page"], rerun["queries"], rerun["db_ms"], rerun["format_ms"], rerun["render_ms"], total_ms))
+    return rerun
+
+def page_percentiles(weeks=8):
+    """p50/p90/p99 полного времени перезапуска по страницам и неделям"""
+    with get_metrics_pool().connection() as conn:
+        df = pd.read_sql_query(
+            "SELECT logged_at, page, total_ms FROM rerun_metrics WHERE logged_at >= datetime('now', ?)",
+            conn, params=(f"-{7 * weeks} days",),
+        )
+    if df.empty:
+        return pd.DataFrame(columns=["page", "week", "reruns", "p50_ms", "p90_ms", "p99_ms"])
+    df["week"] = pd.to_datetime(df["logged_at"]).dt.strftime("%G-W%V")
+    grouped = df.groupby(["page", "week"])["total_ms"]
+    return pd.DataFrame({
+        "reruns": grouped.size(),
+        "p50_ms": grouped.quantile(0.5),
+        "p90_ms": grouped.quantile(0.9),
+        "p99_ms": grouped.quantile(0.99),
+    }).reset_index().sort_values(["page", "week"], ascending=[True, False])
+
+def recent_slow_queries(limit=20):
+    """Последние записи журнала медленных запросов"""
+    with get_metrics_pool().connection() as conn:
+        return pd.read_sql_query(
+            "SELECT logged_at, page, section, caller, duration_ms, rows, sql, plan FROM slow_queries ORDER BY id DESC LIMIT ?",
+            conn, params=(limit,),
+        )
+
+# --- ОЧЕРЕДЬ ЗАПИСИ ---
+# Всю запись в базу процесс ведёт одним фоновым потоком на одном соединении: сессии ставят задания
+# func(conn) в очередь и ждут результата. Поток забирает всё, что накопилось (до WRITE_BATCH_MAX),
+# и фиксирует пачку одной транзакцией; каждое задание выполняется в своей точке сохранения,
+# поэтому ошибка одного задания откатывает только его. Сессии не спорят за блокировку записи,
+# а в режиме WAL чтение отчётов не мешает записи. Итоги каждой пачки пишутся в write_batches.
+WRITE_QUEUE_SIZE = 256       # заданий в очереди; при полной очереди новое задание ждёт места
+WRITE_QUEUE_TIMEOUT = 30     # сколько секунд ждать места в очереди, потом — ошибка «очередь переполнена»
+WRITE_BATCH_MAX = 64         # заданий в одной транзакции
+
+class WriteQueue:
+    """Фоновый поток записи базы пула pool"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._jobs = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._conn = None
+        self._thread = threading.Thread(target=self._run, name=f"studio-writer:{pool.path}", daemon=True)
+        self._thread.start()
+
+    def submit(self, func):
+        """Выполняет func(conn) в потоке записи и возвращает её результат (ошибку — пробрасывает)"""
+        if threading.current_thread() is self._thread:
+            return func(self._conn)  # запись изнутри задания — в его же транзакции
+        job = Future()
+        try:
+            self._jobs.put((func, job, time.perf_counter()), timeout=WRITE_QUEUE_TIMEOUT)
+        except queue.Full:
+            raise sqlite3.OperationalError("очередь записи переполнена, повторите позже") from None
+        return job.result()
+
+    def depth(self):
+        """Заданий в очереди сейчас"""
+        return self._jobs.qsize()
+
+    def _next_batch(self):
+        batch = [self._jobs.get()]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            try:
+                with self.pool.connection() as conn:
+                    self._conn = conn
+                    while True:
+                        self._commit(conn, self._next_batch())
+            except Exception as e:
+                # соединение не получено: ожидающие задания получают ошибку, следующая пачка пробует снова
+                for _, job, _ in self._next_batch():
+                    job.set_exception(e)
+
+    def _commit(self, conn, batch):
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for func, job, _ in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    outcomes.append((job, func(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    outcomes.append((job, None, e))
+                conn.execute("RELEASE job")
+            conn.commit()
+        except Exception as e:
+            # транзакция пачки не зафиксирована — ошибку получают все её задания
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(job, None, e) for _, job, _ in batch]
+        finished = time.perf_counter()
+        # слушатели — до результатов заданий: записавшая сессия сразу видит, что данные изменились
+        if any(error is None for _, _, error in outcomes):
+            for callback in _WRITE_LISTENERS:
+                callback(self.pool.path)
+        for job, result, error in outcomes:
+            if error is None:
+                job.set_result(result)
+            else:
+                job.set_exception(error)
+        _save_metrics('''
+            INSERT INTO write_batches (jobs, failed, queue_depth, wait_ms, commit_ms)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (len(batch), sum(error is not None for _, _, error in outcomes), self.depth(),
+              (started - min(enqueued for _, _, enqueued in batch)) * 1000, (finished - started) * 1000))
+
+_WRITERS = {}
+_WRITERS_LOCK = threading.Lock()
+_WRITE_LISTENERS = []
+
+def on_write(callback):
+    """
+    Регистрирует callback(путь базы), который поток записи вызывает после каждой зафиксированной пачки,
+    до того как её задания получат результат
+    """
+    _WRITE_LISTENERS.append(callback)
+
+def get_writer():
+    """Очередь записи базы DB_PATH, общая на процесс"""
+    with _WRITERS_LOCK:
+        writer = _WRITERS.get(DB_PATH)
+        if writer is None:
+            writer = _WRITERS[DB_PATH] = WriteQueue(get_pool())
+        return writer
+
+def queued_write(func):
+    """
+    Декоратор единицы работы func(conn, ...): выполняется в очереди записи, целиком применяется
+    или целиком откатывается. Вызывающий передаёт аргументы без conn и получает результат func.
+    """
+    @wraps(func)
+    def write(*args, **kwargs):
+        return get_writer().submit(lambda conn: func(conn, *args, **kwargs))
+    return write
+
+def write_queue_stats(hours=24):
+    """Пачки записи за последние hours часов: задания, ошибки и перцентили ожидания и фиксации"""
+    with get_metrics_pool().connection() as conn:
+        df = pd.read_sql_query(
+            "SELECT jobs, failed, queue_depth, wait_ms, commit_ms FROM write_batches WHERE logged_at >= datetime('now', ?)",
+            conn, params=(f"-{hours} hours",),
+        )
+    df = df.fillna(0)
+    return {
+        "batches": len(df),
+        "jobs": int(df["jobs"].sum()),
+        "failed": int(df["failed"].sum()),
+        "max_depth": int(df["queue_depth"].max()) if len(df) else 0,
+        "wait_p50_ms": float(df["wait_ms"].quantile(0.5)) if len(df) else 0.0,
+        "wait_p99_ms": float(df["wait_ms"].quantile(0.99)) if len(df) else 0.0,
+        "commit_p50_ms": float(df["commit_ms"].quantile(0.5)) if len(df) else 0.0,
+        "commit_p99_ms": float(df["commit_ms"].quantile(0.99)) if len(df) else 0.0,
+    }
+
+# --- ПАМЯТЬ ПЕРЕЗАПУСКА ---
+# Одинаковое чтение (тот же SQL и параметры) за один перезапуск скрипта выполняется один раз:
+# run_query запоминает результат в счётчиках перезапуска и на повтор отдаёт копию, отмечая повтор
+# в журнале запросов (repeat_of — где было первое чтение). Память пропадает с концом перезапуска
+# и после любой записи в базу процесса, в том числе из других сессий.
+_WRITE_GENERATION = 0
+
+def _count_write(path):
+    global _WRITE_GENERATION
+    _WRITE_GENERATION += 1
+
+on_write(_count_write)
+
+def _rerun_memo():
+    """Память чтений текущего перезапуска (None — отключена); после записи начинается заново"""
+    rerun = current_rerun()
+    if rerun["memo"] is not None and rerun["memo_generation"] != _WRITE_GENERATION:
+        rerun["memo"].clear()
+        rerun["memo_generation"] = _WRITE_GENERATION
+    return rerun["memo"]
+
+def _memo_key(query, params):
+    """Ключ памяти чтений; None — параметры не хешируются, и такое чтение не запоминается"""
+    bindings = tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params)
+    try:
+        hash(bindings)
+    except TypeError:
+        return None
+    return DB_PATH, query, bindings
+
+def _record_repeat(query, first_caller, rows):
+    rerun = current_rerun()
+    rerun["repeats"] += 1
+    if len(rerun["log"]) < RERUN_QUERY_LOG_LIMIT:
+        rerun["log"].append({
+            "section": rerun["section"],
+            "caller": _caller(),
+            "duration_ms": 0.0,
+            "rows": rows,
+            "sql": " ".join(query.split()),
+            "repeat_of": first_caller,
+        })
+
+# --- КЭШ ЧТЕНИЯ ---
+# У каждой таблицы есть счётчик версий в table_versions, который триггеры увеличивают при любой
+# записи (из очереди записи или внешнего скрипта). Кэшированное чтение объявляет
+# таблицы, от которых зависит, и версии этих таблиц входят в ключ кэша: запись в groups
+# не сбрасывает кэш отчётов, а устаревшие записи вытесняются из LRU.
+VERSIONED_TABLES = ("groups", "clients", "services_catalog", "orders", "order_items")
+CACHE_MAX_ENTRIES = 128      # записей на одну кэшированную функцию
+
+def _table_versions_schema():
+    """SQL миграции: таблица версий и триггеры, увеличивающие версию при записи"""
+    parts = ['''
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+    INSERT OR IGNORE INTO table_versions (name) VALUES ('revenue_rollup');
+    ''']
+    for table in VERSIONED_TABLES:
+        parts.append(f"    INSERT OR IGNORE INTO table_versions (name) VALUES ('{table}');")
+        for event, suffix in (("INSERT", "ai"), ("UPDATE", "au"), ("DELETE", "ad")):
+            parts.append(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{suffix} AFTER {event} ON {table}
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+    END;''')
+    return "\n".join(parts)
+
+def table_versions(tables):
+    """Текущие версии указанных таблиц"""
+    with get_pool().connection() as conn:
+        versions = dict(conn.execute("SELECT name, version FROM table_versions"))
+    return tuple(versions.get(table, 0) for table in tables)
+
+# Внутри кэшируемого чтения run_query не глотает ошибку, а пробрасывает её: иначе пустой результат
+# неудачного запроса (например, «database is locked») остался бы в кэше до следующей записи.
+_CACHED_READ = threading.local()
+
+def cached_read(*tables):
+    """
+    Декоратор чтения: LRU-кэш процесса, в ключ которого входят база и версии таблиц tables.
+    Вызывающий получает копию результата и может менять её на месте.
+    Результат с ошибкой БД не кэшируется. .clear() сбрасывает кэш только этой функции.
+    """
+    def decorate(func):
+        @lru_cache(maxsize=CACHE_MAX_ENTRIES)
+        def versioned(db_path, versions, *args, **kwargs):
+            _CACHED_READ.depth = getattr(_CACHED_READ, "depth", 0) + 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _CACHED_READ.depth -= 1
+
+        @wraps(func)
+        def read(*args, **kwargs):
+            try:
+                return copy.copy(versioned(DB_PATH, table_versions(tables), *args, **kwargs))  # DataFrame копируется целиком
+            except Exception:
+                # повтор без кэша: при той же ошибке run_query сообщит о ней и вернёт пустой результат
+                return func(*args, **kwargs)
+        read.clear = versioned.cache_clear
+        return read
+    return decorate
+
+# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
+@cached_read("groups")
+def load_groups():
+    return run_query("SELECT id, name FROM groups ORDER BY id DESC", fetch=True)
+
+# --- АГРЕГАТЫ ВЫРУЧКИ ---
+# revenue_rollup хранит помесячные итоги оплат в разрезе группа / клиент / услуга.
+# Таблица поддерживается триггерами на order_items, orders и clients,
+# rebuild_rollups() пересобирает её с нуля.
+# Услуга в ключе — service_id (0 — услуга не из прайс-листа); до миграции 13 ключом был текст service.
+_ROLLUP_AGGREGATE = '''
+    INSERT INTO revenue_rollup
+        (year, month, group_id, client_id, service_id, items_count, amount_sum, amount_min, amount_max, hours_sum)
+    SELECT year, month, group_id, client_id, service_id,
+           COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+    FROM paid_items
+    WHERE {where}
+    GROUP BY year, month, group_id, client_id, service_id;
+'''
+
+def _rollup_refresh_bucket(row):
+    """SQL для триггера: пересчёт ячейки агрегата, в которую попадает строка order_items (OLD или NEW)"""
+    key = (
+        f"year = CAST(strftime('%Y', {row}.payment_date) AS INTEGER) "
+        f"AND month = CAST(strftime('%m', {row}.payment_date) AS INTEGER) "
+        f"AND client_id = (SELECT client_id FROM orders WHERE id = {row}.order_id) "
+        f"AND service_id = COALESCE({row}.service_id, 0)"
+    )
+    return f"DELETE FROM revenue_rollup WHERE {key};" + _ROLLUP_AGGREGATE.format(where=key)
+
+def _rollup_refresh_clients(where):
+    """SQL для триггера: пересчёт всех ячеек агрегата указанных клиентов"""
+    return f"DELETE FROM revenue_rollup WHERE {where};" + _ROLLUP_AGGREGATE.format(where=where)
+
+def _rollup_triggers():
+    """SQL миграции: триггеры агрегата на order_items и orders"""
+    return f'''
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_rollup_ai AFTER INSERT ON order_items
+    WHEN NEW.payment_date IS NOT NULL
+    BEGIN
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service_id, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service_id, 1, amount, amount, amount, COALESCE(hours, 0)
+        FROM paid_items WHERE item_id = NEW.id
+        ON CONFLICT (year, month, group_id, client_id, service_id) DO UPDATE SET
+            items_count = items_count + 1,
+            amount_sum = amount_sum + excluded.amount_sum,
+            amount_min = MIN(amount_min, excluded.amount_min),
+            amount_max = MAX(amount_max, excluded.amount_max),
+            hours_sum = hours_sum + excluded.hours_sum;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_rollup_au
+    AFTER UPDATE OF order_id, service_id, payment_date, amount, hours ON order_items
+    BEGIN
+        {_rollup_refresh_bucket("OLD")}
+        {_rollup_refresh_bucket("NEW")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_rollup_ad AFTER DELETE ON order_items
+    BEGIN
+        {_rollup_refresh_bucket("OLD")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_au AFTER UPDATE OF client_id ON orders
+    WHEN OLD.client_id IS NOT NEW.client_id
+    BEGIN
+        {_rollup_refresh_clients("client_id IN (OLD.client_id, NEW.client_id)")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_ad AFTER DELETE ON orders
+    BEGIN
+        {_rollup_refresh_clients("client_id = OLD.client_id")}
+    END;
+'''
+
+# --- ПОЛНОТЕКСТОВЫЙ ПОИСК КЛИЕНТОВ ---
+# clients_fts (триграммы) ищет подстроку от 3 символов, clients_prefix_fts — начало слова для 1-2 символов.
+# Обе таблицы внешние (content='clients') и синхронизируются триггерами.
+CLIENT_FTS_TABLES = {
+    "clients_fts": "tokenize='trigram'",
+    "clients_prefix_fts": "tokenize='unicode61 remove_diacritics 2', prefix='1 2'",
+}
+_CLIENT_FTS_COLUMNS = "name, phone, vk_id, tg_id"
+
+def _client_fts_schema():
+    """SQL миграции: FTS-таблицы по clients, триггеры синхронизации и первичное наполнение"""
+    parts = []
+    for table, options in CLIENT_FTS_TABLES.items():
+        parts.append(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+        {_CLIENT_FTS_COLUMNS}, content='clients', content_rowid='id', {options});
+
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_ai AFTER INSERT ON clients
+    BEGIN
+        INSERT INTO {table}(rowid, {_CLIENT_FTS_COLUMNS})
+        VALUES (NEW.id, NEW.name, NEW.phone, NEW.vk_id, NEW.tg_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_ad AFTER DELETE ON clients
+    BEGIN
+        INSERT INTO {table}({table}, rowid, {_CLIENT_FTS_COLUMNS})
+        VALUES ('delete', OLD.id, OLD.name, OLD.phone, OLD.vk_id, OLD.tg_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_au AFTER UPDATE OF {_CLIENT_FTS_COLUMNS} ON clients
+    BEGIN
+        INSERT INTO {table}({table}, rowid, {_CLIENT_FTS_COLUMNS})
+        VALUES ('delete', OLD.id, OLD.name, OLD.phone, OLD.vk_id, OLD.tg_id);
+        INSERT INTO {table}(rowid, {_CLIENT_FTS_COLUMNS})
+        VALUES (NEW.id, NEW.name, NEW.phone, NEW.vk_id, NEW.tg_id);
+    END;
+
+    INSERT INTO {table}({table}) VALUES ('rebuild');
+    ''')
+    return "".join(parts)
+
+# --- КОНТАКТНЫЕ КЛЮЧИ ---
+# Нормализованные телефон / VK / Telegram клиента для поиска дублей.
+# Выражения чисто SQL-ные: они задают генерируемые колонки clients.*_norm и
+# ими же нормализуется введённое значение при проверке, поэтому правила не расходятся.
+def _strip_all(expr, *parts):
+    for part in parts:
+        expr = f"replace({expr}, '{part}', '')"
+    return expr
+
+def _phone_key_sql(arg):
+    """7XXXXXXXXXX из телефона в любом формате; NULL, если там не только цифры и разделители"""
+    d = _strip_all(f"trim({arg})", " ", "-", "(", ")", "+", ".")
+    return (
+        f"(CASE WHEN {d} = '' OR {d} GLOB '*[^0-9]*' THEN NULL "
+        f"WHEN length({d}) = 11 AND {d} GLOB '8*' THEN '7' || substr({d}, 2) "
+        f"WHEN length({d}) = 10 THEN '7' || {d} "
+        f"ELSE {d} END)"
+    )
+
+def _vk_key_sql(arg):
+    """Ник VK без ссылки и @, в нижнем регистре; числовой id приводится к idNNN"""
+    v = f"rtrim(ltrim({_strip_all(f'lower(trim({arg}))', 'https://', 'http://', 'www.', 'm.vk.com/', 'vk.com/')}, '@'), '/')"
+    return f"(CASE WHEN {v} = '' THEN NULL WHEN {v} NOT GLOB '*[^0-9]*' THEN 'id' || {v} ELSE {v} END)"
+
+def _tg_key_sql(arg):
+    """Ник Telegram без ссылки и @, в нижнем регистре"""
+    t = f"rtrim(ltrim({_strip_all(f'lower(trim({arg}))', 'https://', 'http://', 'www.', 'telegram.me/', 't.me/')}, '@'), '/')"
+    return f"(CASE WHEN {t} = '' THEN NULL ELSE {t} END)"
+
+# --- СТАТИСТИКА КЛИЕНТОВ ---
+# client_stats — итоги клиента за всё время: выручка, число оплат и часы по оплаченным услугам
+# (как в paid_items), дата последней оплаты и число заказов «Ожидает оплаты». Добавление услуги
+# или заказа меняет строку на разницу, изменение и удаление пересчитывают строку клиента
+# по его заказам (по индексам, без обхода журнала). Миграция 12.
+CLIENT_STATS_FIELDS = ("revenue", "payments", "hours", "last_payment", "open_orders")
+AWAITING_PAYMENT = "Ожидает оплаты"
+
+_PAID_ITEM = "{row}.payment_date IS NOT NULL AND strftime('%Y', {row}.payment_date) IS NOT NULL"
+
+_CLIENT_STATS_AGGREGATE = f'''
+    SELECT c.id AS client_id,
+           COALESCE(SUM(oi.amount), 0) AS revenue,
+           COUNT(oi.id) AS payments,
+           COALESCE(SUM(oi.hours), 0) AS hours,
+           MAX(oi.payment_date) AS last_payment,
+           (SELECT COUNT(*) FROM orders WHERE client_id = c.id AND status = '{AWAITING_PAYMENT}') AS open_orders
+    FROM clients c
+    LEFT JOIN orders o ON o.client_id = c.id
+    LEFT JOIN order_items oi ON oi.order_id = o.id AND {_PAID_ITEM.format(row="oi")}
+    WHERE {{where}}
+    GROUP BY c.id
+'''
+
+def _client_stats_refresh(client):
+    """SQL для триггера: пересчёт строки client_stats клиента"""
+    return f'''
+        INSERT OR REPLACE INTO client_stats (client_id, {", ".join(CLIENT_STATS_FIELDS)})
+        {_CLIENT_STATS_AGGREGATE.format(where=f"c.id = {client}")};
+    '''
+
+def _client_stats_schema():
+    """SQL миграции: таблица client_stats, индексы сортировок, триггеры и первичное наполнение"""
+    return f'''
+    CREATE TABLE IF NOT EXISTS client_stats (
+        client_id INTEGER PRIMARY KEY,
+        revenue REAL NOT NULL DEFAULT 0,
+        payments INTEGER NOT NULL DEFAULT 0,
+        hours REAL NOT NULL DEFAULT 0,
+        last_payment DATE,
+        open_orders INTEGER NOT NULL DEFAULT 0,
+        avg_check REAL GENERATED ALWAYS AS (CASE WHEN payments > 0 THEN revenue / payments ELSE 0 END) VIRTUAL
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_client_stats_revenue ON client_stats(revenue, client_id);
+    CREATE INDEX IF NOT EXISTS idx_client_stats_payments ON client_stats(payments, client_id);
+    CREATE INDEX IF NOT EXISTS idx_client_stats_last_payment ON client_stats(COALESCE(last_payment, ''), client_id);
+    CREATE INDEX IF NOT EXISTS idx_client_stats_open_orders ON client_stats(open_orders, client_id);
+    CREATE INDEX IF NOT EXISTS idx_client_stats_avg_check ON client_stats(avg_check, client_id);
+
+    CREATE TRIGGER IF NOT EXISTS trg_clients_stats_ai AFTER INSERT ON clients
+    BEGIN
+        INSERT OR IGNORE INTO client_stats (client_id) VALUES (NEW.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_clients_stats_ad AFTER DELETE ON clients
+    BEGIN
+        DELETE FROM client_stats WHERE client_id = OLD.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_stats_ai AFTER INSERT ON order_items
+    WHEN {_PAID_ITEM.format(row="NEW")}
+    BEGIN
+        UPDATE client_stats SET
+            revenue = revenue + COALESCE(NEW.amount, 0),
+            payments = payments + 1,
+            hours = hours + COALESCE(NEW.hours, 0),
+            last_payment = CASE WHEN last_payment IS NULL OR NEW.payment_date > last_payment
+                                THEN NEW.payment_date ELSE last_payment END
+        WHERE client_id = (SELECT client_id FROM orders WHERE id = NEW.order_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_stats_au
+    AFTER UPDATE OF order_id, payment_date, amount, hours ON order_items
+    BEGIN
+        {_client_stats_refresh("(SELECT client_id FROM orders WHERE id = OLD.order_id)")}
+        {_client_stats_refresh("(SELECT client_id FROM orders WHERE id = NEW.order_id)")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_stats_ad AFTER DELETE ON order_items
+    BEGIN
+        {_client_stats_refresh("(SELECT client_id FROM orders WHERE id = OLD.order_id)")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_stats_ai AFTER INSERT ON orders
+    WHEN NEW.status = '{AWAITING_PAYMENT}'
+    BEGIN
+        UPDATE client_stats SET open_orders = open_orders + 1 WHERE client_id = NEW.client_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_stats_au AFTER UPDATE OF client_id, status ON orders
+    WHEN OLD.client_id IS NOT NEW.client_id OR OLD.status IS NOT NEW.status
+    BEGIN
+        {_client_stats_refresh("OLD.client_id")}
+        {_client_stats_refresh("NEW.client_id")}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_stats_ad AFTER DELETE ON orders
+    BEGIN
+        {_client_stats_refresh("OLD.client_id")}
+    END;
+
+    DELETE FROM client_stats;
+    INSERT INTO client_stats (client_id, {", ".join(CLIENT_STATS_FIELDS)})
+    {_CLIENT_STATS_AGGREGATE.format(where="1")};
+    '''
+
+def _client_stats_check(field):
+    """Проверка поля client_stats для DERIVED_FIELD_CHECKS"""
+    differs = (f"abs(s.{field} - e.{field}) > 0.005" if field in ("revenue", "hours")
+               else f"s.{field} IS NOT e.{field}")
+    return {
+        "check": f'''
+            SELECT s.client_id AS row_id, s.{field} AS stored, e.{field} AS expected
+            FROM client_stats s
+            JOIN ({_CLIENT_STATS_AGGREGATE.format(where="1")}) e ON e.client_id = s.client_id
+            WHERE {differs}
+        ''',
+        "repair": f"UPDATE client_stats SET {field} = ? WHERE client_id = ?",
+    }
+
+# --- ПРОИЗВОДНЫЕ ПОЛЯ ---
+# orders.total_amount и clients.first_order_date ведут триггеры (миграция 8), client_stats — миграция 12.
+# Дата первой оплаты только вычисляется: MIN(payment_date) оплат клиента, без оплат — NULL.
+# DERIVED_FIELD_CHECKS находит расхождения с пересчётом «с нуля», repair_derived_fields() их исправляет.
+_FIRST_PAYMENT_SQL = '''
+    SELECT MIN(oi.payment_date)
+    FROM order_items oi
+    JOIN orders o ON oi.order_id = o.id
+    WHERE o.client_id = {client} AND NULLIF(oi.payment_date, '') IS NOT NULL
+'''
+
+def _first_payment_recompute(client):
+    """SQL для триггера: пересчёт даты первой оплаты клиента (если оплат не осталось — NULL)"""
+    return f'''
+        UPDATE clients
+        SET first_order_date = ({_FIRST_PAYMENT_SQL.format(client=client)})
+        WHERE id = {client};
+    '''
+
+DERIVED_FIELD_CHECKS = {
+    "orders.total_amount": {
+        "check": '''
+            SELECT o.id AS row_id, o.total_amount AS stored, COALESCE(t.total, 0) AS expected
+            FROM orders o
+            LEFT JOIN (SELECT order_id, SUM(amount) AS total FROM order_items GROUP BY order_id) t
+                ON t.order_id = o.id
+            WHERE abs(COALESCE(o.total_amount, 0) - COALESCE(t.total, 0)) > 0.005
+        ''',
+        "repair": "UPDATE orders SET total_amount = ? WHERE id = ?",
+    },
+    "clients.first_order_date": {
+        "check": '''
+            SELECT c.id AS row_id, c.first_order_date AS stored, f.first_payment AS expected
+            FROM clients c
+            LEFT JOIN (
+                SELECT o.client_id, MIN(oi.payment_date) AS first_payment
+                FROM order_items oi
+                JOIN orders o ON o.id = oi.order_id
+                WHERE NULLIF(oi.payment_date, '') IS NOT NULL
+                GROUP BY o.client_id
+            ) f ON f.client_id = c.id
+            WHERE c.first_order_date IS NOT f.first_payment
+        ''',
+        "repair": "UPDATE clients SET first_order_date = ? WHERE id = ?",
+    },
+    **{f"client_stats.{field}": _client_stats_check(field) for field in CLIENT_STATS_FIELDS},
+}
+
+# --- СНИМОК ОПЛАТ ---
+# Столбцовый снимок оплаченных услуг (строки paid_items), один на процесс и базу и общий для всех
+# сессий: даты — номера дней (int32), клиент и группа — коды словарей, услуга — service_id (0 — не из
+# прайс-листа), суммы и часы — float.
+# Обновление дочитывает строки с order_items.id больше последнего виденного, а изменённые и удалённые
+# строки берёт из журнала ledger_changes, который ведут триггеры (миграция 11).
+# Снимок после сборки не меняется: обновление собирает новый, и уже выданный остаётся согласованным.
+LEDGER_CHANGES_KEEP = 100000   # сколько последних изменений хранит журнал; отставший снимок читается заново
+
+_LEDGER_ROWS_SQL = '''
+    SELECT item_id, client_id, service_id,
+           CAST(julianday(payment_date) - 2440587.5 AS INTEGER) AS day,
+           amount, hours
+    FROM paid_items
+    WHERE {where}
+'''
+
+def _ledger_changes_schema():
+    """SQL миграции: журнал изменённых и удалённых строк order_items"""
+    return f'''
+    CREATE TABLE IF NOT EXISTS ledger_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_id INTEGER NOT NULL);
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_ledger_au
+    AFTER UPDATE OF id, order_id, service_name, payment_date, amount, hours ON order_items
+    BEGIN
+        INSERT INTO ledger_changes (item_id) VALUES (NEW.id);
+        INSERT INTO ledger_changes (item_id) SELECT OLD.id WHERE OLD.id IS NOT NEW.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_ledger_ad AFTER DELETE ON order_items
+    BEGIN
+        INSERT INTO ledger_changes (item_id) VALUES (OLD.id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_ledger_au AFTER UPDATE OF client_id ON orders
+    WHEN OLD.client_id IS NOT NEW.client_id
+    BEGIN
+        INSERT INTO ledger_changes (item_id) SELECT id FROM order_items WHERE order_id = NEW.id;
+    END;
+
+    -- без каскада строки удалённых заказов и клиентов пропадают из paid_items, оставаясь в order_items
+    CREATE TRIGGER IF NOT EXISTS trg_orders_ledger_ad AFTER DELETE ON orders
+    BEGIN
+        INSERT INTO ledger_changes (item_id) SELECT id FROM order_items WHERE order_id = OLD.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_clients_ledger_ad AFTER DELETE ON clients
+    BEGIN
+        INSERT INTO ledger_changes (item_id)
+        SELECT oi.id FROM order_items oi JOIN orders o ON o.id = oi.order_id WHERE o.client_id = OLD.id;
+    END;
+
+    -- раз в 1000 записей журнал обрезается до LEDGER_CHANGES_KEEP последних
+    CREATE TRIGGER IF NOT EXISTS trg_ledger_changes_trim AFTER INSERT ON ledger_changes
+    WHEN NEW.seq % 1000 = 0
+    BEGIN
+        DELETE FROM ledger_changes WHERE seq <= NEW.seq - {LEDGER_CHANGES_KEEP};
+    END;
+    '''
+
+_LEDGERS = {}
+_LEDGER_LOCK = threading.Lock()
+
+def _fetch_frame(conn, sql, params=()):
+    """Чтение на уже открытом соединении (учитывается в метриках, как run_query)"""
+    started = time.perf_counter()
+    cursor = conn.execute(sql, params)
+    rows = cursor.fetchall()
+    _record_query(conn, sql, params, started, len(rows))
+    return pd.DataFrame(rows, columns=[description[0] for description in cursor.description])
+
+def _encode(dictionary, values):
+    """Коды values в словаре dictionary; новые значения дописываются в конец, коды старых не меняются"""
+    codes = pd.Index(dictionary).get_indexer(values)
+    missing = codes < 0
+    if missing.any():
+        dictionary = np.concatenate((dictionary, pd.unique(values[missing])))
+        codes[missing] = pd.Index(dictionary).get_indexer(values[missing])
+    return dictionary, codes.astype(np.int32)
+
+def _ledger_dimensions(conn, ledger):
+    """Справочники клиентов, групп и услуг: имена по кодам (услуг — по id) и код группы каждого клиента"""
+    clients = _fetch_frame(conn, "SELECT id, name, COALESCE(group_id, 0) AS group_id FROM clients")
+    groups = _fetch_frame(conn, "SELECT id, name FROM groups")
+    services = _fetch_frame(conn, "SELECT id, name FROM services_catalog")
+    group_ids, _ = _encode(ledger["group_ids"], np.concatenate(([0], groups["id"].to_numpy(np.int64))))
+    group_ids, client_group = _encode(group_ids, clients["group_id"].to_numpy(np.int64))
+    client_ids, _ = _encode(ledger["client_ids"], clients["id"].to_numpy(np.int64))
+    # группа 0 («без группы») имени не получает: отчёты по группам её не показывают, как JOIN groups
+    ledger.update(
+        group_ids=group_ids,
+        group_names=groups.set_index("id")["name"].reindex(group_ids).to_numpy(object),
+        client_ids=client_ids,
+        client_names=clients.set_index("id")["name"].reindex(client_ids).to_numpy(object),
+        client_group=pd.Series(client_group, index=clients["id"]).reindex(client_ids, fill_value=0).to_numpy(np.int32),
+        service_names=services.set_index("id")["name"],
+    )
+
+def _ledger_columns(ledger, rows):
+    """Строки paid_items в столбцы снимка"""
+    client_ids, client = _encode(ledger["client_ids"], rows["client_id"].to_numpy(np.int64))
+    if len(client_ids) > len(ledger["client_ids"]):
+        raise sqlite3.DatabaseError("снимок оплат: клиент отсутствует в справочнике")
+    return {
+        "item_id": rows["item_id"].to_numpy(np.int64),
+        "day": rows["day"].to_numpy(np.int32),
+        "client": client,
+        "group": ledger["client_group"][client],
+        "service": rows["service_id"].to_numpy(np.int32),
+        "amount": rows["amount"].fillna(0.0).to_numpy(np.float64),
+        "hours": rows["hours"].fillna(0.0).to_numpy(np.float64),
+    }
+
+def _by_day(columns):
+    """Столбцы снимка, упорядоченные по дню оплаты: периоды отчётов берутся срезами"""
+    order = np.argsort(columns["day"], kind="stable")
+    return {name: values[order] for name, values in columns.items()}
+
+def _ledger_read_all(conn):
+    """
+    Все строки paid_items. Услуги читаются без соединения с заказами (вдвое быстрее на больших базах),
+    клиент подставляется по массиву заказов; строки без заказа или клиента отбрасываются, как в paid_items.
+    """
+    orders = _fetch_frame(conn, "SELECT o.id, o.client_id FROM orders o JOIN clients c ON c.id = o.client_id")
+    items = _fetch_frame(conn, '''
+        SELECT id AS item_id, order_id, COALESCE(service_id, 0) AS service_id,
+               CAST(julianday(payment_date) - 2440587.5 AS INTEGER) AS day,
+               amount, hours
+        FROM order_items
+        WHERE payment_date IS NOT NULL AND strftime('%Y', payment_date) IS NOT NULL
+    ''')
+    position = pd.Index(orders["id"]).get_indexer(items.pop("order_id"))
+    items = items[position >= 0]
+    items.insert(1, "client_id", orders["client_id"].to_numpy(np.int64)[position[position >= 0]])
+    return items
+
+def _ledger_read_items(conn, item_ids):
+    """Текущие строки paid_items для item_ids (удалённых и неоплаченных среди них нет)"""
+    return _fetch_frame(conn, _LEDGER_ROWS_SQL.format(where="item_id IN (SELECT value FROM json_each(?))"),
+                        (json.dumps(item_ids.tolist()),))
+
+def _ledger_refresh(conn, ledger):
+    """Снимок, доведённый до состояния базы; ledger (предыдущий снимок или None) не меняется"""
+    last_item = conn.execute("SELECT COALESCE(MAX(id), 0) FROM order_items").fetchone()[0]
+    last_change = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM ledger_changes").fetchone()[0]
+    first_change = conn.execute("SELECT MIN(seq) FROM ledger_changes").fetchone()[0]
+    versions = tuple(version for _, version in conn.execute(
+        "SELECT name, version FROM table_versions WHERE name IN ('clients', 'groups', 'services_catalog') ORDER BY name"))
+
+    # журнал обрезан дальше, чем снимок успел прочитать, — изменения потеряны, читаем всё заново
+    lagging = ledger is not None and first_change is not None and first_change > ledger["last_change"] + 1
+    if ledger is None or lagging:
+        fresh = {"client_ids": np.array([], np.int64), "group_ids": np.array([], np.int64)}
+        _ledger_dimensions(conn, fresh)
+        fresh.update(columns=_by_day(_ledger_columns(fresh, _ledger_read_all(conn))),
+                     last_item=last_item, last_change=last_change, versions=versions)
+        return fresh
+    if (last_item, last_change, versions) == (ledger["last_item"], ledger["last_change"], ledger["versions"]):
+        return ledger
+
+    ledger = dict(ledger)
+    columns = ledger["columns"]
+    if versions != ledger["versions"]:
+        _ledger_dimensions(conn, ledger)
+        columns = dict(columns, group=ledger["client_group"][columns["client"]])
+    # строки выше last_item приходят дочиткой целиком, журнал нужен только для уже виденных id
+    changed = np.unique(np.fromiter((item_id for (item_id,) in conn.execute(
+        "SELECT item_id FROM ledger_changes WHERE seq > ? AND item_id <= ?",
+        (ledger["last_change"], ledger["last_item"]))), np.int64))
+    if len(changed):
+        keep = ~np.isin(columns["item_id"], changed)
+        columns = {name: values[keep] for name, values in columns.items()}
+    frames = [_ledger_read_items(conn, changed),
+              _fetch_frame(conn, _LEDGER_ROWS_SQL.format(where="item_id > ?"), (ledger["last_item"],))]
+    frames = [frame for frame in frames if len(frame)]
+    if frames:
+        added = _ledger_columns(ledger, pd.concat(frames, ignore_index=True))
+        columns = _by_day({name: np.concatenate((values, added[name])) for name, values in columns.items()})
+    ledger.update(columns=columns, last_item=last_item, last_change=last_change, versions=versions)
+    return ledger
+
+def ledger_snapshot():
+    """Снимок оплат базы DB_PATH, доведённый до её текущего состояния (общий на процесс)"""
+    with _LEDGER_LOCK:
+        with get_pool().connection() as conn:
+            conn.execute("BEGIN")  # счётчики, справочники и строки читаются из одной версии базы
+            try:
+                ledger = _ledger_refresh(conn, _LEDGERS.get(DB_PATH))
+            finally:
+                conn.rollback()
+        _LEDGERS[DB_PATH] = ledger
+        return ledger
+
+def _day_number(value):
+    """Номер дня от 1970-01-01 для даты YYYY-MM-DD"""
+    return int(np.datetime64(value, "D").astype(np.int64))
+
+def _year_days(year):
+    """Первый день года и первый день следующего"""
+    return _day_number(f"{int(year):04d}-01-01"), _day_number(f"{int(year) + 1:04d}-01-01")
+
+def _ledger_months(day):
+    """Номера месяцев от января 1970 для номеров дней"""
+    return day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+def _ledger_rows(ledger, year=None, month=None, group=None, since=None):
+    """Столбцы строк снимка под параметры отчёта: период — срез по дню оплаты, месяц и группа — маска"""
+    columns = ledger["columns"]
+    start, stop = 0, len(columns["day"])
+    if year is not None:
+        start, stop = np.searchsorted(columns["day"], _year_days(year))
+    if since is not None:
+        start = max(start, np.searchsorted(columns["day"], _day_number(since)))
+    rows = {name: values[start:stop] for name, values in columns.items()}
+    mask = np.ones(stop - start, dtype=bool)
+    if month is not None:
+        mask &= _ledger_months(rows["day"]) % 12 + 1 == int(month)
+    if group is not None:
+        mask &= np.isin(rows["group"], np.flatnonzero(ledger["group_ids"] == int(group)))
+    if month is None and group is None:
+        return rows
+    return {name: values[mask] for name, values in rows.items()}
+
+def _ledger_totals(ledger, key, rows):
+    """Число оплат и сумма по кодам столбца key"""
+    size = len(ledger[f"{key}_ids"])
+    return (np.bincount(rows[key], minlength=size),
+            np.bincount(rows[key], weights=rows["amount"], minlength=size))
+
+def _snapshot_groups_by_year(ledger, **params):
+    counts, sums = _ledger_totals(ledger, "group", _ledger_rows(ledger, **params))
+    df = pd.DataFrame({"group_name": ledger["group_names"], "payments_count": counts, "total_sum": sums})
+    df = df[(df["payments_count"] > 0) & df["group_name"].notna()]
+    df["avg_sum"] = df["total_sum"] / df["payments_count"]
+    return df.sort_values("group_name").reset_index(drop=True)
+
+def _snapshot_clients(ledger, **params):
+    counts, sums = _ledger_totals(ledger, "client", _ledger_rows(ledger, **params))
+    df = pd.DataFrame({"client_name": ledger["client_names"], "payments_count": counts, "total_sum": sums})
+    df = df[df["payments_count"] > 0]
+    return df.sort_values("total_sum", ascending=False, kind="stable").reset_index(drop=True)
+
+def _snapshot_services(ledger, **params):
+    rows = _ledger_rows(ledger, **params)
+    counts = np.bincount(rows["service"])
+    df = pd.DataFrame({
+        "service_id": np.arange(len(counts)),
+        "payments_count": counts,
+        "total_sum": np.bincount(rows["service"], weights=rows["amount"], minlength=len(counts)),
+        "total_hours": np.bincount(rows["service"], weights=rows["hours"], minlength=len(counts)),
+    })[counts > 0]
+    # названия — только для показа: услуга без id или удалённая из прайс-листа получает общую подпись
+    names = ledger["service_names"].reindex(df["service_id"]).fillna(UNLISTED_SERVICE)
+    df.insert(1, "service_name", names.to_numpy(object))
+    return df.sort_values("total_sum", ascending=False, kind="stable").reset_index(drop=True)
+
+def _snapshot_years_summary(ledger):
+    day, amount = ledger["columns"]["day"], ledger["columns"]["amount"]
+    summary = []
+    if len(day):
+        first, last = _ledger_months(day[[0, -1]]) // 12 + 1970
+        for year in range(first, last + 1):
+            start, stop = np.searchsorted(day, _year_days(year))
+            if stop > start:
+                paid = amount[start:stop]
+                summary.append((year, stop - start, paid.max(), paid.min(), paid.sum() / (stop - start), paid.sum()))
+    return pd.DataFrame(summary, columns=["year", "Количество_оплат", "Макс_оплата", "Мин_оплата",
+                                          "Средняя_оплата", "Сумма_год"])
+
+def _snapshot_months_of_year(ledger, **params):
+    rows = _ledger_rows(ledger, **params)
+    month = _ledger_months(rows["day"]) % 12 + 1
+    counts = np.bincount(month, minlength=13)
+    sums = np.bincount(month, weights=rows["amount"], minlength=13)
+    df = pd.DataFrame({"month": np.arange(13), "Количество_оплат": counts, "Сумма": sums})[counts > 0]
+    df.insert(2, "Средняя_оплата", df["Сумма"] / df["Количество_оплат"])
+    return df.reset_index(drop=True)
+
+def _snapshot_last_week(ledger, **params):
+    rows = _ledger_rows(ledger, **params)
+    df = pd.DataFrame({
+        "name": ledger["client_names"][rows["client"]],
+        "day": rows["day"],
+        "total_amount": rows["amount"],
+    })
+    df = df.groupby(["name", "day"], as_index=False)["total_amount"].sum()
+    df = df.sort_values(["day", "name"], ascending=[False, True]).reset_index(drop=True)
+    df.insert(1, "payment_date", np.datetime_as_string(df.pop("day").to_numpy().astype("datetime64[D]")))
+    return df
+
+# --- УСЛУГИ ЗАКАЗОВ ---
+# Услуга заказа ссылается на прайс-лист через order_items.service_id: переименование услуги
+# не отрывает от неё историю, а отчёты группируют по целым ключам и берут названия только для показа.
+# Исходный текст service_name не стирается, но читается только у строк без service_id (старые данные,
+# импорт): их перечисляет load_unmatched_services(), а link_service_name() привязывает к услуге.
+UNLISTED_SERVICE = "Не из прайс-листа"
+
+def _service_ids_schema():
+    """SQL миграции: service_id по совпадению названия, агрегат и журнал снимка — по service_id"""
+    return f'''
+    -- триггеры агрегата и журнала снимка завязаны на текст услуги: снимаются до заполнения и ставятся заново
+    DROP TRIGGER IF EXISTS trg_order_items_rollup_ai;
+    DROP TRIGGER IF EXISTS trg_order_items_rollup_au;
+    DROP TRIGGER IF EXISTS trg_order_items_rollup_ad;
+    DROP TRIGGER IF EXISTS trg_orders_rollup_au;
+    DROP TRIGGER IF EXISTS trg_orders_rollup_ad;
+    DROP TRIGGER IF EXISTS trg_order_items_ledger_au;
+
+    ALTER TABLE order_items ADD COLUMN service_id INTEGER REFERENCES services_catalog(id);
+    CREATE INDEX IF NOT EXISTS idx_services_catalog_name ON services_catalog(name);
+
+    -- из одинаковых названий в прайс-листе берётся первая услуга
+    CREATE TEMP TABLE service_keys AS
+    SELECT name, MIN(id) AS id FROM services_catalog WHERE name != '' GROUP BY name;
+
+    UPDATE order_items SET service_id = k.id
+    FROM service_keys k
+    WHERE k.name = order_items.service_name;
+
+    CREATE INDEX IF NOT EXISTS idx_order_items_service_id ON order_items(service_id);
+
+    -- агрегат по тексту уже точен: ключ переводится в id той же заменой и сворачивается заново,
+    -- без повторного прохода по order_items
+    CREATE TEMP TABLE rollup_by_id AS
+    SELECT r.year, r.month, r.group_id, r.client_id, COALESCE(k.id, 0) AS service_id,
+           SUM(r.items_count) AS items_count, SUM(r.amount_sum) AS amount_sum,
+           MIN(r.amount_min) AS amount_min, MAX(r.amount_max) AS amount_max, SUM(r.hours_sum) AS hours_sum
+    FROM revenue_rollup r
+    LEFT JOIN service_keys k ON k.name = r.service
+    GROUP BY r.year, r.month, r.group_id, r.client_id, COALESCE(k.id, 0);
+
+    DROP VIEW IF EXISTS paid_items;
+    CREATE VIEW paid_items AS
+    SELECT
+        oi.id AS item_id,
+        oi.order_id,
+        o.client_id,
+        COALESCE(c.group_id, 0) AS group_id,
+        COALESCE(oi.service_id, 0) AS service_id,
+        oi.payment_date,
+        CAST(strftime('%Y', oi.payment_date) AS INTEGER) AS year,
+        CAST(strftime('%m', oi.payment_date) AS INTEGER) AS month,
+        oi.amount,
+        oi.hours
+    FROM order_items oi
+    JOIN orders o ON oi.order_id = o.id
+    JOIN clients c ON o.client_id = c.id
+    WHERE oi.payment_date IS NOT NULL AND strftime('%Y', oi.payment_date) IS NOT NULL;
+
+    DROP TABLE revenue_rollup;
+    CREATE TABLE revenue_rollup (
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        group_id INTEGER NOT NULL,      -- 0 = без группы
+        client_id INTEGER NOT NULL,
+        service_id INTEGER NOT NULL,    -- 0 = не из прайс-листа
+        items_count INTEGER NOT NULL DEFAULT 0,
+        amount_sum REAL,
+        amount_min REAL,
+        amount_max REAL,
+        hours_sum REAL,
+        PRIMARY KEY (year, month, group_id, client_id, service_id)) WITHOUT ROWID;
+
+    INSERT INTO revenue_rollup SELECT * FROM rollup_by_id;
+    CREATE INDEX IF NOT EXISTS idx_revenue_rollup_client_month ON revenue_rollup(client_id, year, month, amount_sum);
+    UPDATE table_versions SET version = version + 1 WHERE name = 'revenue_rollup';
+    DROP TABLE temp.rollup_by_id;
+    DROP TABLE temp.service_keys;
+    {_rollup_triggers()}
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_ledger_au
+    AFTER UPDATE OF id, order_id, service_id, payment_date, amount, hours ON order_items
+    BEGIN
+        INSERT INTO ledger_changes (item_id) VALUES (NEW.id);
+        INSERT INTO ledger_changes (item_id) SELECT OLD.id WHERE OLD.id IS NOT NEW.id;
+    END;
+    '''
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Версия схемы хранится в PRAGMA user_version, миграция N переводит базу в версию N.
+# Новые миграции добавляются только в конец списка, уже выпущенные не меняются.
+MIGRATIONS = [
+    # 1: базовые таблицы
+    '''
+    CREATE TABLE IF NOT EXISTS groups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE);
+
+    CREATE TABLE IF NOT EXISTS clients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        sex TEXT,
+        phone TEXT,
+        vk_id TEXT,
+        tg_id TEXT,
+        group_id INTEGER,
+        first_order_date DATE,
+        FOREIGN KEY (group_id) REFERENCES groups(id));
+
+    CREATE TABLE IF NOT EXISTS services_catalog (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        min_price REAL,
+        description TEXT);
+
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id INTEGER,
+        execution_date DATE,
+        status TEXT,
+        total_amount REAL DEFAULT 0,
+        FOREIGN KEY (client_id) REFERENCES clients(id));
+
+    CREATE TABLE IF NOT EXISTS order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER,
+        service_name TEXT,
+        payment_date DATE,
+        amount REAL,
+        hours REAL,
+        FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE);
+    ''',
+    # 2: индексы для горячих запросов (состав заказа, отчёты, заказы клиента, фильтр по группе)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id);
+    CREATE INDEX IF NOT EXISTS idx_order_items_payment_date ON order_items(payment_date);
+    CREATE INDEX IF NOT EXISTS idx_orders_client_date ON orders(client_id, execution_date);
+    CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+    CREATE INDEX IF NOT EXISTS idx_clients_group_id ON clients(group_id);
+    ''',
+    # 3: помесячные агрегаты выручки для ОТЧЁТОВ (ключ услуги — текст; на service_id его переводит миграция 13)
+    '''
+    CREATE VIEW IF NOT EXISTS paid_items AS
+    SELECT
+        oi.id AS item_id,
+        oi.order_id,
+        o.client_id,
+        COALESCE(c.group_id, 0) AS group_id,
+        COALESCE(oi.service_name, '') AS service,
+        oi.payment_date,
+        CAST(strftime('%Y', oi.payment_date) AS INTEGER) AS year,
+        CAST(strftime('%m', oi.payment_date) AS INTEGER) AS month,
+        oi.amount,
+        oi.hours
+    FROM order_items oi
+    JOIN orders o ON oi.order_id = o.id
+    JOIN clients c ON o.client_id = c.id
+    WHERE oi.payment_date IS NOT NULL AND strftime('%Y', oi.payment_date) IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS revenue_rollup (
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        group_id INTEGER NOT NULL,      -- 0 = без группы
+        client_id INTEGER NOT NULL,
+        service TEXT NOT NULL,
+        items_count INTEGER NOT NULL DEFAULT 0,
+        amount_sum REAL,
+        amount_min REAL,
+        amount_max REAL,
+        hours_sum REAL,
+        PRIMARY KEY (year, month, group_id, client_id, service)) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_revenue_rollup_client ON revenue_rollup(client_id);
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_rollup_ai AFTER INSERT ON order_items
+    WHEN NEW.payment_date IS NOT NULL
+    BEGIN
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service, 1, amount, amount, amount, COALESCE(hours, 0)
+        FROM paid_items WHERE item_id = NEW.id
+        ON CONFLICT (year, month, group_id, client_id, service) DO UPDATE SET
+            items_count = items_count + 1,
+            amount_sum = amount_sum + excluded.amount_sum,
+            amount_min = MIN(amount_min, excluded.amount_min),
+            amount_max = MAX(amount_max, excluded.amount_max),
+            hours_sum = hours_sum + excluded.hours_sum;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_rollup_au
+    AFTER UPDATE OF order_id, service_name, payment_date, amount, hours ON order_items
+    BEGIN
+        DELETE FROM revenue_rollup
+        WHERE year = CAST(strftime('%Y', OLD.payment_date) AS INTEGER)
+          AND month = CAST(strftime('%m', OLD.payment_date) AS INTEGER)
+          AND client_id = (SELECT client_id FROM orders WHERE id = OLD.order_id)
+          AND service = COALESCE(OLD.service_name, '');
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service,
+               COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+        FROM paid_items
+        WHERE year = CAST(strftime('%Y', OLD.payment_date) AS INTEGER)
+          AND month = CAST(strftime('%m', OLD.payment_date) AS INTEGER)
+          AND client_id = (SELECT client_id FROM orders WHERE id = OLD.order_id)
+          AND service = COALESCE(OLD.service_name, '')
+        GROUP BY year, month, group_id, client_id, service;
+        DELETE FROM revenue_rollup
+        WHERE year = CAST(strftime('%Y', NEW.payment_date) AS INTEGER)
+          AND month = CAST(strftime('%m', NEW.payment_date) AS INTEGER)
+          AND client_id = (SELECT client_id FROM orders WHERE id = NEW.order_id)
+          AND service = COALESCE(NEW.service_name, '');
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service,
+               COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+        FROM paid_items
+        WHERE year = CAST(strftime('%Y', NEW.payment_date) AS INTEGER)
+          AND month = CAST(strftime('%m', NEW.payment_date) AS INTEGER)
+          AND client_id = (SELECT client_id FROM orders WHERE id = NEW.order_id)
+          AND service = COALESCE(NEW.service_name, '')
+        GROUP BY year, month, group_id, client_id, service;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_rollup_ad AFTER DELETE ON order_items
+    BEGIN
+        DELETE FROM revenue_rollup
+        WHERE year = CAST(strftime('%Y', OLD.payment_date) AS INTEGER)
+          AND month = CAST(strftime('%m', OLD.payment_date) AS INTEGER)
+          AND client_id = (SELECT client_id FROM orders WHERE id = OLD.order_id)
+          AND service = COALESCE(OLD.service_name, '');
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service,
+               COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+        FROM paid_items
+        WHERE year = CAST(strftime('%Y', OLD.payment_date) AS INTEGER)
+          AND month = CAST(strftime('%m', OLD.payment_date) AS INTEGER)
+          AND client_id = (SELECT client_id FROM orders WHERE id = OLD.order_id)
+          AND service = COALESCE(OLD.service_name, '')
+        GROUP BY year, month, group_id, client_id, service;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_au AFTER UPDATE OF client_id ON orders
+    WHEN OLD.client_id IS NOT NEW.client_id
+    BEGIN
+        DELETE FROM revenue_rollup WHERE client_id IN (OLD.client_id, NEW.client_id);
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service,
+               COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+        FROM paid_items
+        WHERE client_id IN (OLD.client_id, NEW.client_id)
+        GROUP BY year, month, group_id, client_id, service;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_rollup_ad AFTER DELETE ON orders
+    BEGIN
+        DELETE FROM revenue_rollup WHERE client_id = OLD.client_id;
+        INSERT INTO revenue_rollup
+            (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+        SELECT year, month, group_id, client_id, service,
+               COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+        FROM paid_items
+        WHERE client_id = OLD.client_id
+        GROUP BY year, month, group_id, client_id, service;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_clients_rollup_au AFTER UPDATE OF group_id ON clients
+    WHEN OLD.group_id IS NOT NEW.group_id
+    BEGIN
+        UPDATE revenue_rollup SET group_id = COALESCE(NEW.group_id, 0) WHERE client_id = NEW.id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_clients_rollup_ad AFTER DELETE ON clients
+    BEGIN
+        DELETE FROM revenue_rollup WHERE client_id = OLD.id;
+    END;
+
+    DELETE FROM revenue_rollup;
+    INSERT INTO revenue_rollup
+        (year, month, group_id, client_id, service, items_count, amount_sum, amount_min, amount_max, hours_sum)
+    SELECT year, month, group_id, client_id, service,
+           COUNT(*), SUM(amount), MIN(amount), MAX(amount), COALESCE(SUM(hours), 0)
+    FROM paid_items
+    WHERE 1
+    GROUP BY year, month, group_id, client_id, service;
+    ''',
+    # 4: диапазонный поиск новых клиентов по дате первой оплаты (отчёт 3)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_clients_first_order_date ON clients(first_order_date);
+    ''',
+    # 5: полнотекстовый поиск клиентов
+    _client_fts_schema(),
+    # 6: постраничный список заказов по (execution_date, id)
+    '''
+    CREATE INDEX IF NOT EXISTS idx_orders_execution_date ON orders(execution_date);
+    ''',
+    # 7: нормализованные контакты клиентов для поиска дублей
+    f'''
+    ALTER TABLE clients ADD COLUMN phone_norm TEXT GENERATED ALWAYS AS {_phone_key_sql("phone")} VIRTUAL;
+    ALTER TABLE clients ADD COLUMN vk_norm TEXT GENERATED ALWAYS AS {_vk_key_sql("vk_id")} VIRTUAL;
+    ALTER TABLE clients ADD COLUMN tg_norm TEXT GENERATED ALWAYS AS {_tg_key_sql("tg_id")} VIRTUAL;
+
+    CREATE INDEX IF NOT EXISTS idx_clients_phone_norm ON clients(phone_norm);
+    CREATE INDEX IF NOT EXISTS idx_clients_vk_norm ON clients(vk_norm);
+    CREATE INDEX IF NOT EXISTS idx_clients_tg_norm ON clients(tg_norm);
+    ''',
+    # 8: сумма заказа и дата первой оплаты клиента поддерживаются триггерами
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_derived_ai AFTER INSERT ON order_items
+    BEGIN
+        UPDATE orders SET total_amount = COALESCE(total_amount, 0) + COALESCE(NEW.amount, 0)
+        WHERE id = NEW.order_id;
+
+        UPDATE clients SET first_order_date = NEW.payment_date
+        WHERE id = (SELECT client_id FROM orders WHERE id = NEW.order_id)
+          AND NULLIF(NEW.payment_date, '') IS NOT NULL
+          AND (first_order_date IS NULL OR NEW.payment_date < first_order_date);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_derived_au
+    AFTER UPDATE OF order_id, amount, payment_date ON order_items
+    BEGIN
+        UPDATE orders SET total_amount = COALESCE(total_amount, 0) - COALESCE(OLD.amount, 0)
+        WHERE id = OLD.order_id;
+        UPDATE orders SET total_amount = COALESCE(total_amount, 0) + COALESCE(NEW.amount, 0)
+        WHERE id = NEW.order_id;
+
+        -- старая дата могла быть первой оплатой: тогда пересчёт по индексу (без оплат — NULL),
+        -- иначе достаточно сравнения
+        UPDATE clients
+        SET first_order_date = ({_FIRST_PAYMENT_SQL.format(client="clients.id")})
+        WHERE id = (SELECT client_id FROM orders WHERE id = OLD.order_id)
+          AND first_order_date IS OLD.payment_date;
+
+        UPDATE clients SET first_order_date = NEW.payment_date
+        WHERE id = (SELECT client_id FROM orders WHERE id = NEW.order_id)
+          AND NULLIF(NEW.payment_date, '') IS NOT NULL
+          AND (first_order_date IS NULL OR NEW.payment_date < first_order_date);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_order_items_derived_ad AFTER DELETE ON order_items
+    BEGIN
+        UPDATE orders SET total_amount = COALESCE(total_amount, 0) - COALESCE(OLD.amount, 0)
+        WHERE id = OLD.order_id;
+
+        UPDATE clients
+        SET first_order_date = ({_FIRST_PAYMENT_SQL.format(client="clients.id")})
+        WHERE id = (SELECT client_id FROM orders WHERE id = OLD.order_id)
+          AND first_order_date IS OLD.payment_date;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS trg_orders_derived_au AFTER UPDATE OF client_id ON orders
+    WHEN OLD.client_id IS NOT NEW.client_id
+    BEGIN
+        {_first_payment_recompute("OLD.client_id")}
+        {_first_payment_recompute("NEW.client_id")}
+    END;
+
+    UPDATE orders
+    SET total_amount = (SELECT COALESCE(SUM(amount), 0) FROM order_items WHERE order_id = orders.id);
+
+    -- дата, введённая вручную, заменяется первой оплатой (у клиентов без оплат — NULL)
+    UPDATE clients SET first_order_date = ({_FIRST_PAYMENT_SQL.format(client="clients.id")});
+    ''',
+    # 9: версии таблиц для кэша чтения
+    _table_versions_schema(),
+    # 10: когорты — помесячная выручка клиента читается из покрывающего индекса по порядку клиентов
+    '''
+    CREATE INDEX IF NOT EXISTS idx_revenue_rollup_client_month ON revenue_rollup(client_id, year, month, amount_sum);
+    DROP INDEX IF EXISTS idx_revenue_rollup_client;
+    ''',
+    # 11: журнал изменений услуг для дозагрузки снимка оплат
+    _ledger_changes_schema(),
+    # 12: итоги клиентов за всё время
+    _client_stats_schema(),
+    # 13: услуги заказов по id прайс-листа
+    _service_ids_schema(),
+]
+
+def apply_migrations(conn):
+    """Применяет недостающие миграции, возвращает итоговую версию схемы"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, script in enumerate(MIGRATIONS, start=1):
+        if target <= version:
+            continue
+        try:
+            # executescript сам коммитит открытую транзакцию, поэтому BEGIN/COMMIT пишем явно:
+            # миграция и новый номер версии фиксируются атомарно
+            conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {target};\nCOMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        version = target
+    return version
+
+@queued_write
+def rebuild_rollups(conn):
+    """Пересобирает revenue_rollup с нуля по order_items"""
+    conn.execute("DELETE FROM revenue_rollup")
+    conn.execute(_ROLLUP_AGGREGATE.format(where="1"))
+    # агрегаты меняются помимо триггеров — сами сдвигаем версию для кэша отчётов
+    conn.execute("UPDATE table_versions SET version = version + 1 WHERE name = 'revenue_rollup'")
+
+_SCHEMA_VERSIONS = {}
+_INIT_LOCK = threading.Lock()
+
+def init_db():
+    """Инициализация базы данных DB_PATH (один раз на процесс), возвращает версию схемы"""
+    with _INIT_LOCK:
+        if DB_PATH not in _SCHEMA_VERSIONS:
+            with get_pool().connection() as conn:
+                _SCHEMA_VERSIONS[DB_PATH] = apply_migrations(conn)
+                conn.execute("PRAGMA optimize")  # обновляет статистику планировщика для новых индексов
+        return _SCHEMA_VERSIONS[DB_PATH]
+
+def _print_error(message):
+    print(message, file=sys.stderr)
+
+_error_handler = _print_error
+
+def set_error_handler(handler):
+    """Куда run_query и run_write сообщают об ошибках БД (интерфейс передаёт st.error)"""
+    global _error_handler
+    _error_handler = handler
+
+def run_query(query, params=(), fetch=False):
+    """
+    Выполняет SQL запрос: чтение — на соединении из пула, запись — через очередь записи
+    (время, вместе с ожиданием в очереди, и число строк учитываются в метриках перезапуска)
+    """
+    try:
+        started = time.perf_counter()
+        if not fetch:
+            rowcount = get_writer().submit(lambda conn: conn.execute(query, params).rowcount)
+        else:
+            memo, key = _rerun_memo(), _memo_key(query, params)
+            if key is None:
+                memo = None
+            if memo is not None and key in memo:
+                df, first_caller = memo[key]
+                _record_repeat(query, first_caller, len(df))
+                return df.copy()
+        with get_pool().connection() as conn:
+            if not fetch:
+                _record_query(conn, query, params, started, rowcount)
+                return True
+            c = conn.execute(query, params)
+            data = c.fetchall()
+            _record_query(conn, query, params, started, len(data))
+            cols = [description[0] for description in c.description]
+            df = pd.DataFrame(data, columns=cols)
+        if memo is not None:
+            memo[key] = (df, _caller(2))
+            return df.copy()  # вызывающий может менять результат на месте
+        return df
+    except Exception as e:
+        if fetch and getattr(_CACHED_READ, "depth", 0):
+            raise  # cached_read не кэширует результат и сообщит об ошибке сам
+        _error_handler(f"Ошибка БД: {e}")
+        return pd.DataFrame() if fetch else False
+
+# --- КЛИЕНТЫ, ГРУППЫ, УСЛУГИ ---
+# Однострочные изменения справочников: как и run_query, возвращают True/False.
+def add_client(name, sex, phone, vk_id, tg_id, group_id):
+    return run_query('''
+        INSERT INTO clients (name, sex, phone, vk_id, tg_id, group_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (name, sex, phone, vk_id, tg_id, group_id))
+
+def update_client(client_id, name, sex, phone, vk_id, tg_id, group_id):
+    """Дату первой оплаты не меняет: её ведут триггеры по оплатам"""
+    return run_query('''
+        UPDATE clients
+        SET name=?, sex=?, phone=?, vk_id=?, tg_id=?, group_id=?
+        WHERE id=?
+    ''', (name, sex, phone, vk_id, tg_id, group_id, int(client_id)))
+
+def delete_client(client_id):
+    return run_query("DELETE FROM clients WHERE id=?", (int(client_id),))
+
+def group_name_taken(name, exclude_id=None):
+    """Есть ли уже группа с таким названием (кроме exclude_id)"""
+    found = run_query(
+        "SELECT 1 FROM groups WHERE name=? AND id IS NOT ?",
+        (name, None if exclude_id is None else int(exclude_id)), fetch=True,
+    )
+    return not found.empty
+
+def count_group_clients(group_id):
+    result = run_query("SELECT COUNT(*) AS n FROM clients WHERE group_id=?", (int(group_id),), fetch=True)
+    return int(result.iloc[0]["n"]) if not result.empty else 0
+
+def add_group(name):
+    return run_query("INSERT INTO groups (name) VALUES (?)", (name,))
+
+def rename_group(group_id, name):
+    return run_query("UPDATE groups SET name=? WHERE id=?", (name, int(group_id)))
+
+def delete_group(group_id):
+    return run_query("DELETE FROM groups WHERE id=?", (int(group_id),))
+
+def add_service(name, min_price, description):
+    return run_query(
+        "INSERT INTO services_catalog (name, min_price, description) VALUES (?, ?, ?)",
+        (name, min_price, description),
+    )
+
+def update_service(service_id, name, min_price, description):
+    return run_query('''
+        UPDATE services_catalog
+        SET name=?, min_price=?, description=?
+        WHERE id=?
+    ''', (name, min_price, description, int(service_id)))
+
+def count_service_items(service_id):
+    result = run_query("SELECT COUNT(*) AS n FROM order_items WHERE service_id=?", (int(service_id),), fetch=True)
+    return int(result.iloc[0]["n"]) if not result.empty else 0
+
+def delete_service(service_id):
+    return run_query("DELETE FROM services_catalog WHERE id=?", (int(service_id),))
+
+@cached_read("order_items")
+def load_unmatched_services():
+    """Названия услуг в заказах, не сопоставленные с прайс-листом: число строк, сумма, последняя оплата"""
+    return run_query('''
+        SELECT service_name, COUNT(*) AS items, SUM(amount) AS total_sum, MAX(payment_date) AS last_payment
+        FROM order_items
+        WHERE service_id IS NULL AND COALESCE(service_name, '') != ''
+        GROUP BY service_name
+        ORDER BY items DESC, service_name
+    ''', fetch=True)
+
+def link_service_name(service_name, service_id):
+    """Привязывает все несопоставленные строки с названием service_name к услуге прайс-листа"""
+    return run_query('''
+        UPDATE order_items SET service_id = ?
+        WHERE service_id IS NULL AND service_name = ?
+    ''', (int(service_id), service_name))
+
+# --- ЗАКАЗЫ ---
+def _optional_float(value):
+    """Число для записи; None и NaN (пустая ячейка редактора) записываются как NULL"""
+    return None if value is None or pd.isna(value) else float(value)
+
+def load_order_items(order_id):
+    """Услуги заказа в порядке оплаты; название — из прайс-листа, у несопоставленных — сохранённый текст"""
+    return run_query('''
+        SELECT oi.id, oi.service_id, COALESCE(sc.name, oi.service_name) AS service_name,
+               oi.payment_date, oi.amount, oi.hours
+        FROM order_items oi
+        LEFT JOIN services_catalog sc ON sc.id = oi.service_id
+        WHERE oi.order_id = ? ORDER BY oi.payment_date
+    ''', (int(order_id),), fetch=True)
+
+def order_total(order_id):
+    """Сумма заказа (поддерживается триггерами)"""
+    result = run_query("SELECT total_amount FROM orders WHERE id=?", (int(order_id),), fetch=True)
+    return result.iloc[0]["total_amount"] if not result.empty else 0
+
+def create_order(client_id, execution_date, status):
+    return run_query(
+        "INSERT INTO orders (client_id, execution_date, status) VALUES (?, ?, ?)",
+        (int(client_id), parse_date_to_db(execution_date), status),
+    )
+
+def update_order(order_id, execution_date, status):
+    return run_query(
+        "UPDATE orders SET execution_date=?, status=? WHERE id=?",
+        (parse_date_to_db(execution_date), status, int(order_id)),
+    )
+
+# --- ЗАПИСЬ: ЕДИНИЦЫ РАБОТЫ ---
+# Многошаговые изменения заказов выполняются в очереди записи одной единицей:
+# либо применяются все шаги, либо ни один.
+@queued_write
+def add_order_item(conn, client_id, order_id, execution_date, status, service_id, payment_date, amount, hours):
+    """
+    Добавляет услугу в заказ. Если order_id пуст, сначала создаёт заказ клиента.
+    Возвращает id заказа.
+    """
+    if not order_id:
+        order_id = conn.execute('''
+            INSERT INTO orders (client_id, execution_date, status)
+            VALUES (?, ?, ?)
+        ''', (client_id, parse_date_to_db(execution_date), status)).lastrowid
+
+    conn.execute('''
+        INSERT INTO order_items (order_id, service_id, payment_date, amount, hours)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (int(order_id), int(service_id), parse_date_to_db(payment_date),
+          _optional_float(amount), _optional_float(hours)))
+    return int(order_id)
+
+@queued_write
+def update_order_item(conn, item_id, service_id, payment_date, amount, hours):
+    """
+    Изменяет услугу в заказе (итоги заказа и клиента пересчитывают триггеры).
+    service_id=None оставляет услугу прежней; исходный текст service_name не меняется.
+    """
+    conn.execute('''
+        UPDATE order_items
+        SET service_id = COALESCE(:service_id, service_id),
+            payment_date = :payment_date, amount = :amount, hours = :hours
+        WHERE id = :id
+    ''', {"service_id": None if service_id is None else int(service_id), "payment_date": parse_date_to_db(payment_date),
+          "amount": _optional_float(amount), "hours": _optional_float(hours), "id": int(item_id)})
+    return True
+
+@queued_write
+def delete_order_item(conn, item_id):
+    """Удаляет услугу из заказа (итоги заказа и клиента пересчитывают триггеры)"""
+    conn.execute("DELETE FROM order_items WHERE id=?", (int(item_id),))
+    return True
+
+@queued_write
+def delete_order(conn, order_id):
+    """Удаляет заказ вместе с его услугами"""
+    conn.execute("DELETE FROM order_items WHERE order_id=?", (int(order_id),))
+    conn.execute("DELETE FROM orders WHERE id=?", (int(order_id),))
+    return True
+
+def check_derived_fields():
+    """Расхождения производных полей с пересчётом по order_items"""
+    frames = []
+    for field, spec in DERIVED_FIELD_CHECKS.items():
+        found = run_query(spec["check"], fetch=True)
+        if not found.empty:
+            found.insert(0, "field", field)
+            frames.append(found)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["field", "row_id", "stored", "expected"])
+
+@queued_write
+def repair_derived_fields(conn):
+    """Исправляет все расхождения одной транзакцией, возвращает число исправленных строк"""
+    fixed = 0
+    for spec in DERIVED_FIELD_CHECKS.values():
+        rows = conn.execute(spec["check"]).fetchall()
+        conn.executemany(spec["repair"], [(expected, row_id) for row_id, _, expected in rows])
+        fixed += len(rows)
+    return fixed
+
+def run_write(flow, *args, **kwargs):
+    """Выполняет единицу работы; при ошибке БД показывает её, как run_query, и возвращает None"""
+    try:
+        return flow(*args, **kwargs)
+    except sqlite3.Error as e:
+        _error_handler(f"Ошибка БД: {e}")
+        return None
+
+def _fts_phrase(token):
+    """Экранирует пользовательский ввод как строку FTS5"""
+    return '"' + token.replace('"', '""') + '"'
+
+def search_clients(term, group_id=None, limit=CLIENT_SEARCH_LIMIT):
+    """
+    Поиск клиентов по имени, телефону, VK и Telegram (без учёта регистра, с кириллицей).
+    Слова от 3 символов ищутся как подстроки, более короткие — как начало слова.
+    Результат отсортирован по релевантности.
+    """
+    tokens = term.split()
+    if not tokens:
+        return pd.DataFrame()
+
+    long_tokens = [t for t in tokens if len(t) >= 3]
+    if long_tokens:
+        fts_table = "clients_fts"
+        match = " AND ".join(_fts_phrase(t) for t in long_tokens)
+    else:
+        fts_table = "clients_prefix_fts"
+        match = " AND ".join(_fts_phrase(t) + "*" for t in tokens)
+
+    params = [match]
+    group_filter = ""
+    if group_id is not None:
+        group_filter = "AND c.group_id = ?"
+        params.append(int(group_id))
+    params.append(limit)
+
+    return run_query(f'''
+        SELECT
+            c.id,
+            c.name,
+            c.sex,
+            c.phone,
+            c.vk_id,
+            c.tg_id,
+            COALESCE(g.name, 'Без группы') as group_name,
+            c.first_order_date,
+            s.revenue,
+            s.payments,
+            s.hours,
+            s.avg_check,
+            s.last_payment,
+            s.open_orders
+        FROM {fts_table} f
+        JOIN clients c ON c.id = f.rowid
+        LEFT JOIN client_stats s ON s.client_id = c.id
+        LEFT JOIN groups g ON c.group_id = g.id
+        WHERE {fts_table} MATCH ? {group_filter}
+        ORDER BY f.rank
+        LIMIT ?
+    ''', params, fetch=True)
+
+def find_duplicate_clients(phone=None, vk_id=None, tg_id=None, exclude_id=None):
+    """Клиенты, у которых совпадает хотя бы один нормализованный контакт (поиск по индексам)"""
+    return run_query(f'''
+        SELECT c.id, c.name,
+               c.phone_norm = {_phone_key_sql(":phone")} AS same_phone,
+               c.vk_norm = {_vk_key_sql(":vk")} AS same_vk,
+               c.tg_norm = {_tg_key_sql(":tg")} AS same_tg
+        FROM clients c
+        WHERE (c.phone_norm = {_phone_key_sql(":phone")}
+               OR c.vk_norm = {_vk_key_sql(":vk")}
+               OR c.tg_norm = {_tg_key_sql(":tg")})
+          AND c.id IS NOT :exclude
+        ORDER BY c.id
+    ''', {"phone": phone, "vk": vk_id, "tg": tg_id, "exclude": exclude_id}, fetch=True)
+
+def describe_duplicates(dups):
+    """Текст предупреждения о совпадающих контактах"""
+    parts = []
+    for row in dups.itertuples():
+        fields = [label for label, same in (("телефон", row.same_phone), ("VK", row.same_vk), ("Telegram", row.same_tg)) if same]
+        parts.append(f"#{row.id} {row.name} ({', '.join(fields)})")
+    return "⚠️ Такие контакты уже есть у клиентов: " + "; ".join(parts)
+
+@cached_read("clients")
+def duplicate_contact_groups():
+    """Группы клиентов с одинаковым нормализованным контактом (по индексам, без чтения всей таблицы)"""
+    return run_query('''
+        SELECT 'Телефон' AS contact, phone_norm AS value, COUNT(*) AS clients_count, group_concat(id, ', ') AS client_ids
+        FROM clients WHERE phone_norm IS NOT NULL GROUP BY phone_norm HAVING COUNT(*) > 1
+        UNION ALL
+        SELECT 'VK', vk_norm, COUNT(*), group_concat(id, ', ')
+        FROM clients WHERE vk_norm IS NOT NULL GROUP BY vk_norm HAVING COUNT(*) > 1
+        UNION ALL
+        SELECT 'Telegram', tg_norm, COUNT(*), group_concat(id, ', ')
+        FROM clients WHERE tg_norm IS NOT NULL GROUP BY tg_norm HAVING COUNT(*) > 1
+    ''', fetch=True)
+
+# --- ПОСТРАНИЧНЫЕ СПИСКИ ---
+# Страницы выбираются по ключу (keyset): WHERE (ключ) < (ключ последней строки прошлой страницы),
+# поэтому стоимость страницы не зависит от её номера. Все ключи сортируются по убыванию.
+# keys — сортировка по умолчанию, sorts — другие сортировки списка (у каждой свой индекс).
+LISTINGS = {
+    "clients": {
+        "columns": '''
+            c.id,
+            c.name,
+            c.sex,
+            c.phone,
+            c.vk_id,
+            c.tg_id,
+            COALESCE(g.name, 'Без группы') as group_name,
+            c.first_order_date,
+            s.revenue,
+            s.payments,
+            s.hours,
+            s.avg_check,
+            s.last_payment,
+            s.open_orders
+        ''',
+        # CROSS JOIN закрепляет порядок: обход идёт по индексу сортировки client_stats
+        "from": "client_stats s CROSS JOIN clients c ON c.id = s.client_id LEFT JOIN groups g ON c.group_id = g.id",
+        "count_from": "client_stats s CROSS JOIN clients c ON c.id = s.client_id",
+        "keys": ("s.client_id",),
+        "sorts": {
+            "revenue": {"title": "Выручка", "keys": ("s.revenue", "s.client_id")},
+            "last_payment": {"title": "Последняя оплата", "keys": ("COALESCE(s.last_payment, '')", "s.client_id")},
+            "payments": {"title": "Число оплат", "keys": ("s.payments", "s.client_id")},
+            "avg_check": {"title": "Средний чек", "keys": ("s.avg_check", "s.client_id")},
+            "open_orders": {"title": "Ожидают оплаты", "keys": ("s.open_orders", "s.client_id")},
+        },
+        "filters": {
+            "group": "c.group_id = :group",
+            "min_revenue": "s.revenue >= :min_revenue",
+            "paid_since": "s.last_payment >= :paid_since",
+            "idle_since": "COALESCE(s.last_payment, '') < :idle_since",
+            "open_orders": "s.open_orders >= :open_orders",
+        },
+    },
+    "orders": {
+        "columns": '''
+            o.id,
+            o.execution_date,
+            c.name AS client_name,
+            o.status,
+            o.total_amount
+        ''',
+        "from": "orders o LEFT JOIN clients c ON o.client_id = c.id",
+        "count_from": "orders o",
+        "keys": ("o.execution_date", "o.id"),
+        "filters": {"status": "o.status = :status", "client": "o.client_id = :client"},
+    },
+    "services": {
+        "columns": "s.id, s.name, s.min_price, s.description",
+        "from": "services_catalog s",
+        "count_from": "services_catalog s",
+        "keys": ("s.id",),
+        "filters": {},
+    },
+    "client_orders": {
+        "columns": '''
+            o.id,
+            o.execution_date,
+            o.status,
+            o.total_amount,
+            (SELECT COUNT(*) FROM order_items WHERE order_id = o.id) AS items,
+            (SELECT group_concat(COALESCE(sc.name, oi.service_name), ', ')
+             FROM order_items oi LEFT JOIN services_catalog sc ON sc.id = oi.service_id
+             WHERE oi.order_id = o.id) AS services,
+            (SELECT MAX(payment_date) FROM order_items WHERE order_id = o.id) AS last_payment
+        ''',
+        "from": "orders o",
+        "count_from": "orders o",
+        "keys": ("o.execution_date", "o.id"),
+        "filters": {"client": "o.client_id = :client"},
+    },
+}
+
+def _listing_keys(listing, sort=None):
+    return listing["sorts"][sort]["keys"] if sort else listing["keys"]
+
+def _listing_where(listing, filters):
+    conditions = [listing["filters"][name] for name, value in filters.items() if value is not None]
+    bindings = {name: value for name, value in filters.items() if value is not None}
+    return conditions, bindings
+
+@cached_read("clients", "groups", "orders", "order_items", "services_catalog")
+def count_listing(name, **filters):
+    """Количество строк списка; кэшируется до записи в таблицы списков"""
+    listing = LISTINGS[name]
+    conditions, bindings = _listing_where(listing, filters)
+    where = " AND ".join(conditions) or "1"
+    result = run_query(f"SELECT COUNT(*) AS n FROM {listing['count_from']} WHERE {where}", bindings, fetch=True)
+    return int(result.iloc[0]['n']) if not result.empty else 0
+
+def fetch_page(name, after=None, page_size=PAGE_SIZES[0], sort=None, **filters):
+    """Одна страница списка после ключа after (None — первая страница) в сортировке sort"""
+    listing = LISTINGS[name]
+    keys = _listing_keys(listing, sort)
+    conditions, bindings = _listing_where(listing, filters)
+    if after is not None:
+        placeholders = ", ".join(f":after_{i}" for i in range(len(keys)))
+        conditions.append(f"({', '.join(keys)}) < ({placeholders})")
+        bindings.update({f"after_{i}": value for i, value in enumerate(after)})
+    bindings["limit"] = page_size
+
+    order = ", ".join(f"{k} DESC" for k in keys)
+    key_columns = ", ".join(f"{k} AS _key_{i}" for i, k in enumerate(keys))
+    return run_query(f'''
+        SELECT {listing['columns']}, {key_columns}
+        FROM {listing['from']}
+        WHERE {" AND ".join(conditions) or "1"}
+        ORDER BY {order}
+        LIMIT :limit
+    ''', bindings, fetch=True)
+
+def _page_boundary(name, offset, sort=None, **filters):
+    """Ключ строки с номером offset — для перехода сразу на дальнюю страницу"""
+    listing = LISTINGS[name]
+    keys = _listing_keys(listing, sort)
+    conditions, bindings = _listing_where(listing, filters)
+    bindings["offset"] = offset
+    result = run_query(f'''
+        SELECT {", ".join(keys)}
+        FROM {listing['count_from']}
+        WHERE {" AND ".join(conditions) or "1"}
+        ORDER BY {", ".join(f"{k} DESC" for k in keys)}
+        LIMIT 1 OFFSET :offset
+    ''', bindings, fetch=True)
+    return tuple(next(result.itertuples(index=False))) if not result.empty else None
+
+def listing_page(name, page, page_size, cursors, sort=None, **filters):
+    """
+    Страница page списка LISTINGS[name] в сортировке sort без служебных колонок ключа.
+    cursors[i] — ключ последней строки страницы i - 1 (cursors[1] = None); словарь дополняется
+    границей следующей страницы, вызывающий хранит его между запросами.
+    """
+    if page in cursors:
+        after = cursors[page]
+    else:
+        # переход на непросмотренную страницу: ищем её границу по индексу
+        after = _page_boundary(name, (page - 1) * page_size - 1, sort=sort, **filters)
+
+    page_df = fetch_page(name, after=after, page_size=page_size, sort=sort, **filters)
+    key_columns = [c for c in page_df.columns if c.startswith("_key_")]
+    if len(page_df) == page_size:
+        # itertuples отдаёт встроенные типы Python, которые sqlite3 умеет привязывать
+        cursors[page + 1] = tuple(next(page_df[key_columns].tail(1).itertuples(index=False)))
+    return page_df.drop(columns=key_columns)
+
+# --- ПОЛЯ ВЫБОРА ---
+# Поля выбора клиента, заказа и услуги не загружают справочник целиком: варианты ищутся в базе
+# по введённой строке, их не больше PICKER_LIMIT. Варианты — {id: подпись}, выбор хранится по id,
+# поэтому клиенты с одинаковыми именами не путаются.
+def pick_clients(term="", limit=PICKER_LIMIT):
+    """Клиенты по поиску search_clients; без строки поиска — последние добавленные"""
+    if term.strip():
+        found = search_clients(term, limit=limit)
+    else:
+        found = run_query("SELECT id, name, phone FROM clients ORDER BY id DESC LIMIT ?", (limit,), fetch=True)
+    if found.empty:
+        return {}
+    phones = format_phone_series(found["phone"])
+    return {
+        int(client_id): f"#{client_id} {name}" + (f" · {phone}" if phone else "")
+        for client_id, name, phone in zip(found["id"], found["name"], phones)
+    }
+
+def pick_services(term="", limit=PICKER_LIMIT):
+    """Услуги, в названии которых есть строка (сначала начинающиеся с неё); без строки — новые первыми"""
+    found = run_query('''
+        SELECT id, name FROM services_catalog
+        WHERE instr(casefold(name), casefold(:term)) > 0
+        ORDER BY instr(casefold(name), casefold(:term)) = 1 DESC, id DESC
+        LIMIT :limit
+    ''', {"term": term.strip(), "limit": limit}, fetch=True)
+    return {int(service_id): name for service_id, name in zip(found["id"], found["name"])} if not found.empty else {}
+
+def pick_orders(client_id, term="", limit=PICKER_LIMIT):
+    """Заказы клиента, новые сверху; строка поиска — начало номера заказа"""
+    found = run_query('''
+        SELECT id, execution_date, status FROM orders
+        WHERE client_id = :client AND CAST(id AS TEXT) LIKE :term || '%'
+        ORDER BY execution_date DESC, id DESC
+        LIMIT :limit
+    ''', {"client": int(client_id), "term": term.strip().lstrip("№#"), "limit": limit}, fetch=True)
+    if found.empty:
+        return {}
+    return {
+        int(order_id): f"№{order_id} | {format_date_display(execution_date)} | {status}"
+        for order_id, execution_date, status in zip(found["id"], found["execution_date"], found["status"])
+    }
+
+# поле выбора -> функция поиска и таблицы, от которых зависят варианты (для кэша сессии)
+PICKERS = {
+    "clients": {"find": pick_clients, "tables": ("clients",)},
+    "services": {"find": pick_services, "tables": ("services_catalog",)},
+    "orders": {"find": pick_orders, "tables": ("orders",)},
+}
+
+def load_client(client_id):
+    """Клиент с названием группы (одна строка) или None"""
+    found = run_query('''
+        SELECT c.id, c.name, c.sex, c.phone, c.vk_id, c.tg_id,
+               COALESCE(g.name, 'Без группы') as group_name,
+               c.first_order_date
+        FROM clients c
+        LEFT JOIN groups g ON c.group_id = g.id
+        WHERE c.id = ?
+    ''', (int(client_id),), fetch=True)
+    return found.iloc[0] if not found.empty else None
+
+def load_client_stats(client_id):
+    """Итоги клиента из client_stats (одна строка) или None"""
+    found = run_query("SELECT * FROM client_stats WHERE client_id = ?", (int(client_id),), fetch=True)
+    return found.iloc[0] if not found.empty else None
+
+def load_service(service_id):
+    """Услуга прайс-листа (одна строка) или None"""
+    found = run_query("SELECT * FROM services_catalog WHERE id = ?", (int(service_id),), fetch=True)
+    return found.iloc[0] if not found.empty else None
+
+# --- МАССОВЫЙ ИМПОРТ ---
+# Файл читается порциями по IMPORT_CHUNK_SIZE строк. Порция проверяется целиком, клиенты
+# сопоставляются одним запросом на порцию, запись идёт через executemany в одной транзакции
+# на порцию. Строки с ошибками пропускаются и попадают в отчёт с номером строки файла.
+IMPORT_CHUNK_SIZE = 5000
+
+IMPORT_KINDS = {
+    "clients": {
+        "title": "Клиенты",
+        "columns": ["name", "sex", "phone", "vk_id", "tg_id", "group"],
+    },
+    "orders": {
+        "title": "Заказы и услуги (строка = услуга)",
+        "columns": ["client_id", "phone", "vk_id", "tg_id", "order_ref", "execution_date", "status",
+                    "service_name", "payment_date", "amount", "hours"],
+    },
+}
+
+# Заголовки старой таблицы → колонки импорта (сравнение без регистра)
+IMPORT_COLUMN_ALIASES = {
+    "имя": "name", "пол": "sex", "телефон": "phone", "vk": "vk_id", "вк": "vk_id", "vk id": "vk_id",
+    "telegram": "tg_id", "телеграм": "tg_id", "tg": "tg_id", "группа": "group",
+    "id клиента": "client_id", "заказ": "order_ref", "№ заказа": "order_ref",
+    "дата исполнения": "execution_date", "статус": "status", "услуга": "service_name",
+    "дата оплаты": "payment_date", "сумма": "amount", "часы": "hours",
+}
+
+def _read_csv_chunks(file, chunk_size):
+    head = file.read(65536)
+    file.seek(0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"  # CSV из Excel на русской Windows
+    first_line = head.split(b"\n", 1)[0]
+    sep = ";" if first_line.count(b";") > first_line.count(b",") else ","
+    yield from pd.read_csv(file, sep=sep, encoding=encoding, dtype=str, keep_default_na=False,
+                           skipinitialspace=True, chunksize=chunk_size)
+
+def _xlsx_value(value):
+    """Ячейка Excel как в CSV: целые числа без .0 (телефоны), даты — YYYY-MM-DD"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (datetime, date)):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+def _read_xlsx_chunks(file, chunk_size):
+    try:
+        from openpyxl import load_workbook  # нужен только для XLSX
+    except ImportError:
+        raise ValueError("Для импорта XLSX установите пакет openpyxl")
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = ["" if h is None else str(h) for h in next(rows, ())]
+        batch = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            row = [_xlsx_value(v) for v in row[:len(header)]]
+            batch.append(row + [None] * (len(header) - len(row)))
+            if len(batch) == chunk_size:
+                yield pd.DataFrame(batch, columns=header, dtype=object)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=header, dtype=object)
+    finally:
+        wb.close()
+
+def read_import_chunks(file, filename, chunk_size=IMPORT_CHUNK_SIZE):
+    """Порции строк CSV/XLSX (бинарный файловый объект) с каноническими именами колонок"""
+    is_xlsx = filename.lower().endswith((".xlsx", ".xlsm"))
+    chunks = _read_xlsx_chunks(file, chunk_size) if is_xlsx else _read_csv_chunks(file, chunk_size)
+    for chunk in chunks:
+        names = [str(c).strip().lower() for c in chunk.columns]
+        chunk.columns = [IMPORT_COLUMN_ALIASES.get(n, n) for n in names]
+        yield chunk
+
+def count_import_rows(file, filename):
+    """Число строк данных для прогресса (для XLSX — по размеру листа, может быть неточным)"""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            return None
+        wb = load_workbook(file, read_only=True)
+        total = (wb.active.max_row or 1) - 1
+        wb.close()
+    else:
+        total = -1
+        for block in iter(lambda: file.read(1 << 20), b""):
+            total += block.count(b"\n")
+    file.seek(0)
+    return max(total, 1)
+
+def _cell(rec, column):
+    """Значение ячейки как строка без пробелов по краям; "" для пустой или отсутствующей"""
+    value = rec.get(column)
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ""
+    return str(value).strip()
+
+@lru_cache(maxsize=8192)
+def _import_date(raw):
+    """YYYY-MM-DD или None, если дату не удалось разобрать (даты в файле повторяются — кэшируем)"""
+    value = parse_date_to_db(raw)
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+        return value
+    except (TypeError, ValueError):
+        return None
+
+def _match_contacts(conn, key_sql, column, values):
+    """{введённое значение: [id клиентов]} по нормализованному контакту (индекс clients.<column>)"""
+    if not values:
+        return {}
+    found = {}
+    rows = conn.execute(f'''
+        SELECT k.value, c.id FROM json_each(?) k
+        JOIN clients c ON c.{column} = {key_sql("k.value")}
+    ''', (json.dumps(sorted(values)),))
+    for value, client_id in rows:
+        found.setdefault(value, []).append(client_id)
+    return found
+
+def _import_clients_chunk(conn, records, state):
+    rows, errors, checks = [], [], []
+    for n, rec in records:
+        name = _cell(rec, "name")
+        sex = _cell(rec, "sex").upper()
+        phone = normalize_phone(_cell(rec, "phone"))
+        vk = _cell(rec, "vk_id")
+        tg = normalize_telegram(_cell(rec, "tg_id"))
+        group = _cell(rec, "group")
+        if not name:
+            errors.append((n, "Не указано имя"))
+        elif sex not in ("", "М", "Ж"):
+            errors.append((n, f"Пол должен быть М или Ж: {sex}"))
+        elif phone is None:
+            errors.append((n, f"Некорректный телефон: {_cell(rec, 'phone')}"))
+        else:
+            checks.append((n, name, sex or None, phone, vk, tg, group))
+
+    contacts = {"phone": set(), "vk": set(), "tg": set()}
+    for _, _, _, phone, vk, tg, _ in checks:
+        for kind, value in (("phone", phone), ("vk", vk), ("tg", tg)):
+            if value:
+                contacts[kind].add(value)
+    taken = {}
+    if state["skip_duplicates"]:
+        taken["phone"] = _match_contacts(conn, _phone_key_sql, "phone_norm", contacts["phone"])
+        taken["vk"] = _match_contacts(conn, _vk_key_sql, "vk_norm", contacts["vk"])
+        taken["tg"] = _match_contacts(conn, _tg_key_sql, "tg_norm", contacts["tg"])
+
+    groups = state["groups"]
+    for n, name, sex, phone, vk, tg, group in checks:
+        if state["skip_duplicates"]:
+            dup = next(((kind, value) for kind, value in (("phone", phone), ("vk", vk), ("tg", tg))
+                        if value and (value in taken[kind] or (kind, value.lower()) in state["seen"])), None)
+            if dup:
+                owners = taken[dup[0]].get(dup[1])
+                where = f"у клиента #{owners[0]}" if owners else "выше в файле"
+                errors.append((n, f"Контакт {dup[1]} уже есть {where}"))
+                continue
+            state["seen"].update((kind, value.lower()) for kind, value in (("phone", phone), ("vk", vk), ("tg", tg)) if value)
+        group_id = None
+        if group and group != "Без группы":
+            if group not in groups:
+                groups[group] = conn.execute("INSERT INTO groups (name) VALUES (?)", (group,)).lastrowid
+            group_id = groups[group]
+        rows.append((name, sex, phone, vk, tg, group_id))
+
+    conn.executemany('''
+        INSERT INTO clients (name, sex, phone, vk_id, tg_id, group_id)
+        VALUES (?,?,?,?,?,?)
+    ''', rows)
+    return len(rows), errors
+
+def _import_orders_chunk(conn, records, state):
+    errors, checks = [], []
+    keys = {"id": set(), "phone": set(), "vk": set(), "tg": set()}
+    for n, rec in records:
+        client_id, phone, vk, tg = (_cell(rec, c) for c in ("client_id", "phone", "vk_id", "tg_id"))
+        if client_id:
+            key = ("id", client_id)
+        elif phone:
+            key = ("phone", phone)
+        elif vk:
+            key = ("vk", vk)
+        elif tg:
+            key = ("tg", tg)
+        else:
+            errors.append((n, "Не указан клиент (client_id, телефон, VK или Telegram)"))
+            continue
+        execution_date = _import_date(_cell(rec, "execution_date"))
+        status = _cell(rec, "status") or STATUS_LIST[0]
+        service_name = _cell(rec, "service_name")
+        payment_raw = _cell(rec, "payment_date")
+        payment_date = _import_date(payment_raw) if payment_raw else None
+        amount_raw = _cell(rec, "amount")
+        amount = parse_currency(amount_raw)
+        try:
+            hours = float(_cell(rec, "hours").replace(",", ".") or 0)
+        except ValueError:
+            hours = None
+
+        if not execution_date:
+            errors.append((n, f"Некорректная дата исполнения: {_cell(rec, 'execution_date')}"))
+        elif status not in STATUS_LIST:
+            errors.append((n, f"Неизвестный статус: {status}"))
+        elif not service_name:
+            errors.append((n, "Не указана услуга"))
+        elif payment_raw and not payment_date:
+            errors.append((n, f"Некорректная дата оплаты: {payment_raw}"))
+        elif amount == 0 and re.search(r"[1-9]", amount_raw):
+            errors.append((n, f"Некорректная сумма: {amount_raw}"))
+        elif hours is None:
+            errors.append((n, f"Некорректные часы: {_cell(rec, 'hours')}"))
+        else:
+            keys[key[0]].add(key[1])
+            checks.append((n, key, _cell(rec, "order_ref"), execution_date, status,
+                           service_name, payment_date, amount, hours))
+
+    matches = {
+        "phone": _match_contacts(conn, _phone_key_sql, "phone_norm", keys["phone"]),
+        "vk": _match_contacts(conn, _vk_key_sql, "vk_norm", keys["vk"]),
+        "tg": _match_contacts(conn, _tg_key_sql, "tg_norm", keys["tg"]),
+    }
+    if keys["id"]:
+        matches["id"] = {str(i): [i] for (i,) in conn.execute(
+            "SELECT c.id FROM json_each(?) k JOIN clients c ON c.id = k.value",
+            (json.dumps(sorted(keys["id"])),))}
+
+    items, orders = [], state["orders"]
+    for n, (kind, value), order_ref, execution_date, status, service_name, payment_date, amount, hours in checks:
+        found = matches.get(kind, {}).get(value)
+        if not found:
+            errors.append((n, f"Клиент не найден: {value}"))
+            continue
+        if len(found) > 1:
+            errors.append((n, f"Контакт {value} есть у нескольких клиентов: " + ", ".join(f"#{i}" for i in found)))
+            continue
+        # одна строка файла — одна услуга; услуги с одним order_ref (или одной датой и статусом) — один заказ
+        order_key = (found[0], order_ref) if order_ref else (found[0], execution_date, status)
+        if order_key not in orders:
+            orders[order_key] = conn.execute('''
+                INSERT INTO orders (client_id, execution_date, status) VALUES (?, ?, ?)
+            ''', (found[0], execution_date, status)).lastrowid
+        # название из прайс-листа становится service_id, несопоставленное сохраняется текстом
+        service_id = state["services"].get(service_name)
+        items.append((orders[order_key], service_id, service_name, payment_date, amount, hours))
+
+    conn.executemany('''
+        INSERT INTO order_items (order_id, service_id, service_name, payment_date, amount, hours)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', items)
+    return len(items), errors
+
+IMPORT_WRITERS = {"clients": _import_clients_chunk, "orders": _import_orders_chunk}
+
+def import_file(file, filename, kind, skip_duplicates=True, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """
+    Импорт CSV/XLSX: каждая порция записывается одним заданием очереди записи.
+    progress(обработано, всего) вызывается после каждой порции.
+    Возвращает (число записанных строк, DataFrame ошибок: строка файла, ошибка, исходные значения).
+    """
+    writer = IMPORT_WRITERS[kind]
+    total = count_import_rows(file, filename)
+    state = {"skip_duplicates": skip_duplicates, "seen": set(), "orders": {}, "groups": {}, "services": {}}
+    with get_pool().connection() as conn:
+        state["groups"] = {name: gid for gid, name in conn.execute("SELECT id, name FROM groups")}
+        state["services"] = {name: sid for name, sid in conn.execute(
+            "SELECT name, MIN(id) FROM services_catalog GROUP BY name")}
+
+    imported, done, failed = 0, 0, []
+    for chunk in read_import_chunks(file, filename, chunk_size):
+        records = list(zip(range(done + 2, done + 2 + len(chunk)), chunk.to_dict("records")))  # строка 1 — заголовок
+        written, errors = get_writer().submit(lambda conn: writer(conn, records, state))
+        imported += written
+        if errors:
+            raw = dict(records)
+            failed.extend({"row": n, "error": error, **raw[n]} for n, error in sorted(errors))
+        done += len(chunk)
+        if progress:
+            progress(done, max(total or done, done))
+    return imported, pd.DataFrame(failed, columns=None if failed else ["row", "error"])
+
+# --- ДВИЖОК ОТЧЁТОВ ---
+# Каждый отчёт — один агрегирующий SQL-запрос, который возвращает ровно отображаемые строки.
+# "params" перечисляет параметры отчёта, "filters" — условие WHERE для каждого из них;
+# условия неуказанных (None) параметров в запрос не попадают.
+# "snapshot" — тот же отчёт по снимку оплат: run_report берёт его, а SQL остаётся для выгрузки.
+# "types" — типы столбцов результата (как в SQL): по ним строится схема выгрузки в Parquet.
+REPORTS = {
+    "groups_by_year": {
+        "title": "Оплаты за год по группам",
+        "params": ("year",),
+        "filters": {"year": "r.year = :year"},
+        "snapshot": _snapshot_groups_by_year,
+        "types": {"group_name": "TEXT", "payments_count": "INTEGER", "total_sum": "REAL", "avg_sum": "REAL"},
+        "sql": '''
+            SELECT g.name AS group_name,
+                   SUM(r.items_count) AS payments_count,
+                   SUM(r.amount_sum) AS total_sum,
+                   SUM(r.amount_sum) / SUM(r.items_count) AS avg_sum
+            FROM revenue_rollup r
+            JOIN groups g ON g.id = r.group_id
+            WHERE {where}
+            GROUP BY r.group_id
+            ORDER BY g.name
+        ''',
+    },
+    "clients_by_year": {
+        "title": "Оплаты за год по клиентам",
+        "params": ("year", "group"),
+        "filters": {"year": "r.year = :year", "group": "r.group_id = :group"},
+        "snapshot": _snapshot_clients,
+        "types": {"client_name": "TEXT", "payments_count": "INTEGER", "total_sum": "REAL"},
+        "sql": '''
+            SELECT c.name AS client_name,
+                   SUM(r.items_count) AS payments_count,
+                   SUM(r.amount_sum) AS total_sum
+            FROM revenue_rollup r
+            JOIN clients c ON c.id = r.client_id
+            WHERE {where}
+            GROUP BY r.client_id
+            ORDER BY total_sum DESC
+        ''',
+    },
+    "new_clients": {
+        "title": "Новые клиенты за год",
+        "params": ("year", "group"),
+        # диапазон по дате вместо strftime('%Y', ...) = ?, чтобы работал индекс по first_order_date
+        "filters": {
+            "year": "c.first_order_date >= :year_start AND c.first_order_date < :year_end",
+            "group": "c.group_id = :group",
+        },
+        "types": {"name": "TEXT", "first_order_date": "TEXT", "payments_count": "INTEGER", "total_sum": "REAL"},
+        "sql": '''
+            SELECT c.name,
+                   c.first_order_date,
+                   COUNT(oi.id) AS payments_count,
+                   SUM(oi.amount) AS total_sum
+            FROM clients c
+            JOIN orders o ON c.id = o.client_id
+            JOIN order_items oi ON o.id = oi.order_id
+            WHERE {where}
+            GROUP BY c.id
+            ORDER BY total_sum DESC
+        ''',
+    },
+    "years_summary": {
+        "title": "Сводка по годам",
+        "params": (),
+        "filters": {},
+        "snapshot": _snapshot_years_summary,
+        "types": {"year": "INTEGER", "Количество_оплат": "INTEGER", "Макс_оплата": "REAL", "Мин_оплата": "REAL",
+                  "Средняя_оплата": "REAL", "Сумма_год": "REAL"},
+        "sql": '''
+            SELECT year,
+                   SUM(items_count) AS Количество_оплат,
+                   MAX(amount_max) AS Макс_оплата,
+                   MIN(amount_min) AS Мин_оплата,
+                   SUM(amount_sum) / SUM(items_count) AS Средняя_оплата,
+                   SUM(amount_sum) AS Сумма_год
+            FROM revenue_rollup
+            WHERE {where}
+            GROUP BY year
+            ORDER BY year
+        ''',
+    },
+    "clients_by_month": {
+        "title": "Оплаты за месяц (детализация)",
+        "params": ("year", "month", "group"),
+        "filters": {"year": "r.year = :year", "month": "r.month = :month", "group": "r.group_id = :group"},
+        "snapshot": _snapshot_clients,
+        "types": {"client_name": "TEXT", "payments_count": "INTEGER", "total_sum": "REAL"},
+        "sql": '''
+            SELECT c.name AS client_name,
+                   SUM(r.items_count) AS payments_count,
+                   SUM(r.amount_sum) AS total_sum
+            FROM revenue_rollup r
+            JOIN clients c ON c.id = r.client_id
+            WHERE {where}
+            GROUP BY r.client_id
+            ORDER BY total_sum DESC
+        ''',
+    },
+    "services": {
+        "title": "Выручка и часы по услугам",
+        "params": ("year", "month", "group"),
+        "filters": {"year": "year = :year", "month": "month = :month", "group": "group_id = :group"},
+        "snapshot": _snapshot_services,
+        # итоги сворачиваются по целому service_id, названия прайс-листа подставляются к готовым строкам
+        "types": {"service_id": "INTEGER", "service_name": "TEXT", "payments_count": "INTEGER",
+                  "total_sum": "REAL", "total_hours": "REAL"},
+        "sql": '''
+            SELECT r.service_id,
+                   COALESCE(sc.name, 'Не из прайс-листа') AS service_name,
+                   r.payments_count,
+                   r.total_sum,
+                   r.total_hours
+            FROM (
+                SELECT service_id,
+                       SUM(items_count) AS payments_count,
+                       SUM(amount_sum) AS total_sum,
+                       SUM(hours_sum) AS total_hours
+                FROM revenue_rollup
+                WHERE {where}
+                GROUP BY service_id
+            ) r
+            LEFT JOIN services_catalog sc ON sc.id = r.service_id
+            ORDER BY r.total_sum DESC, r.service_id
+        ''',
+    },
+    "months_of_year": {
+        "title": "Динамика по месяцам",
+        "params": ("year",),
+        "filters": {"year": "year = :year"},
+        "snapshot": _snapshot_months_of_year,
+        "types": {"month": "INTEGER", "Количество_оплат": "INTEGER", "Средняя_оплата": "REAL", "Сумма": "REAL"},
+        "sql": '''
+            SELECT month,
+                   SUM(items_count) AS Количество_оплат,
+                   SUM(amount_sum) / SUM(items_count) AS Средняя_оплата,
+                   SUM(amount_sum) AS Сумма
+            FROM revenue_rollup
+            WHERE {where}
+            GROUP BY month
+            ORDER BY month
+        ''',
+    },
+    "last_week": {
+        "title": "Оплаты за последнюю неделю",
+        "params": ("since",),
+        "filters": {"since": "oi.payment_date >= :since"},
+        "snapshot": _snapshot_last_week,
+        "types": {"name": "TEXT", "payment_date": "TEXT", "total_amount": "REAL"},
+        "sql": '''
+            SELECT c.name, oi.payment_date, SUM(oi.amount) as total_amount
+            FROM order_items oi
+            JOIN orders o ON oi.order_id = o.id
+            JOIN clients c ON o.client_id = c.id
+            WHERE {where}
+            GROUP BY c.name, oi.payment_date
+            ORDER BY oi.payment_date DESC
+        ''',
+    },
+    "cohorts": {
+        "title": "Когорты по месяцу первой оплаты",
+        "params": ("year", "group"),
+        # year — год привлечения когорты; клиент попадает в когорту месяца first_order_date
+        "filters": {
+            "year": "c.first_order_date >= :year_start AND c.first_order_date < :year_end",
+            "group": "c.group_id = :group",
+        },
+        # m сворачивает агрегаты до клиента-месяца, читая покрывающий индекс по порядку (без сортировки),
+        # k — когорта клиента; итог сворачивается до когорты и номера месяца с первой оплаты
+        "types": {"cohort": "TEXT", "month_offset": "INTEGER", "clients": "INTEGER", "revenue": "REAL"},
+        "sql": '''
+            SELECT k.cohort,
+                   m.ym - k.cohort_ym AS month_offset,
+                   COUNT(*) AS clients,
+                   SUM(m.revenue) AS revenue
+            FROM (
+                SELECT client_id, year * 12 + month AS ym, SUM(amount_sum) AS revenue
+                FROM revenue_rollup
+                GROUP BY client_id, year, month
+            ) m
+            JOIN (
+                SELECT c.id,
+                       substr(c.first_order_date, 1, 7) AS cohort,
+                       CAST(substr(c.first_order_date, 1, 4) AS INTEGER) * 12
+                           + CAST(substr(c.first_order_date, 6, 2) AS INTEGER) AS cohort_ym
+                FROM clients c
+                WHERE c.first_order_date IS NOT NULL AND {where}
+            ) k ON k.id = m.client_id
+            WHERE m.ym >= k.cohort_ym
+            GROUP BY k.cohort, month_offset
+            ORDER BY k.cohort, month_offset
+        ''',
+    },
+    "ledger": {
+        "title": "Журнал оплат (все услуги)",
+        "params": ("year", "month", "group"),
+        # диапазоны по payment_date, чтобы выборка и сортировка шли по индексу
+        "filters": {
+            "year": "oi.payment_date >= :year_start AND oi.payment_date < :year_end",
+            "month": "strftime('%m', oi.payment_date) = printf('%02d', :month)",
+            "group": "c.group_id = :group",
+        },
+        "types": {
+            "payment_date": "TEXT", "item_id": "INTEGER", "order_id": "INTEGER", "execution_date": "TEXT",
+            "status": "TEXT", "client_id": "INTEGER", "client_name": "TEXT", "group_name": "TEXT",
+            "service_id": "INTEGER", "service_name": "TEXT", "amount": "REAL", "hours": "REAL",
+        },
+        "sql": '''
+            SELECT oi.payment_date,
+                   oi.id AS item_id,
+                   o.id AS order_id,
+                   o.execution_date,
+                   o.status,
+                   c.id AS client_id,
+                   c.name AS client_name,
+                   COALESCE(g.name, 'Без группы') AS group_name,
+                   oi.service_id,
+                   COALESCE(sc.name, oi.service_name) AS service_name,
+                   oi.amount,
+                   oi.hours
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            JOIN clients c ON c.id = o.client_id
+            LEFT JOIN groups g ON g.id = c.group_id
+            LEFT JOIN services_catalog sc ON sc.id = oi.service_id
+            WHERE oi.payment_date IS NOT NULL AND {where}
+            ORDER BY oi.payment_date, oi.id
+        ''',
+    },
+}
+
+def _check_report_params(name, params):
+    unknown = set(params) - set(REPORTS[name]["params"])
+    if unknown:
+        raise ValueError(f"Отчёт {name} не принимает параметры: {', '.join(sorted(unknown))}")
+
+def compile_report(name, **params):
+    """Собирает SQL отчёта и параметры привязки"""
+    report = REPORTS[name]
+    _check_report_params(name, params)
+
+    conditions = []
+    bindings = {}
+    for param in report["params"]:
+        value = params.get(param)
+        if value is None:
+            continue
+        conditions.append(report["filters"][param])
+        bindings[param] = value if isinstance(value, str) else int(value)  # даты — строкой YYYY-MM-DD
+        if param == "year":
+            bindings["year_start"] = f"{int(value):04d}-01-01"
+            bindings["year_end"] = f"{int(value) + 1:04d}-01-01"
+
+    sql = report["sql"].format(where=" AND ".join(conditions) or "1")
+    return sql, bindings
+
+REPORT_TABLES = ("groups", "clients", "services_catalog", "orders", "order_items", "revenue_rollup")
+
+@cached_read(*REPORT_TABLES)
+def run_report(name, **params):
+    """Результат отчёта; кэшируется по набору параметров до записи в таблицы отчётов"""
+    snapshot = REPORTS[name].get("snapshot")
+    if snapshot is not None:
+        _check_report_params(name, params)
+        try:
+            ledger = ledger_snapshot()
+        except sqlite3.Error as e:
+            _error_handler(f"Ошибка БД: {e}")
+            return pd.DataFrame()
+        return snapshot(ledger, **{param: value for param, value in params.items() if value is not None})
+    sql, bindings = compile_report(name, **params)
+    return run_query(sql, bindings, fetch=True)
+
+COHORT_METRICS = {"clients": "Доля клиентов", "revenue": "Доля выручки"}
+
+def cohort_matrix(cohorts, metric="clients"):
+    """
+    Матрица удержания по результату отчёта cohorts: строка — когорта (месяц первой оплаты),
+    столбец — месяцев с первой оплаты, значение — доля клиентов когорты (или выручки первого месяца),
+    оплативших в этом месяце. Столбец size — размер когорты: клиентов или выручка первого месяца.
+    """
+    if cohorts.empty:
+        return pd.DataFrame()
+    matrix = cohorts.pivot(index="cohort", columns="month_offset", values=metric)
+    # месяцы без единой оплаты в выборке тоже нужны столбцами, иначе смещения «перескакивают»
+    matrix = matrix.reindex(columns=range(int(matrix.columns.max()) + 1)).fillna(0.0)
+    # месяцы, которые для когорты ещё не наступили, — пропуски, а не нули
+    today = date.today()
+    cohort_ym = matrix.index.str[:4].astype(int) * 12 + matrix.index.str[5:7].astype(int)
+    elapsed = (today.year * 12 + today.month) - cohort_ym.to_numpy()
+    matrix = matrix.where(matrix.columns.to_numpy()[None, :] <= elapsed[:, None])
+    # когорта без оплат в свой первый месяц (дата первой оплаты старше оплат) не даёт базы для долей
+    matrix = matrix[matrix[0] > 0]
+    size = matrix[0]
+    matrix = matrix.div(size, axis=0)
+    matrix.insert(0, "size", size)
+    return matrix
+
+@cached_read(*REPORT_TABLES)
+def load_report_years():
+    """Годы, за которые есть оплаты (из помесячных агрегатов)"""
+    years_df = run_query("SELECT DISTINCT year FROM revenue_rollup ORDER BY year", fetch=True)
+    return years_df['year'].tolist() if not years_df.empty else []
+
+# --- ПРЕДРАСЧЁТ ОТЧЁТОВ ---
+# Годовые и месячные отчёты считаются заранее в фоне и хранятся на диске (RESULTS_DB_PATH) в Parquet
+# с ключом «база + отчёт + параметры» и версиями таблиц, по которым посчитаны, поэтому переживают
+# перезапуск. Страница сразу получает сохранённый результат; если версии с тех пор изменились,
+# он помечается устаревшим (attrs["stale"]), а пересчёт ставится в фоновую очередь.
+# Полный проход запускается при старте, после того как запись затихла на PRECOMPUTE_SETTLE секунд,
+# и по расписанию раз в PRECOMPUTE_INTERVAL секунд (он же ловит запись внешних скриптов).
+RESULTS_DB_PATH = 'report_cache.db'
+PRECOMPUTE_SETTLE = 5        # секунд без записи перед пересчётом
+PRECOMPUTE_INTERVAL = 900    # плановый пересчёт, секунд
+PRECOMPUTE_MONTH_YEARS = 1   # за сколько последних лет держать посчитанной помесячную детализацию
+
+RESULTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS report_results (
+    db TEXT NOT NULL,
+    report TEXT NOT NULL,
+    params TEXT NOT NULL,       -- JSON параметров без пустых
+    versions TEXT NOT NULL,     -- JSON версий REPORT_TABLES на момент расчёта
+    computed_at TEXT DEFAULT (datetime('now', 'localtime')),
+    compute_ms REAL,
+    data BLOB NOT NULL,         -- результат в Parquet
+    PRIMARY KEY (db, report, params)) WITHOUT ROWID;
+'''
+
+def get_results_pool():
+    """Пул соединений кэша результатов (отдельный файл, как и база метрик)"""
+    return _shared_pool(RESULTS_DB_PATH, 2, setup=lambda conn: conn.executescript(RESULTS_SCHEMA))
+
+def _result_key(name, params):
+    # база в памяти живёт только с пулом, поэтому её результаты ключуются пулом, а не путём
+    db = f":memory:{get_pool().uid}" if DB_PATH == ":memory:" else os.path.abspath(DB_PATH)
+    return db, name, json.dumps({k: v for k, v in params.items() if v is not None}, sort_keys=True, default=int)
+
+def _stored_result(key, with_data=True):
+    """(versions, computed_at, DataFrame или None) сохранённого результата; None — результата нет"""
+    try:
+        with get_results_pool().connection() as conn:
+            row = conn.execute(f'''
+                SELECT versions, computed_at, {"data" if with_data else "NULL"}
+                FROM report_results WHERE db = ? AND report = ? AND params = ?
+            ''', key).fetchone()
+    except sqlite3.Error:
+        return None  # кэш результатов вспомогательный: без него отчёты просто считаются заново
+    if row is None:
+        return None
+    return row[0], row[1], pd.read_parquet(io.BytesIO(row[2])) if with_data else None
+
+def _compute_result(name, params):
+    """Считает отчёт и сохраняет результат с версиями таблиц, прочитанными до расчёта"""
+    versions = json.dumps(table_versions(REPORT_TABLES))
+    started = time.perf_counter()
+    df = run_report(name, **params)
+    compute_ms = (time.perf_counter() - started) * 1000
+    if len(df.columns):  # пустой кадр без колонок — ошибка БД, её не сохраняем
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        try:
+            with get_results_pool().connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO report_results (db, report, params, versions, compute_ms, data)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (*_result_key(name, params), versions, compute_ms, buffer.getvalue()))
+                conn.commit()
+        except sqlite3.Error:
+            pass
+    return df
+
+@cached_read(*REPORT_TABLES)
+def precomputed_report(name, **params):
+    """
+    Результат отчёта из кэша на диске. attrs["stale"] — результат посчитан по старым данным и уже
+    пересчитывается в фоне, attrs["computed_at"] — когда посчитан. Если результата нет
+    или фоновый предрасчёт не запущен (скрипты), отчёт считается сразу.
+    """
+    stored = _stored_result(_result_key(name, params))
+    if stored is not None:
+        versions, computed_at, df = stored
+        stale = versions != json.dumps(table_versions(REPORT_TABLES))
+        if not stale or _schedule_precompute((name, _result_key(name, params)[2]), _refresh_result, name, params):
+            df.attrs.update(stale=stale, computed_at=computed_at)
+            return df
+    df = _compute_result(name, params)
+    df.attrs.update(stale=False, computed_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return df
+
+def _precompute_calls():
+    """Отчёты, которые держатся посчитанными: (отчёт, параметры)"""
+    years = load_report_years()
+    calls = [("years_summary", {}), ("cohorts", {})]
+    for year in years:
+        calls += [(name, {"year": year})
+                  for name in ("groups_by_year", "clients_by_year", "new_clients", "months_of_year", "services")]
+    for year in years[-PRECOMPUTE_MONTH_YEARS:]:
+        calls += [("clients_by_month", {"year": year, "month": month}) for month in range(1, 13)]
+    return calls
+
+def _refresh_result(name, params):
+    """Пересчитывает результат, если его нет или он устарел; True — пересчитан"""
+    stored = _stored_result(_result_key(name, params), with_data=False)
+    if stored is not None and stored[0] == json.dumps(table_versions(REPORT_TABLES)):
+        return False
+    _compute_result(name, params)
+    return True
+
+def precompute_reports():
+    """Досчитывает отсутствующие и устаревшие результаты из _precompute_calls(), возвращает их число"""
+    return sum(_refresh_result(name, params) for name, params in _precompute_calls())
+
+_PRECOMPUTE = {}   # база -> {"executor", "wake", "pending"}
+_PRECOMPUTE_LOCK = threading.Lock()
+
+def _schedule_precompute(key, func, *args):
+    """
+    Ставит func(*args) в фоновую очередь базы DB_PATH; пока такое же задание ждёт в очереди, второе
+    не ставится (начатое не в счёт: оно могло прочитать данные до последней записи). False — фон не запущен.
+    """
+    runner = _PRECOMPUTE.get(DB_PATH)
+    if runner is None:
+        return False
+    with _PRECOMPUTE_LOCK:
+        if key in runner["pending"]:
+            return True
+        runner["pending"].add(key)
+    runner["executor"].submit(_precompute_job, runner, key, func, *args)
+    return True
+
+def _precompute_job(runner, key, func, *args):
+    with _PRECOMPUTE_LOCK:
+        runner["pending"].discard(key)
+    start_rerun("Предрасчёт отчётов", memo=False)  # медленные запросы фона видны в журнале под этим именем
+    try:
+        func(*args)
+    except Exception as e:
+        _print_error(f"Предрасчёт отчётов: {e}")
+    finally:
+        precomputed_report.clear()  # следующее чтение возьмёт свежий результат с диска
+
+def _precompute_schedule(runner):
+    while True:
+        if runner["wake"].wait(PRECOMPUTE_INTERVAL):
+            # запись идёт — ждём, пока она затихнет
+            runner["wake"].clear()
+            while runner["wake"].wait(PRECOMPUTE_SETTLE):
+                runner["wake"].clear()
+        _schedule_precompute("*", precompute_reports)
+
+def _precompute_on_write(path):
+    runner = _PRECOMPUTE.get(path)
+    if runner is not None:
+        runner["wake"].set()
+
+on_write(_precompute_on_write)
+
+def start_precompute():
+    """Запускает фоновый предрасчёт отчётов базы DB_PATH (один раз на процесс) и первый проход"""
+    with _PRECOMPUTE_LOCK:
+        if DB_PATH in _PRECOMPUTE:
+            return
+        runner = _PRECOMPUTE[DB_PATH] = {
+            "executor": ThreadPoolExecutor(max_workers=1, thread_name_prefix="studio-precompute"),
+            "wake": threading.Event(),
+            "pending": set(),
+        }
+    threading.Thread(target=_precompute_schedule, args=(runner,), name="studio-precompute-schedule", daemon=True).start()
+    _schedule_precompute("*", precompute_reports)
+
+# --- ВЫГРУЗКА ---
+# Отчёт читается с курсора порциями по EXPORT_CHUNK_SIZE строк и сразу дописывается в файл,
+# поэтому память ограничена одной порцией независимо от периода выгрузки.
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_DIR = os.environ.get('STUDIO_EXPORT_DIR')   # None — папка exports рядом с базой
+EXPORT_KEEP_SECONDS = 24 * 3600   # выгрузки старше удаляются при следующей выгрузке
+EXPORT_DOWNLOAD_LIMIT = 50 * 1024 * 1024   # больше — без кнопки скачивания: Streamlit держит её файл в памяти
+EXPORT_FORMATS = {"csv": "CSV", "parquet": "Parquet"}
+EXPORT_FILTERS = ("year", "month", "group")   # фильтры, которые есть в форме выгрузки
+
+def iter_report_chunks(name, chunk_size=EXPORT_CHUNK_SIZE, **params):
+    """
+    Результат отчёта порциями DataFrame (fetchmany), без загрузки всего результата.
+    Пустой результат — одна пустая порция с колонками курсора, чтобы в файле остался заголовок.
+    """
+    sql, bindings = compile_report(name, **params)
+    with get_pool().connection() as conn:
+        cursor = conn.execute(sql, bindings)
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            yield pd.DataFrame(columns=columns)
+        while rows:
+            yield pd.DataFrame.from_records(rows, columns=columns)
+            rows = cursor.fetchmany(chunk_size)
+
+def _write_csv(chunks, out, types=None):
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")  # BOM — чтобы Excel понял UTF-8
+    rows = 0
+    for i, chunk in enumerate(chunks):
+        chunk.to_csv(text, index=False, header=i == 0)
+        rows += len(chunk)
+    text.flush()
+    text.detach()
+    return rows
+
+def _parquet_schema(columns, types):
+    """Схема Parquet по объявленным типам отчёта, а не по первой порции: NULL в ней не задаёт тип колонки"""
+    import pyarrow as pa
+
+    arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string()}
+    return pa.schema([pa.field(c, arrow_types[types.get(c, "TEXT")]) for c in columns])
+
+def _write_parquet(chunks, out, types=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer, schema, rows = None, None, 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                schema = _parquet_schema(chunk.columns, types or {})
+                writer = pq.ParquetWriter(out, schema)
+            # каждую колонку приводим к типу схемы: целые с NULL приходят из pandas как float
+            arrays = [pa.array(chunk[f.name], from_pandas=True).cast(f.type) for f in schema]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+EXPORT_WRITERS = {"csv": _write_csv, "parquet": _write_parquet}
+
+def export_report(name, out, fmt="csv", chunk_size=EXPORT_CHUNK_SIZE, **params):
+    """
+    Пишет отчёт (или журнал оплат "ledger") в бинарный файловый объект out.
+    Параметры, которых отчёт не принимает (например, group у сводки по годам), пропускаются.
+    Возвращает число выгруженных строк.
+    """
+    accepted = {k: v for k, v in params.items() if k in REPORTS[name]["params"]}
+    chunks = iter_report_chunks(name, chunk_size, **accepted)
+    return EXPORT_WRITERS[fmt](chunks, out, REPORTS[name].get("types", {}))
+
+def export_dir():
+    """Папка выгрузок: EXPORT_DIR, иначе exports рядом с базой (у базы в памяти — во временной папке)"""
+    if EXPORT_DIR:
+        return EXPORT_DIR
+    if DB_PATH == ":memory:":
+        return os.path.join(tempfile.gettempdir(), "studio-exports")
+    return os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "exports")
+
+def _cleanup_exports(folder):
+    """Удаляет выгрузки старше EXPORT_KEEP_SECONDS"""
+    cutoff = time.time() - EXPORT_KEEP_SECONDS
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass  # файл могут скачивать прямо сейчас — удалится в следующий раз
+
+def export_report_file(name, fmt="csv", **params):
+    """Выгрузка в файл <папка выгрузок>/<отчёт>[_год][_месяц][_группа].<формат>; возвращает (путь, число строк)"""
+    folder = export_dir()
+    os.makedirs(folder, exist_ok=True)
+    _cleanup_exports(folder)
+    suffix = "".join(f"_{params[k]}" for k in EXPORT_FILTERS if params.get(k) is not None)
+    path = os.path.join(folder, f"{name}{suffix}.{fmt}")
+    with open(path, "wb") as out:
+        rows = export_report(name, out, fmt, **params)
+    return path, rows